@@ -0,0 +1,402 @@
+"""Benchmark the guideseq task locally on synthetic data.
+
+Generates a small reference, a pooled GUIDE-seq run and a manifest, serves
+them from an in-process moto S3 (or any S3 compatible endpoint, such as
+MinIO, given with --endpoint-url), and runs the body of the guideseq task
+against them. The phases the task records in its metrics.json, such as
+the download and each pipeline stage, are combined with the bytes moved
+and a timed stand-in for the final upload, and written as JSON so that
+runs can be compared across versions.
+
+    python bench.py --reads 200000 --samples 3 --out bench.json
+
+With --import-time it instead times `import latch` in fresh interpreters,
+as task startup and registration pay it, lists the slowest imports and
+fails if modules that should only load at task execution were imported.
+
+    python bench.py --import-time --max-import-seconds 2
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BUCKET = "guideseq-bench"
+INPUT_PREFIX = "inputs/test"
+OUTPUT_PREFIX = "outputs"
+BASES = "ACGT"
+IMPORT_REPEATS = 5
+# Loaded on first use, never by importing latch.
+DEFERRED_MODULES = ("boto3", "numpy", "yaml")
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def _random_seq(rng: random.Random, length: int) -> str:
+    return "".join(rng.choices(BASES, k=length))
+
+
+def _revcomp(seq: str) -> str:
+    return seq[::-1].translate(str.maketrans("ACGT", "TGCA"))
+
+
+def generate(
+    root: str,
+    reads: int,
+    samples: int,
+    genome_length: int,
+    read_length: int,
+    seed: int = 0,
+) -> str:
+    """
+    Writes a synthetic run under root/test and returns the manifest path.
+
+    params:
+    - reads: read pairs in the pooled run, 1% of which match no sample
+    - samples: treatment samples, in addition to the control
+    - genome_length: bases in each of the two reference chromosomes
+    - read_length: length of the forward and reverse reads
+    """
+    rng = random.Random(seed)
+    data_dir = os.path.join(root, "test")
+    os.makedirs(data_dir, exist_ok=True)
+
+    chroms = {f"chr{i + 1}": _random_seq(rng, genome_length) for i in range(2)}
+    with open(os.path.join(data_dir, "genome.fa"), "w") as f:
+        for name, seq in chroms.items():
+            f.write(f">{name}\n")
+            for i in range(0, len(seq), 60):
+                f.write(seq[i : i + 60] + "\n")
+
+    barcodes = set()
+    while len(barcodes) < samples + 1:
+        barcodes.add((_random_seq(rng, 8), _random_seq(rng, 8)))
+    manifest_samples = {}
+    sites = {}
+    for i, (barcode1, barcode2) in enumerate(sorted(barcodes)):
+        name = "control" if i == 0 else f"sample{i}"
+        target = ""
+        if i > 0:
+            chrom = rng.choice(list(chroms))
+            pos = rng.randrange(read_length, genome_length - 2 * read_length)
+            sites[name] = (chrom, pos)
+            target = chroms[chrom][pos : pos + 20] + "NGG"
+        manifest_samples[name] = {
+            "target": target,
+            "barcode1": barcode1,
+            "barcode2": barcode2,
+            "description": name,
+        }
+
+    names = list(manifest_samples)
+    outputs = {
+        end: gzip.open(os.path.join(data_dir, f"undemux.{end}.fastq.gz"), "wt", 1)
+        for end in ("r1", "r2", "i1", "i2")
+    }
+    quality = "I" * read_length
+    try:
+        for n in range(reads):
+            if rng.random() < 0.01:
+                barcode1, barcode2 = _random_seq(rng, 8), _random_seq(rng, 8)
+                sample = None
+            else:
+                sample = rng.choice(names)
+                barcode1 = manifest_samples[sample]["barcode1"]
+                barcode2 = manifest_samples[sample]["barcode2"]
+            # Half of a treatment's reads pile up around its cleavage site.
+            if sample in sites and rng.random() < 0.5:
+                chrom, site = sites[sample]
+                start = site + rng.randrange(-10, 10)
+            else:
+                chrom = rng.choice(list(chroms))
+                start = rng.randrange(0, genome_length - 3 * read_length)
+            length = rng.randrange(2 * read_length, 3 * read_length)
+            fragment = chroms[chrom][start : start + length]
+            records = {
+                "r1": fragment[:read_length],
+                "r2": _revcomp(fragment[-read_length:]),
+                "i1": barcode1,
+                "i2": barcode2 + _random_seq(rng, 8),
+            }
+            for end, seq in records.items():
+                outputs[end].write(f"@read{n}\n{seq}\n+\n{quality[: len(seq)]}\n")
+    finally:
+        for f in outputs.values():
+            f.close()
+
+    manifest = {
+        "reference_genome": "test/genome.fa",
+        "output_folder": "output",
+        "bwa": "bwa",
+        "bedtools": "bedtools",
+        "PAM": "NGG",
+        "demultiplex_min_reads": max(1, reads // (4 * (samples + 1))),
+        "undemultiplexed": {
+            field: f"test/undemux.{end}.fastq.gz"
+            for field, end in zip(
+                ("forward", "reverse", "index1", "index2"), ("r1", "r2", "i1", "i2")
+            )
+        },
+        "samples": manifest_samples,
+    }
+    manifest_path = os.path.join(root, "manifest.yaml")
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)  # JSON is valid YAML.
+    return manifest_path
+
+
+def _add_phase(phases: dict, name: str, metrics: dict):
+    """Adds metrics of another Telemetry to phases[name]."""
+    phase = phases.setdefault(name, {})
+    for key, value in metrics.items():
+        if key == "peak_rss_bytes":
+            phase[key] = max(phase.get(key, 0), value)
+        else:
+            phase[key] = phase.get(key, 0) + value
+
+
+def _dir_bytes(path: str) -> int:
+    return sum(p.stat().st_size for p in Path(path).rglob("*") if p.is_file())
+
+
+def run_benchmark(args) -> dict:
+    work = tempfile.mkdtemp(prefix="guideseq-bench-")
+    data_root = os.path.join(work, "data")
+    start = time.time()
+    manifest_path = generate(
+        data_root,
+        args.reads,
+        args.samples,
+        args.genome_length,
+        args.read_length,
+        args.seed,
+    )
+    generate_seconds = time.time() - start
+
+    if args.endpoint_url:
+        os.environ["AWS_ENDPOINT_URL"] = args.endpoint_url
+        mock = None
+    else:
+        # Must start before latch builds its s3 client on first use.
+        from moto import mock_aws
+
+        os.environ.setdefault("AWS_ACCESS_KEY_ID", "bench")
+        os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "bench")
+        os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+        mock = mock_aws()
+        mock.start()
+
+    try:
+        from flytekit.types.directory import FlyteDirectory
+        from flytekit.types.file import FlyteFile
+
+        import latch
+        from latch.s3_dir_download import get_s3_client, list_objects
+        from latch.s3_dir_upload import STAGES, upload_files
+        from latch.telemetry import Telemetry
+
+        s3_client = get_s3_client()
+        s3_client.create_bucket(Bucket=BUCKET)
+        input_files = [
+            str(p) for p in Path(data_root, "test").rglob("*") if p.is_file()
+        ]
+        upload_files(input_files, os.path.join(data_root, "test"), BUCKET, INPUT_PREFIX)
+
+        downloaded = {"bytes": 0}
+
+        def count_get(http_response, parsed, **kwargs):
+            downloaded["bytes"] += parsed.get("ContentLength", 0)
+
+        s3_client.meta.events.register("after-call.s3.GetObject", count_get)
+
+        def remote_dir(uri: str) -> FlyteDirectory:
+            d = FlyteDirectory(uri)
+            d._remote_source = uri
+            return d
+
+        run_dir = os.path.join(work, "run")
+        os.makedirs(run_dir)
+        if os.path.isdir(args.guideseq):
+            os.symlink(
+                os.path.abspath(args.guideseq), os.path.join(run_dir, "guideseq")
+            )
+        cwd = os.getcwd()
+        os.chdir(run_dir)
+
+        try:
+            out = latch.guideseq.task_function(
+                manifest=FlyteFile(manifest_path),
+                input_dir=remote_dir(f"s3://{BUCKET}/{INPUT_PREFIX}"),
+                output_dir=remote_dir(f"s3://{BUCKET}/{OUTPUT_PREFIX}"),
+                **args.task_inputs,
+            )
+            # The task's own telemetry, whose download phase spans every
+            # fetch, including those of stepwise and pipelined runs.
+            metrics_path = os.path.join(latch.OUTPUT_FOLDER, "metrics.json")
+            phases = {}
+            # Absent when the run cache served the run.
+            if os.path.isfile(metrics_path):
+                with open(metrics_path) as f:
+                    phases = json.load(f)["phases"]
+            phases.setdefault("download", {})["bytes"] = downloaded["bytes"]
+            for stage in STAGES:
+                if stage in phases:
+                    phases[stage]["bytes"] = _dir_bytes(
+                        os.path.join(latch.OUTPUT_FOLDER, stage)
+                    )
+            # Stands in for flytekit publishing the returned directory.
+            local = out.path
+            with Telemetry() as telemetry:
+                with telemetry.phase("upload"):
+                    upload_files(
+                        [str(p) for p in Path(local).rglob("*") if p.is_file()],
+                        local,
+                        BUCKET,
+                        f"{OUTPUT_PREFIX}/{latch.OUTPUT_FOLDER}",
+                    )
+            _add_phase(phases, "upload", telemetry.phases["upload"])
+            phases["upload"]["bytes"] = sum(
+                obj["Size"]
+                for obj in list_objects(
+                    f"{OUTPUT_PREFIX}/{latch.OUTPUT_FOLDER}", BUCKET
+                )
+            )
+        finally:
+            os.chdir(cwd)
+    finally:
+        if mock is not None:
+            mock.stop()
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+    with open(os.path.join(os.path.dirname(latch.__file__), "version")) as f:
+        version = f.read().strip()
+    return {
+        "version": version,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "params": {
+            "reads": args.reads,
+            "samples": args.samples,
+            "genome_length": args.genome_length,
+            "read_length": args.read_length,
+            "seed": args.seed,
+            "task_inputs": args.task_inputs,
+        },
+        "generate_seconds": generate_seconds,
+        "wall_seconds": time.time() - start - generate_seconds,
+        "phases": phases,
+    }
+
+
+def import_time(repeats: int = IMPORT_REPEATS) -> dict:
+    """
+    Times `import latch` in fresh interpreters. Reports the median, the
+    modules with the largest cumulative import time in the median run, and
+    any of DEFERRED_MODULES it pulled in.
+    """
+    check = "import sys; print(','.join(m for m in %r if m in sys.modules))" % (
+        DEFERRED_MODULES,
+    )
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import latch; " + check],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+        wall = time.perf_counter() - start
+        modules = {}
+        for line in out.stderr.splitlines():
+            match = IMPORTTIME_LINE.match(line)
+            if match:
+                modules[match.group(4)] = int(match.group(2)) / 1e6
+        runs.append((wall, modules, out.stdout.strip()))
+
+    wall, modules, loaded = sorted(runs, key=lambda run: run[0])[len(runs) // 2]
+    slowest = sorted(modules.items(), key=lambda item: -item[1])[:15]
+    return {
+        "repeats": repeats,
+        "wall_seconds": statistics.median(run[0] for run in runs),
+        "latch_seconds": modules.get("latch", 0.0),
+        "slowest_imports": dict(slowest),
+        "deferred_modules_loaded": [m for m in loaded.split(",") if m],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--reads", type=int, default=100000)
+    parser.add_argument("--samples", type=int, default=2)
+    parser.add_argument("--genome-length", type=int, default=500000)
+    parser.add_argument("--read-length", type=int, default=75)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--task-inputs",
+        type=json.loads,
+        default={},
+        help="extra guideseq task inputs as JSON, e.g. '{\"streaming_demultiplex\": true}'",
+    )
+    parser.add_argument(
+        "--endpoint-url", help="S3 compatible endpoint to use instead of moto"
+    )
+    parser.add_argument(
+        "--guideseq",
+        default="guideseq",
+        help="checkout of the guideseq repository, linked into the run directory",
+    )
+    parser.add_argument("--keep", action="store_true", help="keep the work directory")
+    parser.add_argument("--out", help="JSON file to write, stdout if omitted")
+    parser.add_argument(
+        "--import-time",
+        action="store_true",
+        help="benchmark `import latch` instead of running the task",
+    )
+    parser.add_argument("--import-repeats", type=int, default=IMPORT_REPEATS)
+    parser.add_argument(
+        "--max-import-seconds",
+        type=float,
+        help="fail if the median cumulative import time of latch exceeds this",
+    )
+    args = parser.parse_args(argv)
+
+    if args.import_time:
+        results = import_time(args.import_repeats)
+    else:
+        results = run_benchmark(args)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.import_time:
+        if results["deferred_modules_loaded"]:
+            sys.exit(
+                "import latch loaded "
+                + ", ".join(results["deferred_modules_loaded"])
+                + ", which should load on first use"
+            )
+        if (
+            args.max_import_seconds is not None
+            and results["latch_seconds"] > args.max_import_seconds
+        ):
+            sys.exit(
+                f"import latch took {results['latch_seconds']:.2f}s, "
+                f"over the {args.max_import_seconds}s budget"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,21 +5,159 @@ Guideseq latch pkg.
 (c) 2021 by latch.ai.
 """
 
+import json
 import os
 import os.path
-import subprocess
-import time
+import shutil
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Annotated, List, Optional, Tuple
-from urllib.parse import urlparse, urlunparse
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+from urllib.parse import urlparse
 
-import yaml
-from flytekit import LaunchPlan, task, workflow
-from flytekit.core.with_metadata import FlyteMetadata
+from flytekit import (
+    LaunchPlan,
+    Resources,
+    conditional,
+    current_context,
+    dynamic,
+    task,
+    workflow,
+)
 from flytekit.types.directory import FlyteDirectory
 from flytekit.types.file import FlyteFile
 
-from latch.s3_dir_download import download_dir, ensure_dir
+from latch.bwa_index import (
+    INDEX_SUFFIXES,
+    build_index,
+    ensure_index,
+    open_index_cache,
+)
+from latch.checkpoint import STAGE_FOLDERS, STAGE_INPUTS, Checkpoints, run_digest
+from latch.compress import (
+    INTERMEDIATE_FOLDERS,
+    bgzip,
+    compress_outputs,
+    sam_stream,
+    sam_to_bam,
+)
+from latch.consolidate import consolidate_partitioned
+from latch.control_cache import (
+    CONTROL,
+    control_digest,
+    control_files,
+    open_control_cache,
+)
+from latch.demultiplex import (
+    DEFAULT_MIN_READS,
+    demultiplex_reads,
+    demultiplexed_block,
+    sample_barcodes,
+)
+from latch.download_cache import link_or_clone, open_cache
+from latch.manifest import (
+    READ_FIELDS,
+    load_manifest,
+    path_to_key,
+    reference_companion_paths,
+    referenced_paths,
+)
+from latch.offtargets import write_offtargets
+from latch.pipeline import (
+    READ_ENDS,
+    align_cmd,
+    aligned_path,
+    consolidate_cmd,
+    consolidated_paths,
+    demultiplex_cmd,
+    demultiplexed_paths,
+    filter_cmd,
+)
+from latch.pipeline import guideseq_cmd as guideseq_step_cmd
+from latch.pipeline import (
+    identified_path,
+    identify_cmd,
+    run,
+    umitag_cmd,
+    umitagged_paths,
+    visualize_cmd,
+)
+from latch.prefetch import Prefetch
+from latch.preflight import PreflightError, check_manifest, input_paths, plan_run
+from latch.reference import fasta_digest
+from latch.resources import (
+    TIERS,
+    Tier,
+    available_cpus,
+    available_memory,
+    plan_tier,
+    threaded_bwa,
+)
+from latch.run_cache import open_run_cache, output_files, run_fingerprint
+from latch.s3_dir_download import (
+    DEFAULT_CONCURRENCY,
+    download_dir,
+    download_keys,
+    ensure_dir,
+    get_s3_client,
+    head_objects,
+    list_objects,
+)
+from latch.s3_dir_upload import STAGES, StageUploader, upload_files
+from latch.stream_align import stream_align
+from latch.telemetry import Telemetry
+
+OUTPUT_FOLDER = "guideseq_outputs"
+BATCH_INDEX_CACHE = ".bwa_index_cache"
+DEFAULT_MAX_CONCURRENT_RUNS = 4
+# Share of the task's memory the partitioned consolidation's buckets may use.
+CONSOLIDATE_MEMORY_FRACTION = 0.5
+# Manifest fields naming inputs, outputs or per-sample entries rather than
+# settings of the control's processing.
+MANIFEST_INPUT_FIELDS = (
+    "reference_genome",
+    "output_folder",
+    "undemultiplexed",
+    "demultiplexed",
+    "samples",
+    "bwa",
+    "bedtools",
+)
+
+
+class RunOptions(NamedTuple):
+    """The guideseq task's settings, as threaded through the steps it runs."""
+
+    identify_and_filter: bool = False
+    skip_demultiplex: bool = False
+    download_concurrency: int = DEFAULT_CONCURRENCY
+    selective_download: bool = False
+    download_cache: str = ""
+    download_cache_max_gb: int = 100
+    streaming_demultiplex: bool = False
+    demultiplex_mismatches: int = 0
+    index_cache: str = ""
+    threads: int = 0
+    compress_intermediates: bool = False
+    checkpoint_stages: bool = False
+    stream_alignment: bool = False
+    keep_intermediates: bool = False
+    partitioned_consolidate: bool = False
+    array_identify: bool = False
+    pipelined_download: bool = False
+    control_cache: str = ""
+    columnar_output: bool = False
+
+    @property
+    def stepwise(self) -> bool:
+        """Whether an option needs guideseq run one step at a time."""
+        return not self.identify_and_filter and (
+            self.checkpoint_stages
+            or self.stream_alignment
+            or self.partitioned_consolidate
+            or self.array_identify
+            or self.pipelined_download
+            or self.control_cache != ""
+        )
 
 
 def _fmt_dir(bucket_path: str) -> str:
@@ -28,57 +166,609 @@ def _fmt_dir(bucket_path: str) -> str:
     return bucket_path
 
 
-@task
-def guideseq(
-    manifest: FlyteFile,
+def _split_remote(remote_source: str) -> Tuple[str, str]:
+    """Returns the bucket and key prefix of an s3 directory."""
+    split_uri = urlparse(remote_source)
+    return split_uri.netloc, split_uri.path.strip("/")
+
+
+def _s3_remote(remote_source: str) -> Optional[Tuple[str, str]]:
+    """Bucket and key prefix of an s3:// directory, or None for other schemes."""
+    if urlparse(remote_source).scheme != "s3":
+        return None
+    return _split_remote(remote_source)
+
+
+def _s3_output(output_dir: FlyteDirectory) -> Optional[Tuple[str, str]]:
+    """
+    Bucket and key prefix the run's output folder is published to, or None
+    if output_dir is not on s3 and flytekit publishes the outputs itself.
+    """
+    remote = _s3_remote(output_dir.remote_source)
+    if remote is None:
+        return None
+    bucket_name, prefix = remote
+    return bucket_name, "/".join(p for p in (prefix, OUTPUT_FOLDER) if p)
+
+
+def _materialize(directories: List[FlyteDirectory], root: str, paths: List[str]):
+    """
+    Links paths under root out of flytekit downloads of directories, which
+    each hold a copy of root. For intermediates that are not on s3.
+    """
+    for directory in directories:
+        if all(os.path.isfile(p) for p in paths):
+            break
+        local = directory.download()
+        for path in paths:
+            src = os.path.join(local, os.path.relpath(path, root))
+            if not os.path.isfile(path) and os.path.isfile(src):
+                ensure_dir(path)
+                link_or_clone(src, path)
+    missing = [p for p in paths if not os.path.isfile(p)]
+    if missing:
+        raise FileNotFoundError(f"Not found in upstream outputs: {', '.join(missing)}")
+
+
+def _requests(tier: Tier) -> Resources:
+    return Resources(cpu=str(tier.cpu), mem=f"{tier.memory_gb}Gi")
+
+
+def _input_sizes(
+    manifest_path: str, input_dir: FlyteDirectory, paths: List[str]
+) -> Dict[str, int]:
+    """Sizes of manifest paths, read from a listing of input_dir."""
+    bucket_name, name = _split_remote(input_dir.remote_source)
+    local_dir = os.getcwd() + f"/{name.split('/')[-1]}"
+    sizes = {obj["Key"]: obj["Size"] for obj in list_objects(name, bucket_name)}
+    return {p: sizes.get(path_to_key(p, local_dir, name), 0) for p in paths}
+
+
+def _run_fingerprint(
+    manifest_path: str, input_dir: FlyteDirectory, skip_demultiplex: bool, **options
+) -> str:
+    """Fingerprints a run from its manifest and the ETags of the inputs it reads."""
+    data = load_manifest(manifest_path)
+    data["output_folder"] = OUTPUT_FOLDER
+    bucket_name, name = _split_remote(input_dir.remote_source)
+    local_dir = os.getcwd() + f"/{name.split('/')[-1]}"
+    etags = {obj["Key"]: obj["ETag"] for obj in list_objects(name, bucket_name)}
+    inputs = {}
+    for p in referenced_paths(data, skip_demultiplex):
+        key = path_to_key(p, local_dir, name)
+        if key not in etags:
+            raise ValueError(f"Input {p} does not exist at s3://{bucket_name}/{key}")
+        inputs[p] = etags[key]
+    return run_fingerprint(data, inputs, skip_demultiplex=skip_demultiplex, **options)
+
+
+def _download_inputs(
+    manifest_path: str,
+    input_dir: FlyteDirectory,
+    skip_demultiplex: bool,
+    download_concurrency: int,
+    selective_download: bool,
+    download_cache: str,
+    download_cache_max_gb: int,
+    paths: Optional[List[str]] = None,
+    reference_index: bool = True,
+) -> Path:
+    """Mirrors input_dir, or just the manifest paths it needs, into the cwd.
+
+    Passing explicit manifest `paths` implies a selective download. Index
+    files next to the reference are fetched along with it unless
+    `reference_index` is False.
+    """
+    bucket_name, name = _split_remote(input_dir.remote_source)
+
+    # create input dir
+    local_dir = Path(os.getcwd() + f"/{name.split('/')[-1]}")
+    os.makedirs(str(local_dir), exist_ok=True)
+    cache = open_cache(download_cache, get_s3_client(), download_cache_max_gb * 1024**3)
+    if selective_download or paths is not None:
+        data = load_manifest(manifest_path)
+        if paths is None:
+            paths = referenced_paths(data, skip_demultiplex)
+        download_keys(
+            [path_to_key(p, str(local_dir), name) for p in paths],
+            name,
+            str(local_dir),
+            bucket_name,
+            concurrency=download_concurrency,
+            optional_keys=[
+                path_to_key(p, str(local_dir), name)
+                for p in reference_companion_paths(data["reference_genome"])
+                if reference_index and data["reference_genome"] in paths
+            ],
+            cache=cache,
+        )
+    else:
+        download_dir(
+            name,
+            str(local_dir),
+            bucket_name,
+            concurrency=download_concurrency,
+            cache=cache,
+        )
+    if cache is not None:
+        print(cache.summary())
+    return local_dir
+
+
+def _rewrite_manifest(manifest_path: str, **fields) -> dict:
+    import yaml
+
+    with open(manifest_path, "r") as f:
+        data = yaml.safe_load(f)
+    data["output_folder"] = OUTPUT_FOLDER
+    data.update(fields)
+    with open(manifest_path, "w") as f:
+        yaml.safe_dump(data, f)
+    return data
+
+
+def _streaming_demultiplex(manifest_path: str, mismatches: int) -> dict:
+    """Demultiplexes in-process and returns the manifest `demultiplexed` block."""
+    data = load_manifest(manifest_path)
+    reads = data["undemultiplexed"]
+    out_dir = os.path.join(OUTPUT_FOLDER, "demultiplexed")
+    demultiplex_reads(
+        *[reads[field] for field in READ_FIELDS],
+        sample_barcodes(data["samples"]),
+        out_dir,
+        min_reads=data.get("demultiplex_min_reads", DEFAULT_MIN_READS),
+        max_mismatches=mismatches,
+    )
+    return demultiplexed_block(data["samples"], out_dir)
+
+
+def _link_demultiplexed_inputs(fields: Dict, sample: str) -> Dict[str, str]:
+    """
+    umitag names its outputs after the read file, so pre-demultiplexed
+    inputs are linked into the demultiplex layout under the sample name.
+    """
+    reads = {}
+    for end, field in zip(READ_ENDS, READ_FIELDS):
+        src = os.path.abspath(fields[field])
+        ext = ".fastq.gz" if src.endswith(".gz") else ".fastq"
+        reads[end] = os.path.join("demultiplexed_inputs", f"{sample}.{end}{ext}")
+        ensure_dir(reads[end])
+        if not os.path.islink(reads[end]):
+            os.symlink(src, reads[end])
+    return reads
+
+
+def _sample_reads(
+    data: Dict, sample: str, skip_demultiplex: bool, compressed: bool
+) -> Dict[str, str]:
+    """The sample's demultiplexed read paths keyed by r1/r2/i1/i2."""
+    if skip_demultiplex:
+        return _link_demultiplexed_inputs(data["demultiplexed"][sample], sample)
+    return demultiplexed_paths(OUTPUT_FOLDER, sample, compressed)
+
+
+def _control_digest(
+    data: Dict, skip_demultiplex: bool, compressed: bool, **options
+) -> str:
+    """
+    Keys the control's processed outputs on its reads, the reference, its
+    manifest entry, the manifest's tool settings and options.
+    """
+    settings = {k: v for k, v in data.items() if k not in MANIFEST_INPUT_FIELDS}
+    return control_digest(
+        _sample_reads(data, CONTROL, skip_demultiplex, compressed),
+        fasta_digest(data["reference_genome"]),
+        control=data["samples"][CONTROL],
+        settings=settings,
+        compressed=compressed,
+        **options,
+    )
+
+
+def _identify_sample(
+    data: Dict,
+    sample: str,
+    compressed: bool,
+    array_identify: bool = False,
+    threads: int = 1,
+):
+    """
+    Runs identify on the sample's alignment, streaming it out of the BAM.
+    With array_identify the array-based engine replaces guideseq's.
+    """
+    sample_data = data["samples"][sample]
+
+    def identify_aligned(aligned: str):
+        if array_identify:
+            # numpy is only loaded by tasks that use it, not at registration.
+            from latch.identify import identify as identify_sites
+
+            print(f"Identifying candidate sites of {sample} from {aligned}", flush=True)
+            identify_sites(
+                aligned,
+                data["reference_genome"],
+                identified_path(OUTPUT_FOLDER, sample),
+                sample,
+                sample_data.get("target") or "",
+                sample_data.get("description") or "",
+                processes=threads,
+            )
+            return
+        cmd = identify_cmd(
+            data["reference_genome"],
+            OUTPUT_FOLDER,
+            sample,
+            sample_data.get("target"),
+            sample_data.get("description"),
+            aligned,
+        )
+        _run(cmd, sample)
+
+    if compressed:
+        bam = aligned_path(OUTPUT_FOLDER, sample, compressed)
+        with sam_stream(bam, os.path.join("aligned_stream", f"{sample}.sam")) as sam:
+            identify_aligned(sam)
+    else:
+        identify_aligned(aligned_path(OUTPUT_FOLDER, sample))
+
+
+def _run_stage(
+    stage: str,
+    manifest_path: str,
+    data: Dict,
+    options: RunOptions,
+    cached_control: bool = False,
+):
+    """
+    Runs one guideseq step for every sample, as `guideseq.py all` would. With
+    stream_alignment, align goes straight from the demultiplexed reads. With
+    cached_control the control, restored from the control cache, is skipped.
+    options.threads must already be resolved.
+    """
+    threads = options.threads
+    compressed = options.compress_intermediates
+    stream_alignment = options.stream_alignment
+    if stage == "demultiplex":
+        if options.streaming_demultiplex:
+            _streaming_demultiplex(manifest_path, options.demultiplex_mismatches)
+        else:
+            _run(demultiplex_cmd(manifest_path), "demultiplex")
+        if compressed:
+            for fastq in sorted(Path(OUTPUT_FOLDER, "demultiplexed").glob("*.fastq")):
+                bgzip(str(fastq), threads, _log_path("demultiplex"))
+        return
+
+    genome = data["reference_genome"]
+    for sample in data["samples"]:
+        if sample == CONTROL and cached_control:
+            continue
+        if stage == "umitag" or (stage == "align" and stream_alignment):
+            reads = _sample_reads(data, sample, options.skip_demultiplex, compressed)
+
+        if stage == "align" and stream_alignment:
+            stream_align(
+                reads,
+                data["bwa"],
+                genome,
+                OUTPUT_FOLDER,
+                sample,
+                threads,
+                _log_path(sample),
+                compressed,
+                options.keep_intermediates,
+            )
+            if compressed and options.keep_intermediates:
+                for paths in (
+                    umitagged_paths(OUTPUT_FOLDER, sample),
+                    consolidated_paths(OUTPUT_FOLDER, sample),
+                ):
+                    for fastq in paths.values():
+                        bgzip(fastq, threads, _log_path(sample))
+        elif stage == "umitag":
+            _run(umitag_cmd(reads, OUTPUT_FOLDER), sample)
+            if compressed:
+                for fastq in umitagged_paths(OUTPUT_FOLDER, sample).values():
+                    bgzip(fastq, threads, _log_path(sample))
+        elif stage == "consolidate":
+            if options.partitioned_consolidate:
+                consolidate_partitioned(
+                    umitagged_paths(OUTPUT_FOLDER, sample, compressed),
+                    consolidated_paths(OUTPUT_FOLDER, sample),
+                    os.path.join("consolidate_buckets", sample),
+                    int(available_memory() * CONSOLIDATE_MEMORY_FRACTION),
+                    threads,
+                )
+            else:
+                _run(consolidate_cmd(OUTPUT_FOLDER, sample, compressed), sample)
+            if compressed:
+                for fastq in consolidated_paths(OUTPUT_FOLDER, sample).values():
+                    bgzip(fastq, threads, _log_path(sample))
+        elif stage == "align":
+            _run(
+                align_cmd(data["bwa"], genome, OUTPUT_FOLDER, sample, compressed),
+                sample,
+            )
+            if compressed:
+                sam_to_bam(
+                    aligned_path(OUTPUT_FOLDER, sample), threads, _log_path(sample)
+                )
+        elif stage == "identify":
+            _identify_sample(data, sample, compressed, options.array_identify, threads)
+        elif sample == CONTROL:
+            continue
+        elif stage == "filter":
+            _run(
+                filter_cmd(data.get("bedtools", "bedtools"), OUTPUT_FOLDER, sample),
+                "report",
+            )
+        elif stage == "visualize":
+            _run(visualize_cmd(OUTPUT_FOLDER, sample), "report")
+
+
+def _guideseq_stepwise(
+    manifest_path: str,
     input_dir: FlyteDirectory,
     output_dir: FlyteDirectory,
-    identify_and_filter: bool = False,
-    skip_demultiplex: bool = False,
+    options: RunOptions,
+    remember: Callable[[Dict[str, int]], None],
+    telemetry: Telemetry,
 ) -> FlyteDirectory:
+    """
+    Runs guideseq one step at a time. With checkpoint_stages a checkpoint is
+    recorded after each, and the steps an earlier attempt of this task
+    already completed are skipped. With stream_alignment umitag and
+    consolidate run within align. With pipelined_download the first stage
+    starts once its reads are local, while the reference and its index
+    download behind it. With control_cache a control processed by an earlier
+    run is restored instead of processed, and a new one is published. With
+    columnar_output the identified sites of every sample are also written as
+    a Parquet dataset.
+    """
+    skip_demultiplex = options.skip_demultiplex
+    compress_intermediates = options.compress_intermediates
+    stream_alignment = options.stream_alignment
+    pipelined_download = options.pipelined_download
+    stages = [s for s in STAGE_FOLDERS if not (skip_demultiplex and s == "demultiplex")]
+    inputs = dict(STAGE_INPUTS)
+    if stream_alignment:
+        stages = [s for s in stages if s not in ("umitag", "consolidate")]
+        inputs["align"] = "demultiplexed"
 
-    task_params = locals()
+    checkpoints = None
+    done = []
+    output_s3 = _s3_output(output_dir)
+    if options.checkpoint_stages and output_s3 is None:
+        print("Output directory is not on s3, stages are not checkpointed")
+    elif options.checkpoint_stages:
+        checkpoints = Checkpoints(
+            OUTPUT_FOLDER,
+            *output_s3,
+            # Scoped to the execution, which retries share, so a relaunch over
+            # changed input data never picks up stale stages.
+            run_digest(
+                manifest_path,
+                execution=current_context().execution_id.name,
+                skip_demultiplex=skip_demultiplex,
+                streaming_demultiplex=options.streaming_demultiplex,
+                demultiplex_mismatches=options.demultiplex_mismatches,
+                compress_intermediates=compress_intermediates,
+                stream_alignment=stream_alignment,
+                keep_intermediates=options.keep_intermediates,
+            ),
+            concurrency=options.download_concurrency,
+        )
+        done = checkpoints.completed(stages)
+    remaining = stages[len(done) :]
+    if len(done) > 0:
+        print(f"Resuming after checkpointed stages: {', '.join(done)}")
 
-    # parse out bucket_name and key prefix
-    split_uri = urlparse(input_dir.remote_source)
-    name = _fmt_dir(split_uri.path)
-    if name[0] == "/":
-        name = name[1:]
+    data = load_manifest(manifest_path)
+    reference = data["reference_genome"]
+    needs_reads = len(remaining) > 0 and remaining[0] == stages[0]
+    needs_reference = "align" in remaining or "identify" in remaining
 
-    bucket_name = split_uri.netloc
+    def fetch(paths: Optional[List[str]] = None, reference_index: bool = True):
+        _download_inputs(
+            manifest_path,
+            input_dir,
+            skip_demultiplex,
+            options.download_concurrency,
+            options.selective_download,
+            options.download_cache,
+            options.download_cache_max_gb,
+            paths=paths,
+            reference_index=reference_index,
+        )
 
-    # create input dir
-    input_dir = Path(os.getcwd() + f"/{name.split('/')[-1]}")
-    os.makedirs(str(input_dir), exist_ok=True)
-    download_dir(name, str(input_dir), bucket_name)
+    groups = []
+    if pipelined_download:
+        if needs_reads:
+            reads = [
+                p for p in referenced_paths(data, skip_demultiplex) if p != reference
+            ]
+            groups.append(("reads", lambda: fetch(reads)))
+        if needs_reference:
+            groups.append(
+                ("reference", lambda: fetch([reference], "align" in remaining))
+            )
+
+    with Prefetch(groups) as prefetch:
+        telemetry.start("download")
+        if pipelined_download:
+            if needs_reads:
+                prefetch.wait("reads")
+        elif needs_reads:
+            fetch()
+        elif needs_reference:
+            fetch([reference], "align" in remaining)
+        if len(remaining) > 0 and remaining[0] in inputs:
+            folder = inputs[remaining[0]]
+            writer = next((s for s in done if STAGE_FOLDERS[s] == folder), None)
+            # Inputs that were already demultiplexed came with the download.
+            if writer is not None:
+                checkpoints.restore(writer)
+        telemetry.start(None)
+
+        options = options._replace(threads=options.threads or available_cpus())
+        bwa = data.get("bwa", "bwa")
+        data = _rewrite_manifest(
+            manifest_path, bwa=threaded_bwa(bwa, options.threads, "bwa_threaded.sh")
+        )
+
+        controls = open_control_cache(options.control_cache, get_s3_client())
+        control_key = None
+        cached_control = False
+        output_folder = os.path.abspath(OUTPUT_FOLDER)
+
+        published = []
+        for stage in remaining:
+            # The control is looked up once its demultiplexed reads are local.
+            lookup_control = (
+                controls is not None
+                and control_key is None
+                and inputs.get(stage) == "demultiplexed"
+                and CONTROL in data["samples"]
+            )
+            # The barrier: only stages reading the reference wait for it.
+            needs_wait = pipelined_download and (
+                stage in ("align", "identify") or lookup_control
+            )
+            if needs_wait and not prefetch.ready("reference"):
+                with telemetry.phase("download"):
+                    prefetch.wait("reference")
+            if lookup_control:
+                with telemetry.phase("control_cache"):
+                    control_key = _control_digest(
+                        data,
+                        skip_demultiplex,
+                        compress_intermediates,
+                        stream_alignment=stream_alignment,
+                        keep_intermediates=options.keep_intermediates,
+                        array_identify=options.array_identify,
+                    )
+                    cached_control = controls.fetch(control_key, output_folder)
+                if cached_control:
+                    print(f"Using cached control {control_key}")
+            if stage == "align" and options.index_cache:
+                with telemetry.phase("bwa_index"):
+                    ensure_index(
+                        reference,
+                        bwa,
+                        open_index_cache(options.index_cache, get_s3_client()),
+                        _log_path("bwa_index"),
+                    )
+            elif stage == "align" and stream_alignment:
+                # Streaming replaces guideseq's align step, which would build it.
+                with telemetry.phase("bwa_index"):
+                    build_index(reference, bwa, _log_path("bwa_index"))
+            with telemetry.phase(STAGE_FOLDERS[stage]):
+                _run_stage(stage, manifest_path, data, options, cached_control)
+            if stage == "identify" and control_key is not None and not cached_control:
+                with telemetry.phase("control_cache"):
+                    controls.publish(
+                        control_key,
+                        output_folder,
+                        control_files(output_folder, compress_intermediates),
+                    )
+            if checkpoints is not None:
+                with telemetry.phase("upload"):
+                    published.extend(checkpoints.record(stage))
+    if options.columnar_output:
+        with telemetry.phase("offtargets"):
+            write_offtargets(OUTPUT_FOLDER, data["samples"])
+    telemetry.count_reads(OUTPUT_FOLDER)
+
+    # Stages skipped on a resume are only published, not on local disk.
+    if checkpoints is not None:
+        remember({**checkpoints.sizes(done), **output_files(OUTPUT_FOLDER)})
+    else:
+        remember(output_files(OUTPUT_FOLDER))
+    # Every stage folder is already published, leaving the logs to upload.
+    for path in published:
+        os.remove(path)
+    os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+    return FlyteDirectory(
+        os.path.join(os.getcwd(), OUTPUT_FOLDER),
+        remote_directory=_fmt_dir(output_dir.remote_source) + f"/{OUTPUT_FOLDER}",
+    )
 
-    with open(str(Path(manifest).resolve()), "r") as f:
-        data = yaml.load(f)
-    data["output_folder"] = "guideseq_outputs"
+
+def _guideseq_all(
+    manifest_path: str,
+    input_dir: FlyteDirectory,
+    output_dir: FlyteDirectory,
+    options: RunOptions,
+    remember: Callable[[Dict[str, int]], None],
+    telemetry: Telemetry,
+) -> FlyteDirectory:
+    """Runs the whole pipeline with a single `guideseq.py all`."""
+    identify_and_filter = options.identify_and_filter
+    skip_demultiplex = options.skip_demultiplex
+    output_s3 = _s3_output(output_dir)
+    with telemetry.phase("download"):
+        _download_inputs(
+            manifest_path,
+            input_dir,
+            skip_demultiplex,
+            options.download_concurrency,
+            options.selective_download,
+            options.download_cache,
+            options.download_cache_max_gb,
+        )
+
+    threads = options.threads or available_cpus()
+    bwa = load_manifest(manifest_path).get("bwa", "bwa")
+    fields = {"bwa": threaded_bwa(bwa, threads, "bwa_threaded.sh")}
+    if options.streaming_demultiplex and not (skip_demultiplex or identify_and_filter):
+        with telemetry.phase("demultiplexed"):
+            fields["demultiplexed"] = _streaming_demultiplex(
+                manifest_path, options.demultiplex_mismatches
+            )
+        skip_demultiplex = True
+    data = _rewrite_manifest(manifest_path, **fields)
     output_loc = data["output_folder"]
-    with open(str(Path(manifest).resolve()), "w") as f:
-        yaml.dump(data, f)
 
-    guideseq_cmd = [
-        "python2.7",
-        "guideseq/guideseq/guideseq.py",
-        "all",
-    ]
+    if options.index_cache and not identify_and_filter:
+        with telemetry.phase("bwa_index"):
+            ensure_index(
+                data["reference_genome"],
+                bwa,
+                open_index_cache(options.index_cache, get_s3_client()),
+                os.path.join(OUTPUT_FOLDER, "logs", "bwa_index.log"),
+            )
 
-    guideseq_cmd.extend(["-m", str(Path(manifest).resolve())])
+    guideseq_cmd = guideseq_step_cmd("all")
+    guideseq_cmd.extend(["-m", manifest_path])
     if identify_and_filter:
         guideseq_cmd.extend(["--identifyAndFilter"])
     if skip_demultiplex:
         guideseq_cmd.extend(["--skip_demultiplex"])
 
-    print("Guideseq Command: " + " ".join(guideseq_cmd))
-
-    results = subprocess.run(guideseq_cmd, capture_output=True, text=True)
-
-    if results is not None:
-        print(f" stdout: {results.stdout}" + f" stderr: {results.stderr}")
+    # Intermediates are replaced by their compressed copies after the run,
+    # so only then are they ready to publish.
+    compress_intermediates = options.compress_intermediates
+    skip = INTERMEDIATE_FOLDERS + ("aligned",) if compress_intermediates else ()
+    if output_s3 is not None:
+        uploader = StageUploader(
+            output_loc, *output_s3, concurrency=options.download_concurrency, skip=skip
+        )
     else:
-        print("No process output generated")
+        print("Output directory is not on s3, publishing outputs when the run ends")
+        uploader = nullcontext()
+    with uploader:
+        with telemetry.stages(OUTPUT_FOLDER, STAGES):
+            _run(guideseq_cmd, "guideseq")
+        if compress_intermediates:
+            with telemetry.phase("compress"):
+                compress_outputs(OUTPUT_FOLDER, threads, _log_path("compress"))
+        if options.columnar_output:
+            with telemetry.phase("offtargets"):
+                write_offtargets(OUTPUT_FOLDER, data["samples"])
+        telemetry.count_reads(OUTPUT_FOLDER)
+        # Files published early are removed when the uploader exits.
+        remember(output_files(OUTPUT_FOLDER))
+        telemetry.start("upload")
+    telemetry.start(None)
 
     return FlyteDirectory(
         os.getcwd() + f"/{output_loc}",
@@ -86,6 +776,766 @@ def guideseq(
     )
 
 
+def _log_path(log_name: str) -> str:
+    return os.path.join(OUTPUT_FOLDER, "logs", f"{log_name}.log")
+
+
+def _run(cmd: List[str], log_name: str):
+    run(cmd, _log_path(log_name))
+
+
+@task(requests=_requests(TIERS[0]), retries=2)
+def guideseq(
+    manifest: FlyteFile,
+    input_dir: FlyteDirectory,
+    output_dir: FlyteDirectory,
+    identify_and_filter: bool = False,
+    skip_demultiplex: bool = False,
+    download_concurrency: int = DEFAULT_CONCURRENCY,
+    selective_download: bool = False,
+    download_cache: str = "",
+    download_cache_max_gb: int = 100,
+    streaming_demultiplex: bool = False,
+    demultiplex_mismatches: int = 0,
+    index_cache: str = "",
+    threads: int = 0,
+    compress_intermediates: bool = False,
+    checkpoint_stages: bool = False,
+    run_cache: str = "",
+    stream_alignment: bool = False,
+    keep_intermediates: bool = False,
+    partitioned_consolidate: bool = False,
+    array_identify: bool = False,
+    pipelined_download: bool = False,
+    control_cache: str = "",
+    columnar_output: bool = False,
+) -> FlyteDirectory:
+
+    manifest_path = str(Path(manifest).resolve())
+    output_s3 = _s3_output(output_dir)
+    runs = open_run_cache(run_cache, get_s3_client())
+    if runs is not None and output_s3 is None:
+        print("Output directory is not on s3, the run is not memoized")
+        runs = None
+    if runs is not None:
+        fingerprint = _run_fingerprint(
+            manifest_path,
+            input_dir,
+            skip_demultiplex,
+            identify_and_filter=identify_and_filter,
+            streaming_demultiplex=streaming_demultiplex,
+            demultiplex_mismatches=demultiplex_mismatches,
+            compress_intermediates=compress_intermediates,
+            stream_alignment=stream_alignment,
+            keep_intermediates=keep_intermediates,
+            array_identify=array_identify,
+            columnar_output=columnar_output,
+            control_cache=control_cache,
+        )
+        record = runs.lookup(fingerprint)
+        if record is not None:
+            print(
+                f"Inputs match an earlier run, copying its outputs from "
+                f"s3://{record['bucket']}/{record['prefix']}"
+            )
+            runs.copy(record, *output_s3)
+            os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+            return FlyteDirectory(
+                os.path.join(os.getcwd(), OUTPUT_FOLDER),
+                remote_directory=_fmt_dir(output_dir.remote_source)
+                + f"/{OUTPUT_FOLDER}",
+            )
+
+    outputs_published = {}
+
+    def remember(files: Dict[str, int]):
+        """Notes the outputs to record once they are all published."""
+        outputs_published.update(files)
+
+    options = RunOptions(
+        identify_and_filter=identify_and_filter,
+        skip_demultiplex=skip_demultiplex,
+        download_concurrency=download_concurrency,
+        selective_download=selective_download,
+        download_cache=download_cache,
+        download_cache_max_gb=download_cache_max_gb,
+        streaming_demultiplex=streaming_demultiplex,
+        demultiplex_mismatches=demultiplex_mismatches,
+        index_cache=index_cache,
+        threads=threads,
+        compress_intermediates=compress_intermediates,
+        checkpoint_stages=checkpoint_stages,
+        stream_alignment=stream_alignment,
+        keep_intermediates=keep_intermediates,
+        partitioned_consolidate=partitioned_consolidate,
+        array_identify=array_identify,
+        pipelined_download=pipelined_download,
+        control_cache=control_cache,
+        columnar_output=columnar_output,
+    )
+    with Telemetry() as telemetry:
+        run_steps = _guideseq_stepwise if options.stepwise else _guideseq_all
+        outputs = run_steps(
+            manifest_path, input_dir, output_dir, options, remember, telemetry
+        )
+    if runs is not None:
+        # Published here rather than by flytekit, so the record holds their ETags.
+        local = [
+            path
+            for path in (os.path.join(OUTPUT_FOLDER, rel) for rel in outputs_published)
+            if os.path.isfile(path)
+        ]
+        upload_files(local, OUTPUT_FOLDER, *output_s3, concurrency=download_concurrency)
+        for path in local:
+            os.remove(path)
+        runs.store(fingerprint, list(outputs_published), *output_s3)
+    telemetry.write(os.path.join(OUTPUT_FOLDER, "metrics.json"))
+    print(telemetry.summary())
+    return outputs
+
+
+ValidatedRun = NamedTuple("ValidatedRun", manifest=FlyteFile, plan=FlyteFile)
+
+
+@task(requests=Resources(cpu="1", mem="2Gi"))
+def validate_run(
+    manifest: FlyteFile,
+    input_dir: FlyteDirectory,
+    identify_and_filter: bool = False,
+    skip_demultiplex: bool = False,
+    streaming_demultiplex: bool = False,
+    demultiplex_mismatches: int = 0,
+    download_concurrency: int = DEFAULT_CONCURRENCY,
+    cpu: int = 0,
+    memory_gb: int = 0,
+) -> ValidatedRun:
+    """
+    Checks the manifest and stats every input it references before anything
+    is downloaded, failing with every problem found. Returns the manifest and
+    a JSON plan of input bytes, estimated reads per sample and resources.
+    With identify_and_filter the inputs are the samples' aligned SAMs rather
+    than their reads.
+    """
+    import yaml
+
+    manifest_path = str(Path(manifest).resolve())
+    try:
+        data = load_manifest(manifest_path)
+    except yaml.YAMLError as e:
+        raise PreflightError([f"Manifest is not valid YAML: {e}"])
+    mismatches = demultiplex_mismatches if streaming_demultiplex else 0
+    errors, warnings = check_manifest(
+        data, skip_demultiplex, mismatches, identify_and_filter
+    )
+    for warning in warnings:
+        print(f"Warning: {warning}")
+
+    bucket_name, name = _split_remote(input_dir.remote_source)
+    local_dir = os.getcwd() + f"/{name.split('/')[-1]}"
+    keys = {}
+    if not errors:
+        for path in input_paths(data, skip_demultiplex, identify_and_filter):
+            try:
+                keys[path] = path_to_key(path, local_dir, name)
+            except ValueError as e:
+                errors.append(str(e))
+    if errors:
+        raise PreflightError(errors)
+
+    plan = plan_run(
+        data,
+        keys,
+        bucket_name,
+        {
+            p: path_to_key(p, local_dir, name)
+            for p in reference_companion_paths(data["reference_genome"])
+        },
+        skip_demultiplex=skip_demultiplex,
+        max_mismatches=mismatches,
+        identify_and_filter=identify_and_filter,
+        cpu=cpu,
+        memory_gb=memory_gb,
+        concurrency=download_concurrency,
+    )
+    plan["warnings"] = warnings
+    print(json.dumps(plan, indent=2))
+    plan_path = os.path.join(os.getcwd(), "plan.json")
+    with open(plan_path, "w") as f:
+        json.dump(plan, f, indent=2)
+    return ValidatedRun(manifest=FlyteFile(manifest_path), plan=FlyteFile(plan_path))
+
+
+@dynamic
+def guideseq_sized(
+    manifest: FlyteFile,
+    input_dir: FlyteDirectory,
+    output_dir: FlyteDirectory,
+    identify_and_filter: bool = False,
+    skip_demultiplex: bool = False,
+    download_concurrency: int = DEFAULT_CONCURRENCY,
+    selective_download: bool = False,
+    download_cache: str = "",
+    download_cache_max_gb: int = 100,
+    streaming_demultiplex: bool = False,
+    demultiplex_mismatches: int = 0,
+    index_cache: str = "",
+    cpu: int = 0,
+    memory_gb: int = 0,
+    compress_intermediates: bool = False,
+    checkpoint_stages: bool = False,
+    run_cache: str = "",
+    stream_alignment: bool = False,
+    keep_intermediates: bool = False,
+    partitioned_consolidate: bool = False,
+    array_identify: bool = False,
+    pipelined_download: bool = False,
+    control_cache: str = "",
+    columnar_output: bool = False,
+) -> FlyteDirectory:
+    """Runs the guideseq task on a tier sized from a listing of its inputs."""
+
+    manifest_path = str(Path(manifest).resolve())
+    data = load_manifest(manifest_path)
+    paths = referenced_paths(data, skip_demultiplex)
+    sizes = _input_sizes(manifest_path, input_dir, paths)
+    reference_bytes = sizes.pop(data["reference_genome"], 0)
+    fastq_bytes = sum(sizes.values())
+    tier = plan_tier(fastq_bytes, reference_bytes, cpu, memory_gb)
+    print(
+        f"{fastq_bytes} bytes of FASTQ, "
+        f"{tier.name} tier with {tier.cpu} CPUs and {tier.memory_gb}Gi"
+    )
+
+    return guideseq(
+        manifest=manifest,
+        input_dir=input_dir,
+        output_dir=output_dir,
+        identify_and_filter=identify_and_filter,
+        skip_demultiplex=skip_demultiplex,
+        download_concurrency=download_concurrency,
+        selective_download=selective_download,
+        download_cache=download_cache,
+        download_cache_max_gb=download_cache_max_gb,
+        streaming_demultiplex=streaming_demultiplex,
+        demultiplex_mismatches=demultiplex_mismatches,
+        index_cache=index_cache,
+        threads=tier.cpu,
+        compress_intermediates=compress_intermediates,
+        checkpoint_stages=checkpoint_stages,
+        run_cache=run_cache,
+        stream_alignment=stream_alignment,
+        keep_intermediates=keep_intermediates,
+        partitioned_consolidate=partitioned_consolidate,
+        array_identify=array_identify,
+        pipelined_download=pipelined_download,
+        control_cache=control_cache,
+        columnar_output=columnar_output,
+    ).with_overrides(requests=_requests(tier))
+
+
+@task(requests=Resources(cpu="2", mem="16Gi"))
+def bwa_index(
+    manifest: FlyteFile,
+    input_dir: FlyteDirectory,
+    index_cache: str = "",
+    download_concurrency: int = DEFAULT_CONCURRENCY,
+    download_cache: str = "",
+    download_cache_max_gb: int = 100,
+) -> FlyteDirectory:
+    """Builds, or fetches from index_cache, the BWA index of the reference."""
+
+    manifest_path = str(Path(manifest).resolve())
+    data = load_manifest(manifest_path)
+    reference = data["reference_genome"]
+    _download_inputs(
+        manifest_path,
+        input_dir,
+        False,
+        download_concurrency,
+        True,
+        download_cache,
+        download_cache_max_gb,
+        paths=[reference],
+    )
+    ensure_index(
+        reference,
+        data.get("bwa", "bwa"),
+        open_index_cache(index_cache, get_s3_client()),
+    )
+
+    bundle = os.path.join(os.getcwd(), "bwa_index")
+    os.makedirs(bundle, exist_ok=True)
+    for suffix in INDEX_SUFFIXES:
+        link_or_clone(reference + suffix, os.path.join(bundle, "index" + suffix))
+    return FlyteDirectory(bundle)
+
+
+@task(requests=Resources(cpu="4", mem="8Gi"))
+def demultiplex(
+    manifest: FlyteFile,
+    input_dir: FlyteDirectory,
+    output_dir: FlyteDirectory,
+    skip_demultiplex: bool = False,
+    download_concurrency: int = DEFAULT_CONCURRENCY,
+    download_cache: str = "",
+    download_cache_max_gb: int = 100,
+    streaming_demultiplex: bool = False,
+    demultiplex_mismatches: int = 0,
+    compress_intermediates: bool = False,
+) -> FlyteDirectory:
+    """Splits the pooled run into per-sample FASTQs under demultiplexed/."""
+
+    manifest_path = str(Path(manifest).resolve())
+    os.makedirs(os.path.join(OUTPUT_FOLDER, "demultiplexed"), exist_ok=True)
+    if not skip_demultiplex:
+        data = load_manifest(manifest_path)
+        _download_inputs(
+            manifest_path,
+            input_dir,
+            skip_demultiplex,
+            download_concurrency,
+            True,
+            download_cache,
+            download_cache_max_gb,
+            paths=[data["undemultiplexed"][field] for field in READ_FIELDS],
+        )
+        if streaming_demultiplex:
+            _streaming_demultiplex(manifest_path, demultiplex_mismatches)
+        else:
+            _rewrite_manifest(manifest_path)
+            _run(demultiplex_cmd(manifest_path), "demultiplex")
+        if compress_intermediates:
+            for fastq in sorted(Path(OUTPUT_FOLDER, "demultiplexed").glob("*.fastq")):
+                bgzip(str(fastq), available_cpus(), _log_path("demultiplex"))
+
+    return FlyteDirectory(
+        os.path.join(os.getcwd(), OUTPUT_FOLDER, "demultiplexed"),
+        remote_directory=_fmt_dir(output_dir.remote_source)
+        + f"/{OUTPUT_FOLDER}/demultiplexed",
+    )
+
+
+@task(requests=_requests(TIERS[0]))
+def guideseq_sample(
+    manifest: FlyteFile,
+    input_dir: FlyteDirectory,
+    output_dir: FlyteDirectory,
+    demultiplexed: FlyteDirectory,
+    index: FlyteDirectory,
+    sample: str,
+    skip_demultiplex: bool = False,
+    download_concurrency: int = DEFAULT_CONCURRENCY,
+    download_cache: str = "",
+    download_cache_max_gb: int = 100,
+    threads: int = 0,
+    compress_intermediates: bool = False,
+) -> FlyteDirectory:
+    """Runs umitag, consolidate, align and identify for a single sample."""
+
+    manifest_path = str(Path(manifest).resolve())
+    data = load_manifest(manifest_path)
+
+    paths = [data["reference_genome"]]
+    if skip_demultiplex:
+        fields = data["demultiplexed"][sample]
+        paths.extend(fields[field] for field in READ_FIELDS)
+    _download_inputs(
+        manifest_path,
+        input_dir,
+        skip_demultiplex,
+        download_concurrency,
+        True,
+        download_cache,
+        download_cache_max_gb,
+        paths=paths,
+        reference_index=False,
+    )
+    bundle = index.download()
+    for suffix in INDEX_SUFFIXES:
+        link_or_clone(
+            os.path.join(bundle, "index" + suffix), data["reference_genome"] + suffix
+        )
+
+    if skip_demultiplex:
+        reads = _link_demultiplexed_inputs(fields, sample)
+    else:
+        reads = demultiplexed_paths(OUTPUT_FOLDER, sample, compress_intermediates)
+        remote = _s3_remote(demultiplexed.remote_source)
+        if remote is not None:
+            bucket_name, prefix = remote
+            download_keys(
+                [prefix + "/" + os.path.basename(p) for p in reads.values()],
+                prefix,
+                os.path.join(os.getcwd(), OUTPUT_FOLDER, "demultiplexed"),
+                bucket_name,
+                concurrency=download_concurrency,
+            )
+        else:
+            _materialize(
+                [demultiplexed],
+                os.path.join(OUTPUT_FOLDER, "demultiplexed"),
+                list(reads.values()),
+            )
+
+    genome = data["reference_genome"]
+    threads = threads or available_cpus()
+    bwa = threaded_bwa(data.get("bwa", "bwa"), threads, "bwa_threaded.sh")
+    compressed = compress_intermediates
+    _run(umitag_cmd(reads, OUTPUT_FOLDER), sample)
+    if compressed:
+        for fastq in umitagged_paths(OUTPUT_FOLDER, sample).values():
+            bgzip(fastq, threads, _log_path(sample))
+    _run(consolidate_cmd(OUTPUT_FOLDER, sample, compressed), sample)
+    if compressed:
+        for fastq in consolidated_paths(OUTPUT_FOLDER, sample).values():
+            bgzip(fastq, threads, _log_path(sample))
+    _run(align_cmd(bwa, genome, OUTPUT_FOLDER, sample, compressed), sample)
+
+    if compressed:
+        sam_to_bam(aligned_path(OUTPUT_FOLDER, sample), threads, _log_path(sample))
+    _identify_sample(data, sample, compressed)
+
+    # demultiplexed/ was already published by the demultiplex task.
+    shutil.rmtree(os.path.join(OUTPUT_FOLDER, "demultiplexed"), ignore_errors=True)
+    return FlyteDirectory(
+        os.path.join(os.getcwd(), OUTPUT_FOLDER),
+        remote_directory=_fmt_dir(output_dir.remote_source) + f"/{OUTPUT_FOLDER}",
+    )
+
+
+@dynamic
+def guideseq_samples(
+    manifest: FlyteFile,
+    input_dir: FlyteDirectory,
+    output_dir: FlyteDirectory,
+    demultiplexed: FlyteDirectory,
+    index: FlyteDirectory,
+    skip_demultiplex: bool = False,
+    download_concurrency: int = DEFAULT_CONCURRENCY,
+    download_cache: str = "",
+    download_cache_max_gb: int = 100,
+    cpu: int = 0,
+    memory_gb: int = 0,
+    compress_intermediates: bool = False,
+) -> List[FlyteDirectory]:
+    """Fans out one guideseq_sample task per entry of the manifest's samples,
+    each sized from the bytes of FASTQ it will read."""
+
+    manifest_path = str(Path(manifest).resolve())
+    data = load_manifest(manifest_path)
+    reference = data["reference_genome"]
+    if skip_demultiplex:
+        paths = [reference] + [
+            data["demultiplexed"][sample][field]
+            for sample in data["samples"]
+            for field in READ_FIELDS
+        ]
+        input_sizes = _input_sizes(manifest_path, input_dir, paths)
+    else:
+        pooled = [data["undemultiplexed"][field] for field in READ_FIELDS]
+        input_sizes = _input_sizes(manifest_path, input_dir, [reference] + pooled)
+        remote = _s3_remote(demultiplexed.remote_source)
+        if remote is not None:
+            bucket_name, prefix = remote
+            demultiplexed_sizes = {
+                obj["Key"]: obj["Size"] for obj in list_objects(prefix, bucket_name)
+            }
+        else:
+            print(
+                "Demultiplexed reads are not on s3, sizing every sample for "
+                "the whole pooled run"
+            )
+
+    nodes = []
+    for sample in data["samples"]:
+        if skip_demultiplex:
+            fastq_bytes = sum(
+                input_sizes[data["demultiplexed"][sample][field]]
+                for field in READ_FIELDS
+            )
+        elif remote is not None:
+            fastq_bytes = sum(
+                demultiplexed_sizes.get(prefix + "/" + os.path.basename(p), 0)
+                for p in demultiplexed_paths(
+                    OUTPUT_FOLDER, sample, compress_intermediates
+                ).values()
+            )
+        else:
+            fastq_bytes = sum(input_sizes[p] for p in pooled)
+        tier = plan_tier(fastq_bytes, input_sizes[reference], cpu, memory_gb)
+        print(
+            f"{sample}: {fastq_bytes} bytes of FASTQ, "
+            f"{tier.name} tier with {tier.cpu} CPUs and {tier.memory_gb}Gi"
+        )
+        node = guideseq_sample(
+            manifest=manifest,
+            input_dir=input_dir,
+            output_dir=output_dir,
+            demultiplexed=demultiplexed,
+            index=index,
+            sample=sample,
+            skip_demultiplex=skip_demultiplex,
+            download_concurrency=download_concurrency,
+            download_cache=download_cache,
+            download_cache_max_gb=download_cache_max_gb,
+            threads=tier.cpu,
+            compress_intermediates=compress_intermediates,
+        )
+        nodes.append(node.with_overrides(requests=_requests(tier)))
+    return nodes
+
+
+@task(requests=_requests(TIERS[0]))
+def guideseq_report(
+    manifest: FlyteFile,
+    output_dir: FlyteDirectory,
+    samples: List[FlyteDirectory],
+    download_concurrency: int = DEFAULT_CONCURRENCY,
+) -> FlyteDirectory:
+    """Filters each treatment sample against the control and visualizes it."""
+
+    data = load_manifest(str(Path(manifest).resolve()))
+    if CONTROL not in data["samples"]:
+        raise ValueError("Manifest must contain a 'control' sample")
+
+    output_remote = _fmt_dir(output_dir.remote_source) + f"/{OUTPUT_FOLDER}"
+    identified = [identified_path(OUTPUT_FOLDER, sample) for sample in data["samples"]]
+    output_s3 = _s3_output(output_dir)
+    if output_s3 is not None:
+        bucket_name, prefix = output_s3
+        download_keys(
+            [prefix + p[len(OUTPUT_FOLDER) :] for p in identified],
+            prefix,
+            os.path.join(os.getcwd(), OUTPUT_FOLDER),
+            bucket_name,
+            concurrency=download_concurrency,
+        )
+    else:
+        _materialize(samples, OUTPUT_FOLDER, identified)
+
+    for sample in data["samples"]:
+        if sample == CONTROL:
+            continue
+        _run(
+            filter_cmd(data.get("bedtools", "bedtools"), OUTPUT_FOLDER, sample),
+            "report",
+        )
+        _run(visualize_cmd(OUTPUT_FOLDER, sample), "report")
+
+    return FlyteDirectory(
+        os.path.join(os.getcwd(), OUTPUT_FOLDER), remote_directory=output_remote
+    )
+
+
+@workflow
+def guideseq_fan_out_wf(
+    manifest: FlyteFile,
+    input_dir: FlyteDirectory,
+    output_dir: FlyteDirectory,
+    skip_demultiplex: bool = False,
+    download_concurrency: int = DEFAULT_CONCURRENCY,
+    download_cache: str = "",
+    download_cache_max_gb: int = 100,
+    streaming_demultiplex: bool = False,
+    demultiplex_mismatches: int = 0,
+    index_cache: str = "",
+    cpu: int = 0,
+    memory_gb: int = 0,
+    compress_intermediates: bool = False,
+) -> FlyteDirectory:
+    """Runs guideseq with one pod per sample between demultiplex and filter."""
+
+    index = bwa_index(
+        manifest=manifest,
+        input_dir=input_dir,
+        index_cache=index_cache,
+        download_concurrency=download_concurrency,
+        download_cache=download_cache,
+        download_cache_max_gb=download_cache_max_gb,
+    )
+    demultiplexed = demultiplex(
+        manifest=manifest,
+        input_dir=input_dir,
+        output_dir=output_dir,
+        skip_demultiplex=skip_demultiplex,
+        download_concurrency=download_concurrency,
+        download_cache=download_cache,
+        download_cache_max_gb=download_cache_max_gb,
+        streaming_demultiplex=streaming_demultiplex,
+        demultiplex_mismatches=demultiplex_mismatches,
+        compress_intermediates=compress_intermediates,
+    )
+    samples = guideseq_samples(
+        manifest=manifest,
+        input_dir=input_dir,
+        output_dir=output_dir,
+        demultiplexed=demultiplexed,
+        index=index,
+        skip_demultiplex=skip_demultiplex,
+        download_concurrency=download_concurrency,
+        download_cache=download_cache,
+        download_cache_max_gb=download_cache_max_gb,
+        cpu=cpu,
+        memory_gb=memory_gb,
+        compress_intermediates=compress_intermediates,
+    )
+    return guideseq_report(
+        manifest=manifest,
+        output_dir=output_dir,
+        samples=samples,
+        download_concurrency=download_concurrency,
+    )
+
+
+@dynamic
+def guideseq_batch(
+    manifests: List[FlyteFile],
+    input_dirs: List[FlyteDirectory],
+    output_dirs: List[FlyteDirectory],
+    max_concurrent_runs: int = DEFAULT_MAX_CONCURRENT_RUNS,
+    skip_demultiplex: bool = False,
+    download_concurrency: int = DEFAULT_CONCURRENCY,
+    selective_download: bool = False,
+    download_cache: str = "",
+    download_cache_max_gb: int = 100,
+    streaming_demultiplex: bool = False,
+    demultiplex_mismatches: int = 0,
+    index_cache: str = "",
+    cpu: int = 0,
+    memory_gb: int = 0,
+    compress_intermediates: bool = False,
+    run_cache: str = "",
+) -> List[FlyteDirectory]:
+    """
+    Runs guideseq for every manifest, input_dir and output_dir triple. The
+    BWA index of each distinct reference object is built or fetched once,
+    into index_cache, before the runs that align against it start. Without
+    an index_cache, one is kept next to the first output directory if that
+    is on s3, and otherwise every run indexes its own reference. At most
+    max_concurrent_runs runs are in flight at once.
+    """
+
+    if not len(manifests) == len(input_dirs) == len(output_dirs):
+        raise ValueError(
+            "Batch needs one input and one output directory per manifest, got "
+            f"{len(manifests)} manifests, {len(input_dirs)} input directories "
+            f"and {len(output_dirs)} output directories"
+        )
+    if max_concurrent_runs < 1:
+        raise ValueError("max_concurrent_runs must be at least 1")
+    if not index_cache and len(manifests) > 0:
+        if urlparse(output_dirs[0].remote_source).scheme == "s3":
+            index_cache = (
+                _fmt_dir(output_dirs[0].remote_source) + f"/{BATCH_INDEX_CACHE}"
+            )
+        else:
+            print("Output directory is not on s3, every run indexes its reference")
+
+    if index_cache:
+        # Runs share an index when their reference is the same object version.
+        references = {}
+        run_references = []
+        for manifest, input_dir in zip(manifests, input_dirs):
+            data = load_manifest(str(Path(manifest).resolve()))
+            bucket_name, name = _split_remote(input_dir.remote_source)
+            local_dir = os.getcwd() + f"/{name.split('/')[-1]}"
+            key = path_to_key(data["reference_genome"], local_dir, name)
+            obj = head_objects([key], bucket_name, concurrency=1)[0]
+            if obj is None:
+                raise FileNotFoundError(
+                    f"Reference s3://{bucket_name}/{key} of {manifest.remote_source} "
+                    "does not exist"
+                )
+            reference = (bucket_name, key, obj["ETag"])
+            references.setdefault(reference, (manifest, input_dir))
+            run_references.append(reference)
+
+        index_nodes = {}
+        for reference, (manifest, input_dir) in references.items():
+            print(f"Indexing s3://{reference[0]}/{reference[1]} once for the batch")
+            index_nodes[reference] = bwa_index(
+                manifest=manifest,
+                input_dir=input_dir,
+                index_cache=index_cache,
+                download_concurrency=download_concurrency,
+                download_cache=download_cache,
+                download_cache_max_gb=download_cache_max_gb,
+            )
+
+    lanes = [None] * max_concurrent_runs
+    outputs = []
+    for i, (manifest, input_dir, output_dir) in enumerate(
+        zip(manifests, input_dirs, output_dirs)
+    ):
+        node = guideseq_sized(
+            manifest=manifest,
+            input_dir=input_dir,
+            output_dir=output_dir,
+            skip_demultiplex=skip_demultiplex,
+            download_concurrency=download_concurrency,
+            selective_download=selective_download,
+            download_cache=download_cache,
+            download_cache_max_gb=download_cache_max_gb,
+            streaming_demultiplex=streaming_demultiplex,
+            demultiplex_mismatches=demultiplex_mismatches,
+            index_cache=index_cache,
+            cpu=cpu,
+            memory_gb=memory_gb,
+            compress_intermediates=compress_intermediates,
+            run_cache=run_cache,
+        )
+        if index_cache:
+            index_nodes[run_references[i]] >> node
+        # Each lane runs its share of the batch one run after another.
+        lane = i % max_concurrent_runs
+        if lanes[lane] is not None:
+            lanes[lane] >> node
+        lanes[lane] = node
+        outputs.append(node)
+    return outputs
+
+
+@workflow
+def guideseq_batch_wf(
+    manifests: List[FlyteFile],
+    input_dirs: List[FlyteDirectory],
+    output_dirs: List[FlyteDirectory],
+    max_concurrent_runs: int = DEFAULT_MAX_CONCURRENT_RUNS,
+    skip_demultiplex: bool = False,
+    download_concurrency: int = DEFAULT_CONCURRENCY,
+    selective_download: bool = False,
+    download_cache: str = "",
+    download_cache_max_gb: int = 100,
+    streaming_demultiplex: bool = False,
+    demultiplex_mismatches: int = 0,
+    index_cache: str = "",
+    cpu: int = 0,
+    memory_gb: int = 0,
+    compress_intermediates: bool = False,
+    run_cache: str = "",
+) -> List[FlyteDirectory]:
+    """Runs guideseq over many plates, indexing each distinct reference once."""
+
+    return guideseq_batch(
+        manifests=manifests,
+        input_dirs=input_dirs,
+        output_dirs=output_dirs,
+        max_concurrent_runs=max_concurrent_runs,
+        skip_demultiplex=skip_demultiplex,
+        download_concurrency=download_concurrency,
+        selective_download=selective_download,
+        download_cache=download_cache,
+        download_cache_max_gb=download_cache_max_gb,
+        streaming_demultiplex=streaming_demultiplex,
+        demultiplex_mismatches=demultiplex_mismatches,
+        index_cache=index_cache,
+        cpu=cpu,
+        memory_gb=memory_gb,
+        compress_intermediates=compress_intermediates,
+        run_cache=run_cache,
+    )
+
+
 @workflow
 def guideseq_wf(
     manifest: FlyteFile,
@@ -93,6 +1543,26 @@ def guideseq_wf(
     output_dir: FlyteDirectory,
     identify_and_filter: bool = False,
     skip_demultiplex: bool = False,
+    download_concurrency: int = DEFAULT_CONCURRENCY,
+    selective_download: bool = False,
+    download_cache: str = "",
+    download_cache_max_gb: int = 100,
+    fan_out_samples: bool = False,
+    streaming_demultiplex: bool = False,
+    demultiplex_mismatches: int = 0,
+    index_cache: str = "",
+    cpu: int = 0,
+    memory_gb: int = 0,
+    compress_intermediates: bool = False,
+    checkpoint_stages: bool = False,
+    run_cache: str = "",
+    stream_alignment: bool = False,
+    keep_intermediates: bool = False,
+    partitioned_consolidate: bool = False,
+    array_identify: bool = False,
+    pipelined_download: bool = False,
+    control_cache: str = "",
+    columnar_output: bool = False,
 ) -> FlyteDirectory:
     """The guideseq package implements our data preprocessing and analysis pipeline for GUIDE-Seq data. It takes a parameter manifest file (.yaml) specifying raw sequencing reads as input and produces a table of annotated off-target sites as output.
 
@@ -112,6 +1582,8 @@ def guideseq_wf(
 
     ![Guideseq Pipeline Steps](https://github.com/tsailabSJ/guideseq/blob/master/guideseq_flowchart.png?raw=true)
 
+    With **Fast Identify**, step 4 is done by an array-based engine that counts every position's molecules with one sort of the reads and finds windows with vectorized scans, aligning sites across all CPUs. It reproduces guideseq's identify: its identified/ tables are the same, line for line.
+
     ### Writing A Manifest File<a name="write_manifest"></a>
     When running the end-to-end analysis functionality of the guideseq package, a number of inputs are required. To simplify the formatting of these inputs and to encourage reproducibility, these parameters are inputted into the pipeline via a manifest formatted as a YAML file. YAML files allow easy-to-read specification of key-value pairs. This allows us to easily specify our parameters. The following fields are required in the manifest:
 
@@ -232,6 +1704,154 @@ def guideseq_wf(
           __metadata__:
             display_name: Data is Demultiplexed
 
+        download_concurrency:
+          Maximum number of parallel S3 requests used to download the input directory.
+
+          __metadata__:
+            display_name: Download Concurrency
+
+        selective_download:
+          Download only the files referenced by the manifest instead of the whole input directory.
+          Fails before any transfer if a referenced file is missing.
+
+          __metadata__:
+            display_name: Only Download Manifest Inputs
+
+        download_cache:
+          Local directory or s3:// prefix used to cache downloaded inputs across runs.
+          Inputs are matched on bucket, key, ETag and size. Leave empty to disable.
+
+          __metadata__:
+            display_name: Download Cache Location
+
+        download_cache_max_gb:
+          Least recently used cache entries are evicted once the cache exceeds this size.
+
+          __metadata__:
+            display_name: Download Cache Size (GB)
+
+        fan_out_samples:
+          Demultiplex once, then run umitag, consolidate, align and identify for every sample in parallel
+          on separate nodes before filtering against the control. Not used with Only Identify and Filter.
+
+          __metadata__:
+            display_name: Process Samples in Parallel
+
+        streaming_demultiplex:
+          Demultiplex with a single streaming pass over the four undemultiplexed FASTQs instead of guideseq's
+          demultiplex step. Produces the same demultiplexed/ files and honours demultiplex_min_reads.
+
+          __metadata__:
+            display_name: Fast Demultiplex
+
+        demultiplex_mismatches:
+          Mismatches tolerated in each index barcode by the fast demultiplexer. 0 matches guideseq exactly.
+
+          __metadata__:
+            display_name: Barcode Mismatches
+
+        index_cache:
+          Local directory or s3:// prefix holding BWA indexes keyed on the reference FASTA hash. A cached index is
+          reused; otherwise the index is built once and published there. Leave empty to let guideseq index the reference.
+
+          __metadata__:
+            display_name: BWA Index Cache
+
+        cpu:
+          CPUs requested for alignment, also used as the bwa mem thread count. 0 picks a tier from the input size.
+
+          __metadata__:
+            display_name: CPUs
+
+        memory_gb:
+          Memory requested for alignment in GiB. 0 picks a tier from the input and reference size.
+
+          __metadata__:
+            display_name: Memory (GiB)
+
+        compress_intermediates:
+          Store demultiplexed, umitagged and consolidated reads as BGZF-compressed .fastq.gz and alignments as
+          sorted, indexed .bam instead of .fastq and .sam.
+
+          __metadata__:
+            display_name: Compress Intermediate Files
+
+        checkpoint_stages:
+          Run guideseq one step at a time and record each finished step under the output directory, so a
+          retried task resumes from the last finished step instead of starting over. Not used with Only
+          Identify and Filter or Process Samples in Parallel.
+
+          __metadata__:
+            display_name: Resume From Checkpoints
+
+        run_cache:
+          s3:// prefix to record finished runs under. When the manifest, the input files and the options that
+          change outputs all match an earlier run, its outputs are copied into the output directory instead
+          of running the pipeline again. Not used with Process Samples in Parallel. Leave empty to always run.
+
+          __metadata__:
+            display_name: Run Cache
+
+        stream_alignment:
+          Tag, consolidate and align each sample in one streaming pass, piping consensus reads straight into
+          bwa mem instead of writing umitagged and consolidated FASTQs. Runs guideseq one step at a time and
+          is not used with Only Identify and Filter or Process Samples in Parallel.
+
+          __metadata__:
+            display_name: Stream Reads Into Alignment
+
+        keep_intermediates:
+          With Stream Reads Into Alignment, still write the umitagged and consolidated FASTQs to the output
+          directory.
+
+          __metadata__:
+            display_name: Keep Streamed Intermediates
+
+        partitioned_consolidate:
+          Consolidate UMIs by hash-partitioning reads into on-disk buckets sized to the task's memory and
+          consolidating the buckets on all CPUs, instead of holding a whole sample in memory. Writes the same
+          consolidated/ files. Runs guideseq one step at a time and is not used with Only Identify and Filter
+          or Process Samples in Parallel.
+
+          __metadata__:
+            display_name: Low Memory Consolidation
+
+        array_identify:
+          Identify candidate sites with an array-based engine that counts every position's molecules with one
+          sort of the reads and finds windows with vectorized scans, instead of guideseq's per-position tables,
+          and aligns sites to the target across all CPUs. Writes the same identified/ tables as guideseq.
+          Runs guideseq one step at a time and is not used with Only Identify and Filter or Process Samples in
+          Parallel.
+
+          __metadata__:
+            display_name: Fast Identify
+
+        pipelined_download:
+          Start the pipeline as soon as the reads it begins with are downloaded, fetching the reference and its
+          index in the background until alignment needs them. Downloads only the files the manifest references.
+          Runs guideseq one step at a time and is not used with Only Identify and Filter or Process Samples in
+          Parallel.
+
+          __metadata__:
+            display_name: Start Before Download Finishes
+
+        control_cache:
+          Local directory or s3:// URI where processed control samples are cached, keyed by the control's reads,
+          the reference and the settings that affect them. A run whose control was processed before restores
+          its consolidated reads, alignment and identified sites instead of processing it again. Runs guideseq
+          one step at a time and is not used with Only Identify and Filter or Process Samples in Parallel.
+
+          __metadata__:
+            display_name: Control Cache
+
+        columnar_output:
+          Also write every sample's identified off-target sites as one Parquet dataset under offtargets/, sorted by
+          chromosome and position, with row-group statistics and a per-sample index of targets, site counts and
+          row groups. Not used with Process Samples in Parallel.
+
+          __metadata__:
+            display_name: Columnar Off-Target Table
+
         output_dir:
           Will place the output directory here. Overwrites value in input manifest, which can be ignored.
 
@@ -241,12 +1861,67 @@ def guideseq_wf(
 
     """
 
-    return guideseq(
+    # Fails the run before any download if the manifest or its inputs are wrong.
+    checked = validate_run(
         manifest=manifest,
         input_dir=input_dir,
         identify_and_filter=identify_and_filter,
         skip_demultiplex=skip_demultiplex,
-        output_dir=output_dir,
+        streaming_demultiplex=streaming_demultiplex,
+        demultiplex_mismatches=demultiplex_mismatches,
+        download_concurrency=download_concurrency,
+        cpu=cpu,
+        memory_gb=memory_gb,
+    )
+    return (
+        conditional("fan_out_samples")
+        .if_(fan_out_samples.is_true() & identify_and_filter.is_false())
+        .then(
+            guideseq_fan_out_wf(
+                manifest=checked.manifest,
+                input_dir=input_dir,
+                output_dir=output_dir,
+                skip_demultiplex=skip_demultiplex,
+                download_concurrency=download_concurrency,
+                download_cache=download_cache,
+                download_cache_max_gb=download_cache_max_gb,
+                streaming_demultiplex=streaming_demultiplex,
+                demultiplex_mismatches=demultiplex_mismatches,
+                index_cache=index_cache,
+                cpu=cpu,
+                memory_gb=memory_gb,
+                compress_intermediates=compress_intermediates,
+            )
+        )
+        .else_()
+        .then(
+            guideseq_sized(
+                manifest=checked.manifest,
+                input_dir=input_dir,
+                identify_and_filter=identify_and_filter,
+                skip_demultiplex=skip_demultiplex,
+                output_dir=output_dir,
+                download_concurrency=download_concurrency,
+                selective_download=selective_download,
+                download_cache=download_cache,
+                download_cache_max_gb=download_cache_max_gb,
+                streaming_demultiplex=streaming_demultiplex,
+                demultiplex_mismatches=demultiplex_mismatches,
+                index_cache=index_cache,
+                cpu=cpu,
+                memory_gb=memory_gb,
+                compress_intermediates=compress_intermediates,
+                checkpoint_stages=checkpoint_stages,
+                run_cache=run_cache,
+                stream_alignment=stream_alignment,
+                keep_intermediates=keep_intermediates,
+                partitioned_consolidate=partitioned_consolidate,
+                array_identify=array_identify,
+                pipelined_download=pipelined_download,
+                control_cache=control_cache,
+                columnar_output=columnar_output,
+            )
+        )
     )
 
 
@@ -0,0 +1,185 @@
+"""
+Content-addressed store of file bundles, shared by the BWA index and
+control caches.
+
+A bundle is a set of named files published and fetched whole under a
+digest. Bundles are published atomically: locally by renaming a fully
+written directory into place, and in the object store by uploading, after
+every file, a marker that lists them. A bundle without its marker is a
+miss. Fetches write each file under a temporary name next to its
+destination and rename them all into place only once every file is local,
+so an interrupted fetch never leaves part of a bundle where a reader would
+take it for a whole one. Local files are reflinked or copied, never
+hardlinked, so a task writing to its copy cannot alter the store.
+
+(c) 2021 by latch.ai.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+from latch.download_cache import clone
+from latch.s3_dir_download import DEFAULT_CONCURRENCY, ensure_dir, get_s3_client
+
+COMPLETE_MARKER = "COMPLETE"
+
+
+class BundleStore(ABC):
+    def __init__(self, concurrency: int = DEFAULT_CONCURRENCY):
+        self.concurrency = concurrency
+
+    @abstractmethod
+    def files(self, digest: str) -> Optional[List[str]]:
+        """Names of the bundle's files, or None if it is not published."""
+
+    @abstractmethod
+    def _get(self, digest: str, name: str, dest: str):
+        """Copies one file of a published bundle to dest."""
+
+    @abstractmethod
+    def _put(self, digest: str, files: Dict[str, str]):
+        """Publishes the bundle of files, keyed by name."""
+
+    def fetch(self, digest: str, dest: Callable[[str], str]) -> bool:
+        """
+        Materializes every file of the bundle at dest(name). Returns False,
+        writing nothing, if the bundle is not published.
+        """
+        names = self.files(digest)
+        if names is None:
+            return False
+        staged = []
+        for name in names:
+            path = dest(name)
+            ensure_dir(path)
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(path)),
+                prefix=f".{os.path.basename(path)}.",
+            )
+            os.close(fd)
+            staged.append((name, tmp, path))
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                for future in [
+                    pool.submit(self._get, digest, name, tmp) for name, tmp, _ in staged
+                ]:
+                    future.result()
+        except BaseException:
+            for _, tmp, _ in staged:
+                if os.path.lexists(tmp):
+                    os.remove(tmp)
+            raise
+        for _, tmp, path in staged:
+            os.replace(tmp, path)
+        return True
+
+    def publish(self, digest: str, files: Dict[str, str]):
+        """
+        Stores files, local paths keyed by their name in the bundle, as the
+        bundle for digest unless it is already published.
+        """
+        if self.files(digest) is None:
+            self._put(digest, files)
+
+
+class LocalBundleStore(BundleStore):
+    def __init__(self, root: str, concurrency: int = DEFAULT_CONCURRENCY):
+        super().__init__(concurrency)
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def files(self, digest):
+        bundle = os.path.join(self.root, digest)
+        if not os.path.isdir(bundle):
+            return None
+        names = []
+        for dirpath, _, filenames in os.walk(bundle):
+            for filename in filenames:
+                rel = os.path.relpath(os.path.join(dirpath, filename), bundle)
+                names.append(rel.replace(os.sep, "/"))
+        return sorted(names)
+
+    def _get(self, digest, name, dest):
+        clone(os.path.join(self.root, digest, *name.split("/")), dest)
+
+    def _put(self, digest, files):
+        tmp = tempfile.mkdtemp(dir=self.root, prefix=f".{digest}.")
+        for name, path in files.items():
+            dest = os.path.join(tmp, *name.split("/"))
+            ensure_dir(dest)
+            clone(path, dest)
+        try:
+            os.rename(tmp, os.path.join(self.root, digest))
+        except OSError:
+            # Another task published the same bundle first.
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+class S3BundleStore(BundleStore):
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str,
+        client=None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ):
+        super().__init__(concurrency)
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = client or get_s3_client()
+
+    def _key(self, digest: str, name: str) -> str:
+        return "/".join(p for p in (self.prefix, digest, name) if p)
+
+    def files(self, digest):
+        from botocore.exceptions import ClientError
+
+        try:
+            body = self.client.get_object(
+                Bucket=self.bucket, Key=self._key(digest, COMPLETE_MARKER)
+            )["Body"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return json.loads(body.read())["files"]
+
+    def _get(self, digest, name, dest):
+        self.client.download_file(self.bucket, self._key(digest, name), dest)
+
+    def _put(self, digest, files):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            for future in [
+                pool.submit(
+                    self.client.upload_file, path, self.bucket, self._key(digest, name)
+                )
+                for name, path in files.items()
+            ]:
+                future.result()
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self._key(digest, COMPLETE_MARKER),
+            Body=json.dumps({"files": sorted(files)}, indent=2).encode(),
+        )
+
+
+def open_bundle_store(
+    location: str, client=None, concurrency: int = DEFAULT_CONCURRENCY
+) -> Optional[BundleStore]:
+    """
+    params:
+    - location: local directory or s3://bucket/prefix URI; empty disables the store
+    - client: s3 client, the shared one if omitted
+    """
+    if not location:
+        return None
+    split_uri = urlparse(location)
+    if split_uri.scheme == "s3":
+        return S3BundleStore(split_uri.netloc, split_uri.path, client, concurrency)
+    return LocalBundleStore(location, concurrency)
@@ -0,0 +1,92 @@
+"""
+Persistent cache of BWA index bundles keyed on the reference FASTA hash.
+
+A bundle is the reference's `.amb/.ann/.bwt/.pac/.sa` files plus its
+`.fai`. guideseq's align step only runs `bwa index` when these are missing
+next to `reference_genome`, so materializing a cached bundle there is
+enough for the pipeline to pick it up.
+
+Bundles live in a BundleStore, which publishes them atomically and only
+renames a fetched bundle into place once all of it is local. Only indexes
+built by ensure_index are published: one found next to the reference may
+have been built from other bytes than the reference it is keyed on.
+
+(c) 2021 by latch.ai.
+"""
+
+import os
+from typing import Optional
+
+from latch.bundle_store import BundleStore, open_bundle_store
+from latch.manifest import BWA_INDEX_SUFFIXES
+from latch.pipeline import run
+from latch.reference import build_fai, fasta_digest
+
+INDEX_SUFFIXES = BWA_INDEX_SUFFIXES + (".fai",)
+BUNDLE_NAME = "index"
+
+
+def has_index(reference: str) -> bool:
+    return all(os.path.isfile(reference + suffix) for suffix in INDEX_SUFFIXES)
+
+
+def build_index(reference: str, bwa: str = "bwa", log_path: str = "bwa_index.log"):
+    """Builds the full bundle next to reference."""
+    if not all(os.path.isfile(reference + s) for s in BWA_INDEX_SUFFIXES):
+        run([bwa, "index", reference], log_path)
+    if not os.path.isfile(reference + ".fai"):
+        build_fai(reference)
+
+
+class IndexCache:
+    """Bundles of index files, named `index.<suffix>`, in a BundleStore."""
+
+    def __init__(self, store: BundleStore):
+        self.store = store
+
+    def fetch(self, digest: str, reference: str) -> bool:
+        """Materializes the bundle for digest next to reference, if cached."""
+        return self.store.fetch(
+            digest, lambda name: reference + name[len(BUNDLE_NAME) :]
+        )
+
+    def publish(self, digest: str, reference: str):
+        """Stores the bundle sitting next to reference under digest."""
+        self.store.publish(
+            digest,
+            {BUNDLE_NAME + suffix: reference + suffix for suffix in INDEX_SUFFIXES},
+        )
+
+
+def open_index_cache(location: str, client) -> Optional[IndexCache]:
+    """
+    params:
+    - location: local directory or s3://bucket/prefix URI; empty disables caching
+    - client: initialized s3 client object, used by object store caches
+    """
+    store = open_bundle_store(location, client)
+    return None if store is None else IndexCache(store)
+
+
+def ensure_index(
+    reference: str,
+    bwa: str = "bwa",
+    cache: Optional[IndexCache] = None,
+    log_path: str = "bwa_index.log",
+) -> str:
+    """
+    Makes sure a full bundle sits next to reference, reusing a cached one if
+    possible and publishing a freshly built one. Returns the reference digest.
+    """
+    digest = fasta_digest(reference)
+    if has_index(reference):
+        # Nothing ties it to the reference's bytes, so it is not published.
+        print(f"Using BWA index found next to {reference}")
+    elif cache is not None and cache.fetch(digest, reference):
+        print(f"Using cached BWA index {digest} for {reference}")
+    else:
+        print(f"Building BWA index for {reference}")
+        build_index(reference, bwa, log_path)
+        if cache is not None:
+            cache.publish(digest, reference)
+    return digest
@@ -0,0 +1,160 @@
+"""
+Stage checkpoints that let a retried guideseq task resume where it stopped.
+
+After a stage finishes, its output folder is published under the task's
+output prefix. A marker is then written listing the sha256 of every file
+in that folder. Markers live under a checkpoint prefix keyed on a hash of
+the manifest, the execution and the options that change outputs, so only
+retries of the same run resume from them. Because a
+marker is only written once its files are uploaded, a task killed
+mid-stage simply re-runs that stage.
+
+(c) 2021 by latch.ai.
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+from latch.reference import HASH_BLOCK
+from latch.s3_dir_download import DEFAULT_CONCURRENCY, download_keys, get_s3_client
+from latch.s3_dir_upload import upload_files
+
+# Steps in the order guideseq.py all runs them, and the folder each writes.
+STAGE_FOLDERS = {
+    "demultiplex": "demultiplexed",
+    "umitag": "umitagged",
+    "consolidate": "consolidated",
+    "align": "aligned",
+    "identify": "identified",
+    "filter": "filtered",
+    "visualize": "visualization",
+}
+# The folder each step reads, which is what a resumed run has to restore.
+STAGE_INPUTS = {
+    "umitag": "demultiplexed",
+    "consolidate": "umitagged",
+    "align": "consolidated",
+    "identify": "aligned",
+    "filter": "identified",
+    "visualize": "identified",
+}
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def run_digest(manifest_path: str, **options) -> str:
+    """sha256 of the manifest contents and the options that identify a run."""
+    h = hashlib.sha256()
+    with open(manifest_path, "rb") as f:
+        h.update(f.read())
+    h.update(json.dumps(options, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class Checkpoints:
+    """
+    params:
+    - root: local output folder stage folders are written into
+    - bucket, prefix: s3 location root is published to
+    - digest: run_digest of the run being checkpointed
+    - client: s3 client, the shared one if omitted
+    - concurrency: maximum number of requests in flight at once
+    """
+
+    def __init__(
+        self,
+        root: str,
+        bucket: str,
+        prefix: str,
+        digest: str,
+        client=None,
+        concurrency: int = DEFAULT_CONCURRENCY,
+    ):
+        self.root = root
+        self.bucket = bucket
+        self.prefix = prefix
+        self.marker_prefix = f"{prefix}/.checkpoints/{digest}"
+        self.client = client or get_s3_client()
+        self.concurrency = concurrency
+
+    def _marker_key(self, stage: str) -> str:
+        return f"{self.marker_prefix}/{stage}.json"
+
+    def marker(self, stage: str) -> Optional[Dict]:
+        try:
+            body = self.client.get_object(
+                Bucket=self.bucket, Key=self._marker_key(stage)
+            )["Body"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return json.loads(body.read())
+
+    def completed(self, stages: List[str]) -> List[str]:
+        """The longest run of leading stages that all have markers."""
+        done = []
+        for stage in stages:
+            if self.marker(stage) is None:
+                break
+            done.append(stage)
+        return done
+
+    def record(self, stage: str) -> List[str]:
+        """Publishes the stage's folder, then its marker. Returns the files."""
+        folder = os.path.join(self.root, STAGE_FOLDERS[stage])
+        files = sorted(
+            os.path.join(dirpath, name)
+            for dirpath, _, names in os.walk(folder)
+            for name in names
+        )
+        upload_files(
+            files, self.root, self.bucket, self.prefix, self.client, self.concurrency
+        )
+        rels = [os.path.relpath(p, self.root).replace(os.sep, "/") for p in files]
+        marker = {
+            "stage": stage,
+            "files": {rel: file_digest(path) for rel, path in zip(rels, files)},
+            "sizes": {rel: os.path.getsize(path) for rel, path in zip(rels, files)},
+        }
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self._marker_key(stage),
+            Body=json.dumps(marker, indent=2).encode(),
+        )
+        return files
+
+    def sizes(self, stages: List[str]) -> Dict[str, int]:
+        """Sizes of the published files of stages, keyed on their relative path."""
+        sizes = {}
+        for stage in stages:
+            sizes.update(self.marker(stage)["sizes"])
+        return sizes
+
+    def restore(self, stage: str):
+        """Downloads the folder written by stage and checks it against its marker."""
+        files = self.marker(stage)["files"]
+        download_keys(
+            [f"{self.prefix}/{rel}" for rel in files],
+            self.prefix,
+            self.root,
+            self.bucket,
+            self.client,
+            self.concurrency,
+        )
+        for rel, digest in files.items():
+            path = os.path.join(self.root, rel)
+            if file_digest(path) != digest:
+                raise RuntimeError(
+                    f"Checkpointed {rel} does not match its recorded sha256"
+                )
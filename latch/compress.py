@@ -0,0 +1,84 @@
+"""
+Compressed intermediates: BGZF FASTQs and sorted, indexed BAMs.
+
+Levels favour speed over ratio; both bgzip and samtools compress with the
+task's threads. guideseq's umitag and consolidate steps and bwa all read
+gzipped FASTQ, and sam_stream feeds identify a SAM stream decoded from the
+BAM, so a plain copy only lives until the step that wrote it has finished.
+
+(c) 2021 by latch.ai.
+"""
+
+import glob
+import os
+import subprocess
+from contextlib import contextmanager
+
+from latch.pipeline import run
+
+FASTQ_LEVEL = 1
+BAM_LEVEL = 1
+INTERMEDIATE_FOLDERS = ("demultiplexed", "umitagged", "consolidated")
+
+
+def bgzip(path: str, threads: int, log_path: str) -> str:
+    """Replaces path with a BGZF-compressed path.gz and returns its name."""
+    run(
+        ["bgzip", "-f", "-@", str(threads), "-l", str(FASTQ_LEVEL), path],
+        log_path,
+    )
+    return path + ".gz"
+
+
+def sam_to_bam(sam: str, threads: int, log_path: str) -> str:
+    """Replaces sam with a coordinate sorted, indexed BAM and returns its name."""
+    bam = os.path.splitext(sam)[0] + ".bam"
+    run(
+        [
+            "samtools",
+            "sort",
+            "-@",
+            str(threads),
+            "-l",
+            str(BAM_LEVEL),
+            "-o",
+            bam,
+            sam,
+        ],
+        log_path,
+    )
+    run(["samtools", "index", "-@", str(threads), bam], log_path)
+    os.remove(sam)
+    return bam
+
+
+def compress_outputs(output_folder: str, threads: int, log_path: str):
+    """Compresses every intermediate a `guideseq.py all` run left behind."""
+    for folder in INTERMEDIATE_FOLDERS:
+        for fastq in sorted(glob.glob(os.path.join(output_folder, folder, "*.fastq"))):
+            bgzip(fastq, threads, log_path)
+    for sam in sorted(glob.glob(os.path.join(output_folder, "aligned", "*.sam"))):
+        sam_to_bam(sam, threads, log_path)
+
+
+@contextmanager
+def sam_stream(bam: str, sam: str):
+    """
+    Exposes bam as a SAM named pipe at sam for readers that only take SAM,
+    decoding it on the fly with samtools.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(sam)), exist_ok=True)
+    os.mkfifo(sam)
+    # Opening the write end of a FIFO blocks until a reader attaches, so
+    # samtools is left to do it from its own process.
+    proc = subprocess.Popen(["samtools", "view", "-h", "-o", sam, bam])
+    try:
+        yield sam
+    except BaseException:
+        proc.kill()
+        raise
+    finally:
+        proc.wait()
+        os.remove(sam)
+    if proc.returncode != 0:
+        raise RuntimeError(f"samtools view failed to decode {bam}")
@@ -0,0 +1,246 @@
+"""
+UMI tagging and consolidation as done by guideseq's umitag and consolidate.
+
+A read pair's molecular id is its two index reads, which hold the sample
+barcodes and the UMI, joined to the first bases of read 1. Reads sharing
+a molecular id are collapsed into one consensus read per end: at each
+position the base seen in more than min_freq of the reads, counting only
+calls above min_qual, with the best quality it was called at, or N.
+
+consolidate_partitioned does the same for umitagged FASTQs without holding
+a whole library in memory. Pairs are hash-partitioned on their molecular
+id into on-disk buckets sized to a memory budget, raising the open-file
+limit as far as needed to write them all at once. The buckets are
+consolidated by a pool of processes, and the results merged back in order
+of each molecule's first read. For umitag's sorted output this is the
+order guideseq's consolidate writes.
+
+(c) 2021 by latch.ai.
+"""
+
+import heapq
+import math
+import os
+import resource
+import shutil
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+
+from latch.demultiplex import open_fastq
+
+MIN_QUAL = 15
+MIN_FREQ = 0.9
+# Bases of read 1 appended to the UMI to tell apart molecules sharing one.
+R1_PREFIX = 6
+QUAL_OFFSET = 33
+NO_CALL = (ord("N"), QUAL_OFFSET)
+# Bytes of memory a bucket takes per byte of it on disk once grouped.
+BUCKET_OVERHEAD = 4
+# Descriptors left for everything but the buckets when sizing the limit.
+FILE_HEADROOM = 64
+GZIP_RATIO = 4
+WRITE_BUFFER = 64 * 1024
+
+
+def molecular_id(index1: bytes, index2: bytes, read1: bytes) -> bytes:
+    """
+    params:
+    - index1, index2: sequences of the two index reads
+    - read1: sequence of read 1
+    """
+    return index1 + index2 + b"_" + read1[:R1_PREFIX]
+
+
+def consensus(
+    seqs: List[bytes],
+    quals: List[bytes],
+    min_qual: int = MIN_QUAL,
+    min_freq: float = MIN_FREQ,
+) -> Tuple[bytes, bytes]:
+    """Consensus sequence and qualities of reads of one end of a molecule."""
+    n = len(seqs)
+    seq = bytearray()
+    qual = bytearray()
+    # Reads are cut to the shortest, as consensus is only taken where all overlap.
+    for bases, calls in zip(zip(*seqs), zip(*quals)):
+        counts = {}
+        best = {}
+        for base, q in zip(bases, calls):
+            q -= QUAL_OFFSET
+            if q > min_qual:
+                counts[base] = counts.get(base, 0) + 1
+            if q > best.get(base, 0):
+                best[base] = q
+        if counts:
+            base = max(counts, key=counts.get)
+            if counts[base] / n > min_freq:
+                seq.append(base)
+                qual.append(best[base] + QUAL_OFFSET)
+                continue
+        seq.append(NO_CALL[0])
+        qual.append(NO_CALL[1])
+    return bytes(seq), bytes(qual)
+
+
+def consolidated_record(
+    mol_id: bytes,
+    seqs: List[bytes],
+    quals: List[bytes],
+    min_qual: int = MIN_QUAL,
+    min_freq: float = MIN_FREQ,
+) -> bytes:
+    """The FASTQ record consolidate writes for one end of a molecule."""
+    return _record(mol_id, len(seqs), *consensus(seqs, quals, min_qual, min_freq))
+
+
+def consolidate_partitioned(
+    umitagged: Dict[str, str],
+    consolidated: Dict[str, str],
+    work_dir: str,
+    memory_bytes: int,
+    processes: int,
+    min_qual: int = MIN_QUAL,
+    min_freq: float = MIN_FREQ,
+) -> int:
+    """
+    Consolidates umitagged r1/r2 FASTQs into consolidated r1/r2 FASTQs and
+    returns the number of molecules.
+
+    params:
+    - umitagged: umitagged read paths keyed by r1/r2, optionally gzipped
+    - consolidated: paths to write keyed by r1/r2
+    - work_dir: scratch folder for the buckets, removed afterwards
+    - memory_bytes: memory the bucket workers may use between them
+    - processes: number of buckets consolidated at once
+    """
+    size = sum(
+        os.path.getsize(p) * (GZIP_RATIO if p.endswith(".gz") else 1)
+        for p in umitagged.values()
+    )
+    num_buckets = max(
+        processes, math.ceil(size * BUCKET_OVERHEAD * processes / memory_bytes)
+    )
+    max_buckets = _raise_open_files(num_buckets)
+    if num_buckets > max_buckets:
+        print(
+            f"Warning: consolidating in {max_buckets} buckets instead of "
+            f"{num_buckets}, as many as the open-file limit allows, so they "
+            f"may exceed the {memory_bytes} byte memory budget"
+        )
+        num_buckets = max_buckets
+    os.makedirs(work_dir, exist_ok=True)
+    for path in consolidated.values():
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    try:
+        buckets = _partition(umitagged, work_dir, num_buckets)
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(
+                pool.map(
+                    _consolidate_bucket,
+                    buckets,
+                    [min_qual] * len(buckets),
+                    [min_freq] * len(buckets),
+                )
+            )
+        return _merge(results, consolidated)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _raise_open_files(num_buckets: int) -> int:
+    """
+    Raises the soft open-file limit, up to the hard one, to hold num_buckets
+    files at once. Returns the number of buckets the limit allows.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = num_buckets + FILE_HEADROOM
+    if hard != resource.RLIM_INFINITY:
+        needed = min(needed, hard)
+    if needed > soft:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed, hard))
+        soft = needed
+    return max(1, soft - FILE_HEADROOM)
+
+
+def _record(mol_id: bytes, count: int, seq: bytes, qual: bytes) -> bytes:
+    return b"@%s_%d\n%s\n+\n%s\n" % (mol_id, count, seq, qual)
+
+
+def _partition(umitagged: Dict[str, str], work_dir: str, num_buckets: int):
+    """Writes each pair, numbered by position, to the bucket of its molecular id."""
+    paths = [os.path.join(work_dir, f"{i}.tsv") for i in range(num_buckets)]
+    buckets = [open(p, "wb", buffering=WRITE_BUFFER) for p in paths]
+    streams = [open_fastq(umitagged[end]) for end in ("r1", "r2")]
+    try:
+        r1, r2 = [f for _, f in streams]
+        index = 0
+        while True:
+            ends = [[f.readline().rstrip(b"\n") for _ in range(4)] for f in (r1, r2)]
+            if not ends[0][0]:
+                if ends[1][0]:
+                    raise ValueError("Umitagged FASTQs differ in length")
+                break
+            # umitag appends the molecular id to each header.
+            mol_id = ends[0][0].rsplit(b" ", 1)[-1]
+            if ends[1][0].rsplit(b" ", 1)[-1] != mol_id:
+                raise ValueError(f"Umitagged read pair {index} is out of step")
+            bucket = buckets[zlib.crc32(mol_id) % num_buckets]
+            bucket.write(
+                b"%d\t%s\t%s\t%s\t%s\t%s\n"
+                % (index, mol_id, ends[0][1], ends[0][3], ends[1][1], ends[1][3])
+            )
+            index += 1
+    finally:
+        for f in buckets:
+            f.close()
+        for proc, f in streams:
+            f.close()
+            if proc is not None:
+                proc.wait()
+    return paths
+
+
+def _consolidate_bucket(path: str, min_qual: int, min_freq: float) -> str:
+    """Consolidates one bucket into lines ordered by each molecule's first read."""
+    groups = {}
+    with open(path, "rb") as f:
+        for line in f:
+            index, mol_id, seq1, qual1, seq2, qual2 = line.rstrip(b"\n").split(b"\t")
+            group = groups.get(mol_id)
+            if group is None:
+                group = groups[mol_id] = (int(index), [], [], [], [])
+            for reads, value in zip(group[1:], (seq1, qual1, seq2, qual2)):
+                reads.append(value)
+    os.remove(path)
+
+    out = path + ".consolidated"
+    with open(out, "wb", buffering=WRITE_BUFFER) as f:
+        for mol_id, (index, seqs1, quals1, seqs2, quals2) in sorted(
+            groups.items(), key=lambda item: item[1][0]
+        ):
+            seq1, qual1 = consensus(seqs1, quals1, min_qual, min_freq)
+            seq2, qual2 = consensus(seqs2, quals2, min_qual, min_freq)
+            f.write(
+                b"%d\t%s\t%d\t%s\t%s\t%s\t%s\n"
+                % (index, mol_id, len(seqs1), seq1, qual1, seq2, qual2)
+            )
+    return out
+
+
+def _merge(results: List[str], consolidated: Dict[str, str]) -> int:
+    files = [open(p, "rb") for p in results]
+    count = 0
+    try:
+        with open(consolidated["r1"], "wb") as r1, open(consolidated["r2"], "wb") as r2:
+            for line in heapq.merge(
+                *files, key=lambda line: int(line.split(b"\t", 1)[0])
+            ):
+                _, mol_id, n, seq1, qual1, seq2, qual2 = line.rstrip(b"\n").split(b"\t")
+                r1.write(_record(mol_id, int(n), seq1, qual1))
+                r2.write(_record(mol_id, int(n), seq2, qual2))
+                count += 1
+    finally:
+        for f in files:
+            f.close()
+    return count
@@ -0,0 +1,82 @@
+"""
+Persistent cache of a processed control sample, shared across runs.
+
+Nearly every run carries the same control sample, which is only used as
+background for filter. An entry holds what the control's processing leaves
+in the output folder: its consolidated reads, its alignment and its
+identified sites. Entries are keyed on a hash of the control's
+demultiplexed reads, the reference and the options that change those
+outputs. A run whose control matches an entry restores it and skips
+umitag, consolidate, align and identify for the control.
+
+Entries are bundles in the same BundleStore as BWA indexes, published
+atomically and restored only once every file of the entry is local.
+
+(c) 2021 by latch.ai.
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
+
+from latch.bundle_store import BundleStore, open_bundle_store
+from latch.checkpoint import file_digest
+from latch.pipeline import aligned_path, consolidated_paths, identified_path
+
+CONTROL = "control"
+
+
+def control_digest(reads: Dict[str, str], reference_digest: str, **options) -> str:
+    """
+    sha256 of the control's reads, the reference and the options that change
+    its processed outputs.
+
+    params:
+    - reads: the control's demultiplexed read paths keyed by r1/r2/i1/i2
+    - reference_digest: fasta_digest of the reference
+    """
+    h = hashlib.sha256()
+    for end in sorted(reads):
+        h.update(f"{end}:{file_digest(reads[end])}\n".encode())
+    h.update(reference_digest.encode())
+    h.update(json.dumps(options, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def control_files(output_folder: str, compressed: bool = False) -> List[str]:
+    """The control's processed outputs present under output_folder."""
+    aligned = aligned_path(output_folder, CONTROL, compressed)
+    paths = list(consolidated_paths(output_folder, CONTROL, compressed).values())
+    paths += [aligned, aligned + ".bai", identified_path(output_folder, CONTROL)]
+    return [p for p in paths if os.path.isfile(p)]
+
+
+class ControlCache:
+    """Processed controls in a BundleStore, named by path under output_folder."""
+
+    def __init__(self, store: BundleStore):
+        self.store = store
+
+    def fetch(self, digest: str, output_folder: str) -> bool:
+        """Restores the entry for digest into output_folder, if cached."""
+        return self.store.fetch(
+            digest, lambda name: os.path.join(output_folder, *name.split("/"))
+        )
+
+    def publish(self, digest: str, output_folder: str, paths: List[str]):
+        """Stores paths, all under output_folder, as the entry for digest."""
+        self.store.publish(
+            digest,
+            {os.path.relpath(p, output_folder).replace(os.sep, "/"): p for p in paths},
+        )
+
+
+def open_control_cache(location: str, client=None) -> Optional[ControlCache]:
+    """
+    params:
+    - location: local directory or s3://bucket/prefix URI; empty disables caching
+    - client: s3 client, the shared one if omitted
+    """
+    store = open_bundle_store(location, client)
+    return None if store is None else ControlCache(store)
@@ -0,0 +1,231 @@
+"""
+Single-pass demultiplexer for the pooled GUIDE-seq run.
+
+Reads `forward`, `reverse`, `index1` and `index2` in lockstep, with gzip
+inputs decompressed by one child process each so that the four streams
+inflate in parallel. Reads are assigned in batches against a lookup table
+holding every sample barcode and, optionally, its mismatch neighbours.
+
+Output matches guideseq's demultiplex step: the sample barcode is bases
+1-8 of each index read, barcodes seen at least `min_reads` times get
+their own `<sample>.{r1,r2,i1,i2}.fastq` (named after the raw barcode if
+it is not in the manifest), and everything else goes to `undetermined`.
+
+(c) 2021 by latch.ai.
+"""
+
+import itertools
+import os
+import shutil
+import subprocess
+import time
+from typing import Dict, List
+
+from latch.manifest import READ_FIELDS
+
+READ_ENDS = ("r1", "r2", "i1", "i2")
+DEFAULT_MIN_READS = 10000
+BATCH_SIZE = 65536
+REPORT_EVERY = 1000000
+READ_BUFFER = 4 * 1024 * 1024
+WRITE_BUFFER = 1024 * 1024
+BASES = b"ACGTN"
+
+
+def sample_barcode(fields: Dict) -> str:
+    """The concatenated barcode guideseq matches a sample's index reads on."""
+    return fields["barcode1"][1:8] + fields["barcode2"][1:8]
+
+
+def sample_barcodes(samples: Dict) -> Dict[str, str]:
+    """Maps the concatenated barcode guideseq matches on to each sample name."""
+    barcodes = {}
+    for sample, fields in samples.items():
+        barcode = sample_barcode(fields)
+        if barcode in barcodes:
+            raise ValueError(
+                f"Samples '{barcodes[barcode]}' and '{sample}' share barcode {barcode}"
+            )
+        barcodes[barcode] = sample
+    return barcodes
+
+
+def build_lookup(barcodes: Dict[str, str], max_mismatches: int = 0) -> Dict[bytes, str]:
+    """
+    Precomputes every accepted index sequence, allowing up to max_mismatches
+    substitutions in each of the two index barcodes. Neighbours that are
+    reachable from more than one sample are dropped as ambiguous.
+    """
+    lookup = {}
+    ambiguous = set()
+    for barcode, sample in barcodes.items():
+        half = len(barcode) // 2
+        first = _neighbours(barcode[:half].encode(), max_mismatches)
+        second = _neighbours(barcode[half:].encode(), max_mismatches)
+        for a, b in itertools.product(first, second):
+            key = a + b
+            if lookup.get(key, sample) != sample:
+                ambiguous.add(key)
+            lookup[key] = sample
+    for key in ambiguous:
+        del lookup[key]
+    # Exact barcodes always win over another sample's neighbour.
+    for barcode, sample in barcodes.items():
+        lookup[barcode.encode()] = sample
+    return lookup
+
+
+def demultiplex_reads(
+    read1: str,
+    read2: str,
+    index1: str,
+    index2: str,
+    barcodes: Dict[str, str],
+    out_dir: str,
+    min_reads: int = DEFAULT_MIN_READS,
+    max_mismatches: int = 0,
+    batch_size: int = BATCH_SIZE,
+) -> Dict[str, int]:
+    """
+    params:
+    - read1, read2, index1, index2: undemultiplexed FASTQs, optionally gzipped
+    - barcodes: concatenated barcode to sample name, see sample_barcodes
+    - out_dir: folder receiving the per-sample FASTQs
+    - min_reads: barcodes with fewer reads are written to undetermined
+    - max_mismatches: substitutions tolerated per index barcode
+    - batch_size: reads matched per batch
+
+    Returns the number of reads seen per sample id.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    lookup = build_lookup(barcodes, max_mismatches)
+    streams = [open_fastq(path) for path in (read1, read2, index1, index2)]
+
+    count = {}
+    buffers = {}
+    outfiles = {}
+    total_count = 0
+    next_report = REPORT_EVERY
+    start = time.time()
+    try:
+        while True:
+            lines = [list(itertools.islice(f, 4 * batch_size)) for _, f in streams]
+            n = len(lines[0])
+            if any(len(end) != n for end in lines):
+                raise ValueError(
+                    "Undemultiplexed FASTQs contain different numbers of reads"
+                )
+            if n == 0:
+                break
+
+            batch = {}
+            i1, i2 = lines[2], lines[3]
+            for j in range(1, n, 4):
+                barcode = i1[j][1:8] + i2[j][1:8]
+                sample_id = lookup.get(barcode)
+                if sample_id is None:
+                    sample_id = barcode.decode()
+                batch.setdefault(sample_id, []).append(j - 1)
+
+            for sample_id, offsets in batch.items():
+                records = [
+                    b"".join(b"".join(end[o : o + 4]) for o in offsets) for end in lines
+                ]
+                count[sample_id] = count.get(sample_id, 0) + len(offsets)
+                if sample_id in outfiles:
+                    _write(outfiles[sample_id], records)
+                elif count[sample_id] < min_reads:
+                    pending = buffers.setdefault(sample_id, [[] for _ in READ_ENDS])
+                    for buf, chunk in zip(pending, records):
+                        buf.append(chunk)
+                else:
+                    outfiles[sample_id] = _open_outputs(out_dir, sample_id)
+                    pending = buffers.pop(sample_id, [[] for _ in READ_ENDS])
+                    _write(
+                        outfiles[sample_id],
+                        [b"".join(buf) + chunk for buf, chunk in zip(pending, records)],
+                    )
+
+            total_count += n // 4
+            if total_count < next_report:
+                continue
+            next_report += REPORT_EVERY
+            print(
+                f"Demultiplexed {total_count} reads in "
+                f"{(time.time() - start) / 60:.1f} minutes."
+            )
+
+        undetermined = _open_outputs(out_dir, "undetermined")
+        for pending in buffers.values():
+            _write(undetermined, [b"".join(buf) for buf in pending])
+        outfiles["undetermined"] = undetermined
+    finally:
+        for files in outfiles.values():
+            for f in files:
+                f.close()
+        for proc, f in streams:
+            f.close()
+            if proc is not None:
+                proc.wait()
+
+    for path, (proc, _) in zip((read1, read2, index1, index2), streams):
+        if proc is not None and proc.returncode != 0:
+            raise RuntimeError(f"Failed to decompress {path}")
+
+    num_fastqs = len([v for v in count.values() if v >= min_reads])
+    print(
+        f"Wrote FASTQs for the {num_fastqs} sample barcodes out of {len(count)} "
+        f"with at least {min_reads} reads."
+    )
+    return count
+
+
+def demultiplexed_block(samples: Dict, out_dir: str) -> Dict[str, Dict[str, str]]:
+    """Manifest `demultiplexed` entries pointing at the files written by demultiplex."""
+    return {
+        sample: {
+            field: os.path.join(out_dir, f"{sample}.{end}.fastq")
+            for field, end in zip(READ_FIELDS, READ_ENDS)
+        }
+        for sample in samples
+    }
+
+
+def _neighbours(seq: bytes, max_mismatches: int) -> List[bytes]:
+    found = {seq}
+    frontier = {seq}
+    for _ in range(max_mismatches):
+        step = set()
+        for s in frontier:
+            for i in range(len(s)):
+                for base in BASES:
+                    step.add(s[:i] + bytes([base]) + s[i + 1 :])
+        frontier = step - found
+        found |= step
+    return list(found)
+
+
+def open_fastq(path: str):
+    if not path.endswith(".gz"):
+        return None, open(path, "rb", buffering=READ_BUFFER)
+    gunzip = shutil.which("pigz") or "gzip"
+    proc = subprocess.Popen(
+        [gunzip, "-dc", path], stdout=subprocess.PIPE, bufsize=READ_BUFFER
+    )
+    return proc, proc.stdout
+
+
+def _open_outputs(out_dir: str, sample_id: str):
+    return [
+        open(
+            os.path.join(out_dir, f"{sample_id}.{end}.fastq"),
+            "wb",
+            buffering=WRITE_BUFFER,
+        )
+        for end in READ_ENDS
+    ]
+
+
+def _write(files, records):
+    for f, chunk in zip(files, records):
+        f.write(chunk)
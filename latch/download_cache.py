@@ -0,0 +1,257 @@
+"""
+Content-addressed cache for objects fetched by download_dir.
+
+Entries are keyed on (bucket, key, ETag, size), so a cache hit is only
+possible for a byte-identical object. The cache either lives in a local
+directory (e.g. a persistent volume mounted into the task pod), where hits
+are materialized as reflinks, or copies where the filesystem cannot share
+extents, or under a prefix in the object store, where it spares repeated
+pulls from external source buckets. Local entries are read-only and never
+hardlinked, so a task's inputs stay writable and cannot alias the cache.
+Both stores evict least recently used entries once over their byte budget,
+and only ever delete entries they wrote.
+In the object store an entry's recency is the LastModified of a small
+access marker next to it, as entries over 5 GB cannot be copied onto
+themselves to refresh their own.
+
+(c) 2021 by latch.ai.
+"""
+
+import fcntl
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import threading
+from abc import ABC, abstractmethod
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+DEFAULT_MAX_BYTES = 100 * 1024**3
+ACCESS_FOLDER = ".access"
+# Entries are named by their sha256, anything else under the cache is not ours.
+ENTRY_NAME = re.compile(r"^[0-9a-f]{64}$")
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+
+class DownloadCache(ABC):
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.miss_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def digest(bucket: str, obj: Dict) -> str:
+        ident = "\0".join(
+            [bucket, obj["Key"], (obj.get("ETag") or "").strip('"'), str(obj["Size"])]
+        )
+        return hashlib.sha256(ident.encode("utf-8")).hexdigest()
+
+    def fetch(self, bucket: str, obj: Dict, dest: str) -> bool:
+        """
+        Materializes a cached copy of obj at dest. Returns False on a miss.
+        Safe to call from several threads at once.
+        """
+        if obj.get("ETag") is None:
+            found = False
+        else:
+            found = self._get(self.digest(bucket, obj), dest)
+        with self._lock:
+            if found:
+                self.hits += 1
+                self.hit_bytes += obj["Size"]
+            else:
+                self.misses += 1
+                self.miss_bytes += obj["Size"]
+        return found
+
+    def store(self, bucket: str, obj: Dict, path: str):
+        """Adds a freshly downloaded object to the cache."""
+        if obj.get("ETag") is None:
+            return
+        self._put(self.digest(bucket, obj), path)
+
+    def summary(self) -> str:
+        return (
+            f"Download cache: {self.hits} hits ({self.hit_bytes} bytes), "
+            f"{self.misses} misses ({self.miss_bytes} bytes)"
+        )
+
+    @abstractmethod
+    def _get(self, digest: str, dest: str) -> bool:
+        """Materializes the entry for digest at dest. Returns False on a miss."""
+
+    @abstractmethod
+    def _put(self, digest: str, path: str):
+        """Stores a copy of path as the entry for digest."""
+
+    @abstractmethod
+    def evict(self):
+        """Drops least recently used entries until the cache fits max_bytes."""
+
+
+class LocalDownloadCache(DownloadCache):
+    def __init__(self, root: str, max_bytes: int = DEFAULT_MAX_BYTES):
+        super().__init__(max_bytes)
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _entry(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _get(self, digest, dest):
+        entry = self._entry(digest)
+        try:
+            clone(entry, dest)
+        except FileNotFoundError:
+            return False
+        # mtime doubles as the LRU clock.
+        os.utime(entry)
+        return True
+
+    def _put(self, digest, path):
+        entry = self._entry(digest)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(entry), prefix=".")
+        os.close(fd)
+        clone(path, tmp)
+        # The entry's inode is the cache's alone; read-only, a stray write
+        # cannot poison it.
+        os.chmod(tmp, 0o444)
+        os.replace(tmp, entry)
+
+    def evict(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                if not ENTRY_NAME.match(filename) or path != self._entry(filename):
+                    continue
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class S3DownloadCache(DownloadCache):
+    def __init__(
+        self, bucket: str, prefix: str, client, max_bytes: int = DEFAULT_MAX_BYTES
+    ):
+        super().__init__(max_bytes)
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = client
+
+    def _entry(self, digest: str) -> str:
+        return f"{self.prefix}/{digest}" if self.prefix else digest
+
+    def _access_marker(self, digest: str) -> str:
+        return self._entry(f"{ACCESS_FOLDER}/{digest}")
+
+    def _get(self, digest, dest):
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.download_file(self.bucket, self._entry(digest), dest)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        # Rewriting the empty marker refreshes its LastModified, the LRU
+        # clock for this store, whatever the size of the entry.
+        self.client.put_object(
+            Bucket=self.bucket, Key=self._access_marker(digest), Body=b""
+        )
+        return True
+
+    def _put(self, digest, path):
+        self.client.upload_file(path, self.bucket, self._entry(digest))
+
+    def evict(self):
+        objects = []
+        accessed = {}
+        prefix = self.prefix + "/" if self.prefix else ""
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                digest = obj["Key"].rsplit("/", 1)[-1]
+                if not ENTRY_NAME.match(digest):
+                    continue
+                if obj["Key"] == self._access_marker(digest):
+                    accessed[digest] = obj["LastModified"]
+                elif obj["Key"] == self._entry(digest):
+                    objects.append((digest, obj))
+        entries = []
+        for digest, obj in objects:
+            last_used = max(
+                obj["LastModified"], accessed.get(digest, obj["LastModified"])
+            )
+            entries.append((last_used, obj["Size"], digest))
+        total = sum(size for _, size, _ in entries)
+        for _, size, digest in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.client.delete_object(Bucket=self.bucket, Key=self._entry(digest))
+            if digest in accessed:
+                self.client.delete_object(
+                    Bucket=self.bucket, Key=self._access_marker(digest)
+                )
+            total -= size
+
+
+def open_cache(
+    location: str, client, max_bytes: int = DEFAULT_MAX_BYTES
+) -> Optional[DownloadCache]:
+    """
+    params:
+    - location: local directory or s3://bucket/prefix URI; empty disables caching
+    - client: initialized s3 client object, used by object store caches
+    - max_bytes: LRU eviction budget
+    """
+    if not location:
+        return None
+    split_uri = urlparse(location)
+    if split_uri.scheme == "s3":
+        return S3DownloadCache(split_uri.netloc, split_uri.path, client, max_bytes)
+    return LocalDownloadCache(location, max_bytes)
+
+
+def link_or_clone(src: str, dest: str):
+    """Hardlinks src to dest, or clones it where it cannot be linked."""
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+        return
+    except FileNotFoundError:
+        raise
+    except OSError:
+        pass
+    clone(src, dest)
+
+
+def clone(src: str, dest: str):
+    """Copies src to dest, sharing its extents where the filesystem can."""
+    if os.path.lexists(dest):
+        os.remove(dest)
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdest:
+        try:
+            fcntl.ioctl(fdest.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            shutil.copyfileobj(fsrc, fdest, 1024 * 1024)
@@ -0,0 +1,632 @@
+"""
+Array-based candidate site identification, reproducing guideseq's identify.
+
+The tag-primed read (second of pair) of every alignment guideseq counts is
+loaded into one compact NumPy array per field: its chromosome, position,
+strand, tag primer, molecular barcode and consolidated read count. As in
+guideseq, a read's position is its start on the forward strand, or the end
+of its template on the reverse strand, and its primer is read from its
+first 20 bases. One sort of the reads then gives each position's distinct
+barcodes and total reads per strand and primer, instead of guideseq's
+per-position Counters, and windows are runs of positions at most
+WINDOW_SIZE apart, found with a vectorized scan and summed with reduceat.
+
+A window is a candidate site if it has molecules on both strands, or was
+amplified with both tag primers. Its reference sequence, FLANK bases either
+side of the position with the most molecules, is aligned to the sample's
+target with guideseq's fuzzy regular expressions, in batches across a
+process pool. The table written is guideseq's
+`identified/*_identifiedOfftargets.txt`: the same columns, windows merged
+when they align to the same target site, rows in the same order, and floats
+formatted as Python 2 prints them. test.py compares the two on the test
+dataset line for line.
+
+(c) 2021 by latch.ai.
+"""
+
+import multiprocessing
+import os
+import re
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+import regex
+
+from latch.reference import Reference
+
+MAPQ_THRESHOLD = 50
+# Positions further apart than this start a new window. guideseq hard-codes it.
+WINDOW_SIZE = 10
+# Bases either side of a window's position in its sequence, guideseq's
+# --window_size.
+FLANK = 25
+# Sites per task sent to the alignment pool.
+ALIGN_BATCH = 1024
+# guideseq's limit on an alignment's substitutions, a gap counting three.
+MAX_SCORE = 7
+IUPAC_REGEX = {
+    "N": "[ATCGN]",
+    "Y": "[CTY]",
+    "R": "[AGR]",
+    "W": "[ATW]",
+    "S": "[CGS]",
+    "A": "A",
+    "T": "T",
+    "C": "C",
+    "G": "G",
+}
+IUPAC_REGEX_EXTENDED = {**IUPAC_REGEX, "-": "[ATCGN]"}
+# The first bases of a read primed on either strand of the dsODN tag.
+PRIMERS = {b"TTGAGTTGTCATATGTTAAT": 1, b"ACATATGACAACTCAATTAA": 2}
+PRIMER_LENGTH = 20
+# consolidate names each read after its molecular barcode and read count.
+READ_NAME = re.compile(rb"([ACGTN]{8}_[ACGTN]{6}_[ACGTN]{6})_([0-9]*)")
+
+FLAG_REVERSE = 0x10
+FLAG_SECOND = 0x80
+FLAG_SUPPLEMENTARY = 0x800
+COMPLEMENT = bytes.maketrans(b"ACGTacgt", b"TGCATGCA")
+REVERSE_COMPLEMENT = str.maketrans("ACGTacgt", "TGCATGCA")
+
+COLUMNS = (
+    "#BED_Chromosome",
+    "BED_Min.Position",
+    "BED_Max.Position",
+    "BED_Name",
+    "Filename",
+    "WindowIndex",
+    "WindowChromosome",
+    "Position",
+    "WindowSequence",
+    "+.mi",
+    "-.mi",
+    "bi.sum.mi",
+    "bi.geometric_mean.mi",
+    "+.total",
+    "-.total",
+    "total.sum",
+    "total.geometric_mean",
+    "primer1.mi",
+    "primer2.mi",
+    "primer.geometric_mean",
+    "position.stdev",
+    "BED_Site_Name",
+    "BED_Score",
+    "BED_Site_Chromosome",
+    "Site_SubstitutionsOnly.Sequence",
+    "Site_SubstitutionsOnly.NumSubstitutions",
+    "Site_SubstitutionsOnly.Strand",
+    "Site_SubstitutionsOnly.Start",
+    "Site_SubstitutionsOnly.End",
+    "Site_GapsAllowed.Sequence",
+    "Site_GapsAllowed.Length",
+    "Site_GapsAllowed.Score",
+    "Site_GapsAllowed.Substitutions",
+    "Site_GapsAllowed.Insertions",
+    "Site_GapsAllowed.Deletions",
+    "Site_GapsAllowed.Strand",
+    "Site_GapsAllowed.Start",
+    "Site_GapsAllowed.End",
+    "Cell",
+    "Targetsite",
+    "TargetSequence",
+    "RealignedTargetSequence",
+)
+# Column whose counts are added up when windows merge into one site.
+MERGED_COUNT_COLUMN = COLUMNS.index("bi.sum.mi")
+
+
+class Reads(NamedTuple):
+    """
+    Counted reads, one entry each. Chromosomes index the sorted list of
+    names loaded with them, barcodes are numbered in order of appearance and
+    primers are 1 or 2, or 0 for neither.
+    """
+
+    chrom: np.ndarray
+    position: np.ndarray
+    reverse: np.ndarray
+    primer: np.ndarray
+    barcode: np.ndarray
+    count: np.ndarray
+
+
+class Positions(NamedTuple):
+    """Per-position counts, sorted by chromosome and position."""
+
+    chrom: np.ndarray
+    position: np.ndarray
+    plus_mi: np.ndarray
+    minus_mi: np.ndarray
+    plus_total: np.ndarray
+    minus_total: np.ndarray
+    primer1_mi: np.ndarray
+    primer2_mi: np.ndarray
+
+
+class Windows(NamedTuple):
+    """
+    Per-window sums over positions. first and end bound each window's
+    positions, and mode is the one with the most molecules.
+    """
+
+    index: np.ndarray
+    first: np.ndarray
+    end: np.ndarray
+    mode: np.ndarray
+    plus_mi: np.ndarray
+    minus_mi: np.ndarray
+    plus_total: np.ndarray
+    minus_total: np.ndarray
+    primer1_mi: np.ndarray
+    primer2_mi: np.ndarray
+
+
+def load_reads(
+    sam: str, mapq_threshold: int = MAPQ_THRESHOLD
+) -> Tuple[List[str], Reads]:
+    """
+    Reads every alignment guideseq counts from sam: the second read of its
+    pair, primary or secondary, with a mapping quality of at least
+    mapq_threshold and a template length. Returns the chromosome names and
+    the reads.
+
+    params:
+    - sam: SAM file or named pipe, read once
+    """
+    chroms, barcodes = {}, {}
+    columns = (array("l"), array("q"), array("b"), array("b"), array("q"), array("q"))
+    with open(sam, "rb") as f:
+        for line in f:
+            if line.startswith(b"@"):
+                continue
+            fields = line.split(b"\t", 11)
+            if len(fields) < 11:
+                continue
+            flag = int(fields[1])
+            if (
+                int(fields[4]) < mapq_threshold
+                or not flag & FLAG_SECOND
+                or flag & FLAG_SUPPLEMENTARY
+            ):
+                continue
+            template_length = int(fields[8])
+            if template_length == 0:
+                continue
+
+            match = READ_NAME.search(fields[0])
+            if match is None:
+                raise ValueError(
+                    f"{sam}: read {fields[0].decode()} is not named after its "
+                    "molecular barcode and read count"
+                )
+            seq = fields[9]
+            if flag & FLAG_REVERSE:
+                read_start = seq[-PRIMER_LENGTH:].translate(COMPLEMENT)[::-1]
+            else:
+                read_start = seq[:PRIMER_LENGTH]
+            if template_length < 0:
+                position = int(fields[7]) + abs(template_length) - 1
+            else:
+                position = int(fields[3])
+
+            chrom = fields[2].decode()
+            columns[0].append(chroms.setdefault(chrom, len(chroms)))
+            columns[1].append(position)
+            columns[2].append(template_length < 0)
+            columns[3].append(PRIMERS.get(read_start, 0))
+            columns[4].append(barcodes.setdefault(match.group(1), len(barcodes)))
+            columns[5].append(int(match.group(2)))
+
+    names = sorted(chroms)
+    rank = np.empty(len(names), dtype=np.int64)
+    rank[[chroms[name] for name in names]] = np.arange(len(names))
+    return names, Reads(
+        rank[np.frombuffer(columns[0], dtype=np.dtype(f"i{columns[0].itemsize}"))],
+        np.frombuffer(columns[1], dtype=np.int64),
+        np.frombuffer(columns[2], dtype=np.int8).astype(bool),
+        np.frombuffer(columns[3], dtype=np.int8),
+        np.frombuffer(columns[4], dtype=np.int64),
+        np.frombuffer(columns[5], dtype=np.int64),
+    )
+
+
+def count_positions(reads: Reads) -> Positions:
+    """
+    Molecules, distinct barcodes, and reads at each position, by strand,
+    and molecules by primer summed over both strands.
+    """
+    order = np.lexsort((reads.position, reads.chrom))
+    chrom, position = reads.chrom[order], reads.position[order]
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = (chrom[1:] != chrom[:-1]) | (position[1:] != position[:-1])
+    site = np.empty(len(order), dtype=np.int64)
+    site[order] = np.cumsum(new) - 1
+    n = int(new.sum())
+
+    strand = site * 2 + reads.reverse
+    mi = _distinct(strand, reads.barcode, 2 * n).reshape(n, 2)
+    total = np.bincount(strand, weights=reads.count, minlength=2 * n)
+    total = total.astype(np.int64).reshape(n, 2)
+    primed = reads.primer > 0
+    primer = (strand[primed] * 2) + reads.primer[primed] - 1
+    primer_mi = _distinct(primer, reads.barcode[primed], 4 * n).reshape(n, 2, 2)
+    primer_mi = primer_mi.sum(axis=1)
+
+    return Positions(
+        chrom=chrom[new],
+        position=position[new],
+        plus_mi=mi[:, 0],
+        minus_mi=mi[:, 1],
+        plus_total=total[:, 0],
+        minus_total=total[:, 1],
+        primer1_mi=primer_mi[:, 0],
+        primer2_mi=primer_mi[:, 1],
+    )
+
+
+def find_windows(positions: Positions, window_size: int = WINDOW_SIZE) -> Windows:
+    """
+    Groups positions into windows, breaking at each chromosome and wherever
+    two are more than window_size apart. Windows are numbered from 1 across
+    chromosomes. The mode of a window is the position with the most
+    molecules, the rightmost on ties.
+    """
+    n = len(positions.position)
+    new = np.ones(n, dtype=bool)
+    new[1:] = (positions.chrom[1:] != positions.chrom[:-1]) | (
+        np.diff(positions.position) > window_size
+    )
+    first = np.flatnonzero(new)
+    end = np.append(first[1:], n) if n else first
+    window = np.cumsum(new) - 1
+
+    molecules = positions.plus_mi + positions.minus_mi
+    by_molecules = np.lexsort((np.arange(n), molecules, window))
+    mode = by_molecules[end - 1]
+
+    def per_window(values):
+        return np.add.reduceat(values, first) if n else values
+
+    return Windows(
+        index=np.arange(1, len(first) + 1),
+        first=first,
+        end=end,
+        mode=mode,
+        plus_mi=per_window(positions.plus_mi),
+        minus_mi=per_window(positions.minus_mi),
+        plus_total=per_window(positions.plus_total),
+        minus_total=per_window(positions.minus_total),
+        primer1_mi=per_window(positions.primer1_mi),
+        primer2_mi=per_window(positions.primer2_mi),
+    )
+
+
+def flagged(windows: Windows) -> np.ndarray:
+    """Windows seen on both strands, or amplified with both primers."""
+    return ((windows.plus_mi > 0) & (windows.minus_mi > 0)) | (
+        (windows.primer1_mi > 0) & (windows.primer2_mi > 0)
+    )
+
+
+def _distinct(group: np.ndarray, barcode: np.ndarray, groups: int) -> np.ndarray:
+    """Distinct barcodes in each of groups, given each read's group."""
+    order = np.lexsort((barcode, group))
+    group, barcode = group[order], barcode[order]
+    new = np.ones(len(order), dtype=bool)
+    new[1:] = (group[1:] != group[:-1]) | (barcode[1:] != barcode[:-1])
+    return np.bincount(group[new], minlength=groups)
+
+
+def regex_from_sequence(
+    seq: str, indels: int = 1, errors: int = MAX_SCORE
+) -> Tuple[str, str]:
+    """
+    guideseq's fuzzy patterns for seq: substitutions only, and with up to
+    indels gaps, each costing three substitutions.
+    """
+    pattern = "(?b:" + "".join(IUPAC_REGEX[c] for c in seq.upper()) + ")"
+    return (
+        pattern + f"{{s<={errors}}}",
+        pattern + f"{{i<={indels},d<={indels},s<={errors},3i+3d+1s<={errors}}}",
+    )
+
+
+def extended_pattern(seq: str, indels: int = 1, errors: int = MAX_SCORE) -> str:
+    """The gapped pattern for a target with a gap, written -, in it."""
+    pattern = "".join(IUPAC_REGEX_EXTENDED[c] for c in seq)
+    return (
+        "(?b:"
+        + pattern
+        + ")"
+        + f"{{i<={indels},d<={indels},s<={errors},3i+3d+1s<={errors}}}"
+    )
+
+
+def realigned_sequences(target: str, match, errors: int = MAX_SCORE):
+    """
+    The target and off-target sequences of a gapped match, with - placed
+    where guideseq places the bulge, or (None, "") if no placement gives
+    the match's counts.
+    """
+    match_sequence = match.group()
+    substitutions, insertions, deletions = match.fuzzy_counts
+    realigned_fuzzy = (substitutions, max(0, insertions - 1), max(0, deletions - 1))
+
+    if insertions:  # DNA bulge
+        pam = target.index("N")
+        if pam > len(target) / 2:
+            targets = [target[: i + 1] + "-" + target[i + 1 :] for i in range(pam + 1)]
+        else:
+            targets = [target[:i] + "-" + target[i:] for i in range(pam, len(target))]
+    else:
+        targets = [target]
+
+    realigned_target, realigned_offtarget = None, ""
+    for seq in targets:
+        if deletions:  # RNA bulge
+            realignments = [
+                match_sequence[: i + 1] + "-" + match_sequence[i + 1 :]
+                for i in range(len(match_sequence) - 1)
+            ]
+            texts = [
+                match_sequence[: i + 1] + seq[i + 1] + match_sequence[i + 1 :]
+                for i in range(len(match_sequence) - 1)
+            ]
+        else:
+            realignments = texts = [match_sequence]
+        # guideseq passes errors as the indel limit here; kept for parity.
+        pattern = extended_pattern(seq, errors)
+        for text, realignment in zip(texts, realignments):
+            m = regex.search(pattern, text, regex.BESTMATCH)
+            if m and m.fuzzy_counts == realigned_fuzzy:
+                realigned_target, realigned_offtarget = seq, realignment
+    return realigned_target, realigned_offtarget
+
+
+def align_sequences(target: str, window: str, max_score: int = MAX_SCORE) -> list:
+    """
+    guideseq's alignment of target to either strand of window: the best
+    match with substitutions only, and the best with a bulge. Returns the
+    fields guideseq writes for them, "" where there is no match: sequence,
+    substitutions, strand, start and end of the first; sequence, length,
+    score, substitutions, insertions, deletions, strand, start and end of
+    the second; and the target realigned to it. Coordinates are within
+    window, on the strand matched.
+    """
+    window = window.upper()
+    standard, gapped = regex_from_sequence(target, errors=max_score)
+    strands = (("+", window), ("-", reverse_complement(window)))
+
+    lowest_mismatch = max_score + 1
+    chosen_m, strand_m = None, ""
+    for strand, text in strands:
+        m = regex.search(standard, text, regex.BESTMATCH)
+        if m is not None and m.fuzzy_counts[0] < lowest_mismatch:
+            chosen_m, strand_m, lowest_mismatch = m, strand, m.fuzzy_counts[0]
+
+    lowest_distance = 100
+    chosen_b, strand_b = None, ""
+    for strand, text in strands:
+        m = regex.search(gapped, text, regex.BESTMATCH)
+        if m is None:
+            continue
+        substitutions, insertions, deletions = m.fuzzy_counts
+        if insertions or deletions:
+            distance = substitutions + (insertions + deletions) * 3
+            edistance = substitutions + insertions + deletions
+            if distance < lowest_distance and edistance < lowest_mismatch:
+                chosen_b, strand_b, lowest_distance = m, strand, distance
+
+    if chosen_m:
+        unbulged = [
+            chosen_m.group(),
+            chosen_m.fuzzy_counts[0],
+            strand_m,
+            chosen_m.start(),
+            chosen_m.end(),
+        ]
+    else:
+        unbulged = ["", "", "", "", ""]
+
+    bulged = [""] * 6 + [strand_b, "", "", "none"]
+    if chosen_b:
+        realigned_target, bulged_sequence = realigned_sequences(
+            target, chosen_b, max_score
+        )
+        bulged[9] = realigned_target
+        if bulged_sequence:
+            substitutions, insertions, deletions = chosen_b.fuzzy_counts
+            bulged[:6] = [
+                bulged_sequence,
+                len(chosen_b.group()),
+                substitutions + (insertions + deletions) * 3,
+                substitutions,
+                insertions,
+                deletions,
+            ]
+            bulged[7:9] = [chosen_b.start(), chosen_b.end()]
+        else:
+            bulged[6] = ""
+    return unbulged + bulged
+
+
+def reverse_complement(seq: str) -> str:
+    return seq.translate(REVERSE_COMPLEMENT)[::-1]
+
+
+def align_sites(
+    sites: Sequence[str], target: str, max_score: int = MAX_SCORE, processes: int = 1
+) -> List[list]:
+    """
+    align_sequences for every site, in batches of ALIGN_BATCH spread over
+    processes. Results come back in the order of sites.
+    """
+    batches = [sites[i : i + ALIGN_BATCH] for i in range(0, len(sites), ALIGN_BATCH)]
+    if processes <= 1 or len(batches) <= 1:
+        return [a for batch in batches for a in _align_batch(target, batch, max_score)]
+    # Workers are started from a fork server, not forked from the task, so
+    # they inherit neither its threads nor its locks.
+    context = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+        results = pool.map(_align_batch, repeat(target), batches, repeat(max_score))
+        return [alignment for batch in results for alignment in batch]
+
+
+def _align_batch(target: str, sites: Sequence[str], max_score: int) -> List[list]:
+    return [align_sequences(target, site, max_score) for site in sites]
+
+
+def identify(
+    sam: str,
+    reference: str,
+    out_path: str,
+    sample: str,
+    target: Optional[str],
+    description: Optional[str],
+    mapq_threshold: int = MAPQ_THRESHOLD,
+    window_size: int = WINDOW_SIZE,
+    flank: int = FLANK,
+    max_score: int = MAX_SCORE,
+    processes: int = 1,
+) -> int:
+    """
+    Writes the sample's identified off-target table and returns its rows.
+
+    params:
+    - sam: the sample's alignment as SAM, or a named pipe streaming it
+    - reference: reference FASTA the alignment is against, read through its .fai
+    - out_path: table to write
+    - sample, target, description: the sample's manifest entry, written as
+      guideseq writes them, None as "None"
+    - processes: worker processes aligning candidate sites to the target
+    """
+    chroms, reads = load_reads(sam, mapq_threshold)
+    positions = count_positions(reads)
+    windows = find_windows(positions, window_size)
+    candidates = np.flatnonzero(flagged(windows))
+
+    summaries = []
+    for w in candidates:
+        first, end, mode = windows.first[w], windows.end[w], windows.mode[w]
+        plus, minus = int(windows.plus_mi[w]), int(windows.minus_mi[w])
+        plus_total = int(windows.plus_total[w])
+        minus_total = int(windows.minus_total[w])
+        primer1, primer2 = int(windows.primer1_mi[w]), int(windows.primer2_mi[w])
+        chrom = chroms[positions.chrom[mode]]
+        position = int(positions.position[mode])
+        bed_chrom = "chr" + chrom
+        # guideseq takes the deviation over the window's positions ordered by
+        # molecules, and the order changes the last bits of the float.
+        members = positions.position[first:end]
+        molecules = positions.plus_mi[first:end] + positions.minus_mi[first:end]
+        ordered = members[np.argsort(molecules, kind="stable")]
+        summaries.append(
+            [
+                int(windows.index[w]),
+                chrom,
+                position,
+                None,
+                bed_chrom,
+                int(members.min()),
+                int(members.max()),
+                f"{bed_chrom}_{position}_{plus + minus}",
+                plus,
+                minus,
+                plus + minus,
+                _py2_str((plus * minus) ** 0.5),
+                plus_total,
+                minus_total,
+                plus_total + minus_total,
+                _py2_str((plus_total * minus_total) ** 0.5),
+                primer1,
+                primer2,
+                _py2_str((primer1 * primer2) ** 0.5),
+                repr(float(np.std(ordered))),
+            ]
+        )
+    with Reference(reference) as genome:
+        sequences = genome.fetch_many(
+            (row[1], row[2] - flank, row[2] + flank) for row in summaries
+        )
+    for row, sequence in zip(summaries, sequences):
+        row[3] = sequence.decode()
+    summaries = [[str(value) for value in row] for row in summaries]
+
+    if target:
+        alignments = align_sites(
+            [row[3] for row in summaries], target, max_score, processes
+        )
+    else:
+        alignments = [None] * len(summaries)
+
+    filename = os.path.basename(sam)
+    annotation = [str(description), str(sample), str(target)]
+    sites = {}
+    for row, alignment in zip(summaries, alignments):
+        key, line = _site_line(row, alignment, filename, annotation, flank)
+        if key in sites:
+            merged = int(line[MERGED_COUNT_COLUMN])
+            merged += int(sites[key][MERGED_COUNT_COLUMN])
+            sites[key][MERGED_COUNT_COLUMN] = str(merged)
+        else:
+            sites[key] = line
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+    with open(out_path, "w") as f:
+        f.write("\t".join(COLUMNS) + "\n")
+        for key in sorted(sites):
+            f.write("\t".join(str(value) for value in sites[key]) + "\n")
+    return len(sites)
+
+
+def _site_line(
+    row: List[str], alignment: Optional[list], filename: str, annotation, flank: int
+) -> Tuple[str, list]:
+    """
+    A window's line of the table, and the key guideseq merges lines under:
+    the span of its target site, or of the window if it has none.
+    """
+    window_chrom, window_start, window_end, bed_name = row[4:8]
+    line = row[4:8] + [filename] + row[0:4] + row[8:]
+    if alignment is None:
+        line += [""] * 17 + annotation + ["none"]
+        return f"{window_chrom}_{window_start}_{window_end}", line
+
+    sequence, mismatches, strand, start, end = alignment[:5]
+    bulged = alignment[5:11]
+    bulged_strand, bulged_start, bulged_end, realigned = alignment[11:]
+    position = int(row[2])
+    spans = []
+    for site_strand, site_start, site_end in (
+        (strand, start, end),
+        (bulged_strand, bulged_start, bulged_end),
+    ):
+        if site_strand == "+":
+            spans.append((site_start + position - flank, site_end + position - flank))
+        elif site_strand == "-":
+            spans.append((position + flank - site_end, position + flank - site_start))
+        else:
+            spans.append(("", ""))
+    site_chrom, bed_score = window_chrom, 1
+    if not (strand or bulged_strand):
+        site_chrom, bed_score, bed_name = "", "", ""
+    line += [bed_name, bed_score, site_chrom, sequence, mismatches, strand]
+    line += list(spans[0]) + [*bulged, bulged_strand, *spans[1]]
+    line += annotation + [realigned]
+
+    found = [span for span in spans if span[0] != ""]
+    if not found:
+        return f"{window_chrom}_{window_start}_{window_end}", line
+    start = min(span[0] for span in found)
+    end = max(span[1] for span in found)
+    return f"{window_chrom}_{start}_{end}", line
+
+
+def _py2_str(value: float) -> str:
+    """A float as Python 2's str prints it: 12 significant digits."""
+    text = f"{value:.12g}"
+    return text if any(c in text for c in ".en") else text + ".0"
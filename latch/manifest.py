@@ -0,0 +1,75 @@
+"""
+Helpers for reading a guideseq manifest and mapping the files it references
+back onto objects under the task's input_dir prefix.
+
+(c) 2021 by latch.ai.
+"""
+
+import os
+from typing import Dict, List
+
+READ_FIELDS = ("forward", "reverse", "index1", "index2")
+BWA_INDEX_SUFFIXES = (".amb", ".ann", ".bwt", ".pac", ".sa")
+
+
+def load_manifest(path: str) -> Dict:
+    import yaml
+
+    with open(path, "r") as f:
+        return yaml.safe_load(f)
+
+
+def referenced_paths(data: Dict, skip_demultiplex: bool = False) -> List[str]:
+    """Local paths, as written in the manifest, that the pipeline will read.
+
+    params:
+    - data: parsed manifest
+    - skip_demultiplex: read the per-sample `demultiplexed` block instead of
+      the pooled `undemultiplexed` one
+    """
+    if "reference_genome" not in data:
+        raise ValueError("Manifest is missing required field 'reference_genome'")
+    paths = [data["reference_genome"]]
+
+    if skip_demultiplex:
+        samples = data.get("demultiplexed")
+        if not samples:
+            raise ValueError(
+                "Manifest is missing the 'demultiplexed' block required by skip_demultiplex"
+            )
+        reads = list(samples.values())
+    else:
+        if "undemultiplexed" not in data:
+            raise ValueError("Manifest is missing required field 'undemultiplexed'")
+        reads = [data["undemultiplexed"]]
+
+    for fields in reads:
+        for field in READ_FIELDS:
+            if not fields.get(field):
+                raise ValueError(f"Manifest read block is missing '{field}'")
+            paths.append(fields[field])
+    return paths
+
+
+def reference_companion_paths(reference: str) -> List[str]:
+    """Prebuilt bwa/faidx index files that may sit next to the reference."""
+    return [reference + suffix for suffix in BWA_INDEX_SUFFIXES + (".fai",)]
+
+
+def path_to_key(path: str, local_dir: str, prefix: str) -> str:
+    """Maps a manifest path onto the s3 key it was downloaded from.
+
+    params:
+    - path: path as written in the manifest, relative to the working directory
+    - local_dir: local folder the input_dir prefix is mirrored into
+    - prefix: s3 key prefix of input_dir
+    """
+    rel = os.path.relpath(
+        os.path.normpath(os.path.join(os.getcwd(), path)),
+        os.path.normpath(local_dir),
+    )
+    if rel == os.curdir or rel.split(os.sep)[0] == os.pardir:
+        raise ValueError(
+            f"Manifest path '{path}' is outside of the input directory '{local_dir}'"
+        )
+    return prefix + "/" + rel.replace(os.sep, "/")
@@ -0,0 +1,224 @@
+"""
+Columnar copy of a run's off-target tables for querying across runs.
+
+Every sample's identified/ table is read into one Parquet table, sorted by
+chromosome and position so that the row-group statistics on those columns
+let readers skip everything outside a region. The rows carry the identify
+columns under their original names. Each row leads with its sample, its
+target and whether the site survived background filtering. A second,
+small table indexes the samples: their target, their number of sites and
+the row groups holding them, so a per-sample or per-target query reads
+only those row groups.
+
+    offtargets/sites.parquet     one row per identified site
+    offtargets/samples.parquet   one row per sample
+
+(c) 2021 by latch.ai.
+"""
+
+import os
+from typing import Dict, Optional
+
+from latch.control_cache import CONTROL
+from latch.pipeline import identified_path
+
+DATASET_FOLDER = "offtargets"
+SITES_FILE = "sites.parquet"
+SAMPLES_FILE = "samples.parquet"
+ROW_GROUP_ROWS = 64 * 1024
+COMPRESSION = "zstd"
+# Identify columns with numeric values; every other column is a string.
+INT_COLUMNS = (
+    "BED_Min.Position",
+    "BED_Max.Position",
+    "WindowIndex",
+    "Position",
+    "+.mi",
+    "-.mi",
+    "bi.sum.mi",
+    "+.total",
+    "-.total",
+    "total.sum",
+    "primer1.mi",
+    "primer2.mi",
+    "BED_Score",
+    "Site_SubstitutionsOnly.NumSubstitutions",
+    "Site_SubstitutionsOnly.Start",
+    "Site_SubstitutionsOnly.End",
+    "Site_GapsAllowed.Length",
+    "Site_GapsAllowed.Score",
+    "Site_GapsAllowed.Substitutions",
+    "Site_GapsAllowed.Insertions",
+    "Site_GapsAllowed.Deletions",
+    "Site_GapsAllowed.Start",
+    "Site_GapsAllowed.End",
+)
+FLOAT_COLUMNS = (
+    "bi.geometric_mean.mi",
+    "total.geometric_mean",
+    "primer.geometric_mean",
+    "position.stdev",
+)
+SORT_COLUMNS = ("WindowChromosome", "Position")
+# Fields of a table line that identify a site in both identified/ and filtered/.
+SITE_KEY_FIELDS = 4
+
+
+def filtered_path(output_folder: str, sample: str) -> str:
+    return os.path.join(output_folder, "filtered", f"{sample}_backgroundFiltered.txt")
+
+
+def write_offtargets(
+    output_folder: str, samples: Dict[str, Dict], row_group_rows: int = ROW_GROUP_ROWS
+) -> Optional[str]:
+    """
+    Writes the dataset under output_folder and returns its folder, or None if
+    no sample has an identified table.
+
+    params:
+    - output_folder: shared output folder holding identified/ and filtered/
+    - samples: the manifest's samples block
+    - row_group_rows: rows per Parquet row group
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    header = None
+    columns = {}
+    for sample, fields in samples.items():
+        path = identified_path(output_folder, sample)
+        if not os.path.isfile(path):
+            continue
+        sample_header, rows = _read_table(path)
+        if header is None:
+            header = sample_header
+            columns = {"sample": [], "target": [], "background_filtered": []}
+            columns.update((name, []) for name in header)
+        elif sample_header != header:
+            raise ValueError(f"{path} has different columns than the other samples")
+
+        passed = None
+        if sample != CONTROL and os.path.isfile(filtered_path(output_folder, sample)):
+            _, filtered = _read_table(filtered_path(output_folder, sample))
+            passed = {tuple(row[:SITE_KEY_FIELDS]) for row in filtered}
+        for row in rows:
+            columns["sample"].append(sample)
+            columns["target"].append(fields.get("target") or None)
+            columns["background_filtered"].append(
+                None if passed is None else tuple(row[:SITE_KEY_FIELDS]) in passed
+            )
+            for name, value in zip(header, row):
+                columns[name].append(value)
+    if header is None:
+        return None
+
+    arrays = []
+    schema = [
+        pa.field("sample", pa.string()),
+        pa.field("target", pa.string()),
+        pa.field("background_filtered", pa.bool_()),
+    ]
+    for name in header:
+        if name in INT_COLUMNS:
+            schema.append(pa.field(name, pa.int64()))
+        elif name in FLOAT_COLUMNS:
+            schema.append(pa.field(name, pa.float64()))
+        else:
+            schema.append(pa.field(name, pa.string()))
+    for field in schema:
+        values = columns[field.name]
+        if pa.types.is_integer(field.type):
+            values = [_parse(v, _int) for v in values]
+        elif pa.types.is_floating(field.type):
+            values = [_parse(v, float) for v in values]
+        elif field.name in header:
+            values = [v if v != "" else None for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    table = pa.Table.from_arrays(arrays, schema=pa.schema(schema))
+    sort_keys = [c for c in SORT_COLUMNS if c in header] + ["sample"]
+    table = table.sort_by([(c, "ascending") for c in sort_keys])
+
+    out_dir = os.path.join(output_folder, DATASET_FOLDER)
+    os.makedirs(out_dir, exist_ok=True)
+    pq.write_table(
+        table,
+        os.path.join(out_dir, SITES_FILE),
+        row_group_size=row_group_rows,
+        compression=COMPRESSION,
+        write_statistics=True,
+        write_page_index=True,
+        sorting_columns=[
+            pq.SortingColumn(table.schema.get_field_index(c)) for c in sort_keys
+        ],
+    )
+
+    index = {}
+    for row, (sample, passed) in enumerate(
+        zip(
+            table.column("sample").to_pylist(),
+            table.column("background_filtered").to_pylist(),
+        )
+    ):
+        entry = index.setdefault(sample, {"sites": 0, "passed": 0, "row_groups": []})
+        entry["sites"] += 1
+        entry["passed"] += bool(passed)
+        group = row // row_group_rows
+        if not entry["row_groups"] or entry["row_groups"][-1] != group:
+            entry["row_groups"].append(group)
+    names = sorted(index)
+    samples_table = pa.table(
+        {
+            "sample": pa.array(names, pa.string()),
+            "target": pa.array(
+                [samples[s].get("target") or None for s in names], pa.string()
+            ),
+            "description": pa.array(
+                [samples[s].get("description") or None for s in names], pa.string()
+            ),
+            "sites": pa.array([index[s]["sites"] for s in names], pa.int64()),
+            "background_filtered_sites": pa.array(
+                [index[s]["passed"] for s in names], pa.int64()
+            ),
+            "row_groups": pa.array(
+                [index[s]["row_groups"] for s in names], pa.list_(pa.int32())
+            ),
+        }
+    )
+    pq.write_table(
+        samples_table, os.path.join(out_dir, SAMPLES_FILE), compression=COMPRESSION
+    )
+    print(
+        f"Wrote {table.num_rows} off-target sites of {len(names)} samples "
+        f"to {out_dir}, sorted by {', '.join(sort_keys)}"
+    )
+    return out_dir
+
+
+def _read_table(path: str):
+    """Header and rows of a tab separated table, rows padded to the header."""
+    with open(path) as f:
+        header = None
+        rows = []
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            if header is None and line.startswith("#"):
+                header = fields
+                continue
+            if not line.strip():
+                continue
+            rows.append(fields)
+    header = header or []
+    width = len(header)
+    return header, [row + [""] * (width - len(row)) for row in rows]
+
+
+def _int(value: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        # python2 identify may write whole numbers as floats.
+        return int(float(value))
+
+
+def _parse(value: str, convert):
+    return None if value == "" else convert(value)
@@ -0,0 +1,230 @@
+"""
+Command builders for the individual steps of guideseq.py.
+
+Every step writes below a shared output folder using the layout of
+`guideseq.py all`, so outputs from steps run on different nodes can be
+merged back into one `guideseq_outputs` directory.
+
+(c) 2021 by latch.ai.
+"""
+
+import logging
+import logging.handlers
+import os
+import subprocess
+import sys
+from collections import deque
+from typing import Dict, List
+
+GUIDESEQ = "guideseq/guideseq/guideseq.py"
+READ_ENDS = ("r1", "r2", "i1", "i2")
+
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_BACKUPS = 3
+TAIL_LINES = 50
+
+
+def run(cmd: List[str], log_path: str, tail_lines: int = TAIL_LINES):
+    """
+    Runs cmd with stdout and stderr merged and streamed line by line to the
+    task log and to a rotating log file, keeping only the last tail_lines in
+    memory. Raises with that tail if cmd exits non-zero.
+
+    params:
+    - cmd: command to run
+    - log_path: rotating log file, created along with its folder
+    - tail_lines: lines of output included in the error
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(log_path)), exist_ok=True)
+    handler = logging.handlers.RotatingFileHandler(
+        log_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS
+    )
+    tail = deque(maxlen=tail_lines)
+
+    print("Guideseq Command: " + " ".join(cmd), flush=True)
+    try:
+        with subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            errors="replace",
+            bufsize=1,
+        ) as proc:
+            for line in proc.stdout:
+                line = line.rstrip("\n")
+                sys.stdout.write(line + "\n")
+                sys.stdout.flush()
+                handler.emit(logging.makeLogRecord({"msg": line}))
+                tail.append(line)
+    finally:
+        handler.close()
+
+    if proc.returncode != 0:
+        raise RuntimeError(
+            f"{' '.join(cmd)} exited with code {proc.returncode}. "
+            f"Last {len(tail)} lines of output:\n" + "\n".join(tail)
+        )
+
+
+def guideseq_cmd(step: str) -> List[str]:
+    # Unbuffered, so progress reaches the streamed task log as it happens.
+    return ["python2.7", "-u", GUIDESEQ, step]
+
+
+def _fastq_ext(compressed: bool) -> str:
+    return ".fastq.gz" if compressed else ".fastq"
+
+
+def demultiplexed_paths(
+    output_folder: str, sample: str, compressed: bool = False
+) -> Dict[str, str]:
+    return {
+        end: os.path.join(
+            output_folder, "demultiplexed", f"{sample}.{end}{_fastq_ext(compressed)}"
+        )
+        for end in READ_ENDS
+    }
+
+
+def umitagged_paths(
+    output_folder: str, sample: str, compressed: bool = False
+) -> Dict[str, str]:
+    return {
+        end: os.path.join(
+            output_folder,
+            "umitagged",
+            f"{sample}.{end}.umitagged{_fastq_ext(compressed)}",
+        )
+        for end in ("r1", "r2")
+    }
+
+
+def consolidated_paths(
+    output_folder: str, sample: str, compressed: bool = False
+) -> Dict[str, str]:
+    return {
+        end: os.path.join(
+            output_folder,
+            "consolidated",
+            f"{sample}.{end}.consolidated{_fastq_ext(compressed)}",
+        )
+        for end in ("r1", "r2")
+    }
+
+
+def aligned_path(output_folder: str, sample: str, compressed: bool = False) -> str:
+    ext = ".bam" if compressed else ".sam"
+    return os.path.join(output_folder, "aligned", f"{sample}{ext}")
+
+
+def identified_path(output_folder: str, sample: str) -> str:
+    return os.path.join(
+        output_folder, "identified", f"{sample}_identifiedOfftargets.txt"
+    )
+
+
+def demultiplex_cmd(manifest: str) -> List[str]:
+    return guideseq_cmd("demultiplex") + ["-m", manifest]
+
+
+def umitag_cmd(reads: Dict[str, str], output_folder: str) -> List[str]:
+    """
+    params:
+    - reads: demultiplexed read paths keyed by r1/r2/i1/i2
+    - output_folder: shared output folder
+    """
+    return guideseq_cmd("umitag") + [
+        "--read1",
+        reads["r1"],
+        "--read2",
+        reads["r2"],
+        "--index1",
+        reads["i1"],
+        "--index2",
+        reads["i2"],
+        "--outfolder",
+        output_folder,
+    ]
+
+
+def consolidate_cmd(
+    output_folder: str, sample: str, compressed: bool = False
+) -> List[str]:
+    umitagged = umitagged_paths(output_folder, sample, compressed)
+    return guideseq_cmd("consolidate") + [
+        "--read1",
+        umitagged["r1"],
+        "--read2",
+        umitagged["r2"],
+        "--outfolder",
+        output_folder,
+    ]
+
+
+def align_cmd(
+    bwa: str, genome: str, output_folder: str, sample: str, compressed: bool = False
+) -> List[str]:
+    consolidated = consolidated_paths(output_folder, sample, compressed)
+    return guideseq_cmd("align") + [
+        "--bwa",
+        bwa,
+        "--genome",
+        genome,
+        "--read1",
+        consolidated["r1"],
+        "--read2",
+        consolidated["r2"],
+        "--outfolder",
+        output_folder,
+    ]
+
+
+def identify_cmd(
+    genome: str,
+    output_folder: str,
+    sample: str,
+    target: str,
+    description: str,
+    aligned: str = None,
+) -> List[str]:
+    """
+    params:
+    - aligned: SAM to read, defaults to the one align wrote for sample
+    """
+    return guideseq_cmd("identify") + [
+        "--aligned",
+        aligned or aligned_path(output_folder, sample),
+        "--genome",
+        genome,
+        "--outfolder",
+        output_folder,
+        "--target_sequence",
+        target or "",
+        "--description",
+        description or "",
+    ]
+
+
+def filter_cmd(bedtools: str, output_folder: str, sample: str) -> List[str]:
+    return guideseq_cmd("filter") + [
+        "--bedtools",
+        bedtools,
+        "--identified",
+        identified_path(output_folder, sample),
+        "--background",
+        identified_path(output_folder, "control"),
+        "--outfolder",
+        output_folder,
+    ]
+
+
+def visualize_cmd(output_folder: str, sample: str) -> List[str]:
+    return guideseq_cmd("visualize") + [
+        "--infile",
+        identified_path(output_folder, sample),
+        "--outfolder",
+        output_folder,
+        "--title",
+        sample,
+    ]
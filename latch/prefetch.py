@@ -0,0 +1,76 @@
+"""
+Fetches the task's inputs in the background, in the order the pipeline
+needs them.
+
+Inputs are split into named groups, such as the reads the first stage
+consumes and the reference only align needs. The groups are fetched one
+after another on a single thread, so the first group gets the whole
+transfer pool. The pipeline starts as soon as that group has arrived,
+and each later stage waits only on the group it reads.
+
+(c) 2021 by latch.ai.
+"""
+
+import threading
+from typing import Callable, List, Optional, Tuple
+
+
+class Prefetch:
+    """
+    Context manager that fetches groups of inputs on a background thread.
+    On exit, groups not yet started are skipped, and the one in flight is
+    waited for so that no download outlives the task.
+
+    params:
+    - groups: (name, fetch) pairs in the order to fetch them, where fetch
+      takes no arguments and returns once the group is on local disk
+    """
+
+    def __init__(self, groups: List[Tuple[str, Callable[[], None]]]):
+        self.groups = groups
+        self._ready = {name: threading.Event() for name, _ in groups}
+        self._fetched = set()
+        self._error: Optional[BaseException] = None
+        self._failed: Optional[str] = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._fetch_all, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def ready(self, name: str) -> bool:
+        return name in self._fetched
+
+    def wait(self, name: str):
+        """
+        Blocks until group name is local. Raises if the prefetch failed on
+        this group or on one before it.
+        """
+        self._ready[name].wait()
+        if name not in self._fetched:
+            reason = "" if self._failed == name else f" after '{self._failed}' failed"
+            raise RuntimeError(
+                f"Fetching inputs '{name}' failed{reason}"
+            ) from self._error
+
+    def _fetch_all(self):
+        try:
+            for name, fetch in self.groups:
+                if self._stop.is_set():
+                    break
+                self._failed = name
+                fetch()
+                self._fetched.add(name)
+                self._ready[name].set()
+        except BaseException as e:
+            self._error = e
+        finally:
+            # Releases every waiter, who then find out whether their group came.
+            for event in self._ready.values():
+                event.set()
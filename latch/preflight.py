@@ -0,0 +1,356 @@
+"""
+Pre-flight checks of a guideseq run, made before anything is downloaded.
+
+The manifest is schema-checked. Every object it references is stat'ed
+with concurrent HEAD requests. Sample barcodes are compared the way
+demultiplex matches them. Every problem found is reported at once, so a
+typo costs seconds instead of a download and part of a run.
+
+A run that passes gets a plan. The plan holds the bytes the run will
+read and the number of reads in each sample, estimated from the first
+block of each FASTQ. It also holds the tier the task will be sized to.
+
+(c) 2021 by latch.ai.
+"""
+
+import itertools
+import re
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from latch.control_cache import CONTROL
+from latch.demultiplex import build_lookup, sample_barcode
+from latch.manifest import READ_FIELDS, reference_companion_paths
+from latch.pipeline import aligned_path
+from latch.resources import plan_tier
+from latch.s3_dir_download import DEFAULT_CONCURRENCY, get_s3_client, head_objects
+
+# Bytes read from the start of each FASTQ to estimate its number of reads.
+SAMPLE_BYTES = 1024 * 1024
+BARCODE = re.compile(r"^[ACGTN]{8,}$")
+TARGET = re.compile(r"^[ACGTRYSWKMBDHVN]*$")
+KNOWN_FIELDS = {
+    "reference_genome",
+    "output_folder",
+    "bwa",
+    "bedtools",
+    "PAM",
+    "demultiplex_min_reads",
+    "undemultiplexed",
+    "demultiplexed",
+    "samples",
+}
+
+
+class PreflightError(ValueError):
+    """Raised with every problem found in a run's manifest and inputs."""
+
+    def __init__(self, problems: List[str]):
+        self.problems = problems
+        super().__init__(
+            f"{len(problems)} problem(s) with the run:\n"
+            + "\n".join(f"- {p}" for p in problems)
+        )
+
+
+def check_manifest(
+    data,
+    skip_demultiplex: bool = False,
+    max_mismatches: int = 0,
+    identify_and_filter: bool = False,
+) -> Tuple[List[str], List[str]]:
+    """
+    Schema and barcode checks of a parsed manifest. Returns its errors and
+    warnings.
+
+    params:
+    - data: manifest as parsed by a safe loader
+    - skip_demultiplex: the run reads the per-sample `demultiplexed` block
+    - max_mismatches: substitutions demultiplex tolerates per index barcode
+    - identify_and_filter: the run reads each sample's alignment under
+      `output_folder` instead of any reads
+    """
+    if not isinstance(data, dict):
+        return ["Manifest must be a mapping of fields"], []
+    errors = []
+    warnings = [
+        f"Unknown manifest field '{k}' is ignored"
+        for k in data
+        if k not in KNOWN_FIELDS
+    ]
+
+    if not _nonempty_str(data.get("reference_genome")):
+        errors.append("'reference_genome' must be the path of the reference FASTA")
+    for field in ("bwa", "bedtools", "PAM"):
+        if field in data and not _nonempty_str(data[field]):
+            errors.append(f"'{field}' must be a non-empty string")
+    min_reads = data.get("demultiplex_min_reads", 0)
+    if not isinstance(min_reads, int) or isinstance(min_reads, bool) or min_reads < 0:
+        errors.append("'demultiplex_min_reads' must be a non-negative integer")
+
+    samples = data.get("samples")
+    if not isinstance(samples, dict) or not samples:
+        errors.append("'samples' must map sample names to their barcodes")
+        samples = {}
+    elif CONTROL not in samples:
+        errors.append(f"'samples' must contain a '{CONTROL}' sample")
+    elif len(samples) < 2:
+        errors.append(f"'samples' needs at least one sample besides '{CONTROL}'")
+
+    valid = {}
+    for sample, fields in samples.items():
+        if not isinstance(fields, dict):
+            errors.append(f"Sample '{sample}' must be a mapping of fields")
+            continue
+        ok = True
+        for field in ("barcode1", "barcode2"):
+            if not isinstance(fields.get(field), str) or not BARCODE.match(
+                fields[field]
+            ):
+                errors.append(
+                    f"Sample '{sample}' {field} must be at least 8 bases of ACGTN"
+                )
+                ok = False
+        target = fields.get("target")
+        if target is not None and (
+            not isinstance(target, str) or not TARGET.match(target)
+        ):
+            errors.append(f"Sample '{sample}' target must be a nucleotide sequence")
+        if ok:
+            valid[sample] = fields
+    errors.extend(_barcode_collisions(valid))
+    warnings.extend(_barcode_neighbours(valid, max_mismatches))
+
+    if identify_and_filter:
+        if not _nonempty_str(data.get("output_folder")):
+            errors.append(
+                "identify_and_filter needs the 'output_folder' holding aligned/"
+            )
+    elif skip_demultiplex:
+        blocks = data.get("demultiplexed")
+        if not isinstance(blocks, dict):
+            errors.append("skip_demultiplex needs a 'demultiplexed' block per sample")
+            blocks = {}
+        for sample in samples:
+            if sample not in blocks:
+                errors.append(f"'demultiplexed' has no reads for sample '{sample}'")
+            else:
+                errors.extend(_check_reads(blocks[sample], f"demultiplexed.{sample}"))
+    else:
+        errors.extend(_check_reads(data.get("undemultiplexed"), "undemultiplexed"))
+    return errors, warnings
+
+
+def plan_run(
+    data: Dict,
+    keys: Dict[str, str],
+    bucket: str,
+    optional_keys: Optional[Dict[str, str]] = None,
+    skip_demultiplex: bool = False,
+    max_mismatches: int = 0,
+    identify_and_filter: bool = False,
+    cpu: int = 0,
+    memory_gb: int = 0,
+    client=None,
+    concurrency: int = DEFAULT_CONCURRENCY,
+) -> Dict:
+    """
+    Stats a checked manifest's inputs and returns the run's plan. Raises
+    PreflightError listing every missing input.
+
+    params:
+    - data: manifest that passed check_manifest
+    - keys: s3 key of every path the manifest references, see input_paths
+    - bucket: bucket holding the keys
+    - optional_keys: s3 key of paths that are used if they exist, such as a
+      prebuilt index next to the reference
+    - identify_and_filter: the inputs are alignments, no reads are estimated
+    - cpu, memory_gb: explicit requests that override the planned tier
+    - client: s3 client, the shared one if omitted
+    """
+    client = client or get_s3_client()
+    optional_keys = {p: k for p, k in (optional_keys or {}).items() if p not in keys}
+    all_keys = {**optional_keys, **keys}
+    paths = list(all_keys)
+    # One batch of concurrent HEADs covers required and optional inputs.
+    stats = dict(
+        zip(
+            paths,
+            head_objects([all_keys[p] for p in paths], bucket, client, concurrency),
+        )
+    )
+    missing = [p for p in keys if stats[p] is None]
+    if missing:
+        raise PreflightError(
+            [f"Input does not exist: s3://{bucket}/{keys[p]} ({p})" for p in missing]
+        )
+
+    reference = data["reference_genome"]
+    companions = [p for p in optional_keys if stats[p] is not None]
+    fastq_bytes = sum(stats[p]["Size"] for p in keys if p != reference)
+    reference_bytes = stats[reference]["Size"]
+
+    def head(path: str) -> bytes:
+        return client.get_object(
+            Bucket=bucket, Key=keys[path], Range=f"bytes=0-{SAMPLE_BYTES - 1}"
+        )["Body"].read()
+
+    reads = {}
+    if skip_demultiplex and not identify_and_filter:
+        for sample in data["samples"]:
+            path = data["demultiplexed"][sample]["forward"]
+            reads[sample] = estimate_reads(head(path), stats[path]["Size"])[0]
+    elif not identify_and_filter:
+        block = data["undemultiplexed"]
+        path = block["forward"]
+        total, _ = estimate_reads(head(path), stats[path]["Size"])
+        _, index1 = estimate_reads(
+            head(block["index1"]), stats[block["index1"]]["Size"]
+        )
+        _, index2 = estimate_reads(
+            head(block["index2"]), stats[block["index2"]]["Size"]
+        )
+        reads = sample_shares(data["samples"], index1, index2, max_mismatches, total)
+
+    tier = plan_tier(fastq_bytes, reference_bytes, cpu, memory_gb)
+    return {
+        "input_bytes": fastq_bytes
+        + reference_bytes
+        + sum(stats[p]["Size"] for p in companions),
+        "fastq_bytes": fastq_bytes,
+        "reference_bytes": reference_bytes,
+        "prebuilt_index": len(companions) == len(reference_companion_paths(reference)),
+        "estimated_reads": reads,
+        "tier": {"name": tier.name, "cpu": tier.cpu, "memory_gb": tier.memory_gb},
+    }
+
+
+def input_paths(
+    data: Dict, skip_demultiplex: bool = False, identify_and_filter: bool = False
+) -> List[str]:
+    """
+    Every path a checked manifest references. With identify_and_filter that
+    is the reference and the aligned SAM of each sample, which guideseq reads
+    from `output_folder/aligned/`.
+    """
+    paths = [data["reference_genome"]]
+    if identify_and_filter:
+        folder = data["output_folder"]
+        return paths + [aligned_path(folder, sample) for sample in data["samples"]]
+    if skip_demultiplex:
+        blocks = [data["demultiplexed"][sample] for sample in data["samples"]]
+    else:
+        blocks = [data["undemultiplexed"]]
+    for block in blocks:
+        paths.extend(block[field] for field in READ_FIELDS)
+    return list(dict.fromkeys(paths))
+
+
+def estimate_reads(head: bytes, size: int) -> Tuple[int, List[bytes]]:
+    """
+    Estimates the reads in a FASTQ of size bytes from its first bytes, gzip
+    compressed or not. Also returns the sequences of the complete records in
+    head.
+    """
+    text, ratio = _inflate(head)
+    lines = text.split(b"\n")
+    records = (len(lines) - 1) // 4
+    if records == 0:
+        return 0, []
+    record_bytes = sum(len(line) + 1 for line in lines[: 4 * records])
+    return round(size / (record_bytes / records * ratio)), lines[1 : 4 * records : 4]
+
+
+def sample_shares(
+    samples: Dict,
+    index1: List[bytes],
+    index2: List[bytes],
+    max_mismatches: int,
+    total: int,
+) -> Dict[str, int]:
+    """
+    Splits an estimated total of pooled reads across samples by matching a
+    sample of index reads as demultiplex does. Unmatched reads count as
+    `undetermined`.
+    """
+    lookup = build_lookup(
+        {sample_barcode(fields): sample for sample, fields in samples.items()},
+        max_mismatches,
+    )
+    counts = dict.fromkeys(list(samples) + ["undetermined"], 0)
+    for i1, i2 in zip(index1, index2):
+        counts[lookup.get(i1[1:8] + i2[1:8], "undetermined")] += 1
+    seen = sum(counts.values())
+    return {s: round(total * n / seen) if seen else 0 for s, n in counts.items()}
+
+
+def _nonempty_str(value) -> bool:
+    return isinstance(value, str) and value != ""
+
+
+def _check_reads(block, name: str) -> List[str]:
+    if not isinstance(block, dict):
+        return [f"'{name}' must map {', '.join(READ_FIELDS)} to FASTQ paths"]
+    return [
+        f"'{name}' is missing '{field}'"
+        for field in READ_FIELDS
+        if not _nonempty_str(block.get(field))
+    ]
+
+
+def _barcode_collisions(samples: Dict) -> List[str]:
+    owners = {}
+    for sample, fields in samples.items():
+        owners.setdefault(sample_barcode(fields), []).append(sample)
+    return [
+        f"Samples {', '.join(repr(s) for s in names)} share barcode {barcode}"
+        for barcode, names in owners.items()
+        if len(names) > 1
+    ]
+
+
+def _barcode_neighbours(samples: Dict, max_mismatches: int) -> List[str]:
+    """Sample pairs whose mismatch neighbourhoods overlap, losing those reads."""
+    if max_mismatches == 0:
+        return []
+    warnings = []
+    for (a, fa), (b, fb) in itertools.combinations(samples.items(), 2):
+        x, y = sample_barcode(fa), sample_barcode(fb)
+        if x == y:
+            continue
+        half = len(x) // 2
+        if all(
+            _hamming(x[s], y[s]) <= 2 * max_mismatches
+            for s in (slice(None, half), slice(half, None))
+        ):
+            warnings.append(
+                f"Barcodes of '{a}' and '{b}' are within {2 * max_mismatches} "
+                "mismatches, reads between them are dropped as ambiguous"
+            )
+    return warnings
+
+
+def _hamming(a: str, b: str) -> int:
+    return sum(x != y for x, y in zip(a, b)) + abs(len(a) - len(b))
+
+
+def _inflate(head: bytes) -> Tuple[bytes, float]:
+    """
+    As much of head as can be decompressed, and the bytes of head per byte
+    of it. Concatenated gzip members, as bgzip writes, are followed.
+    """
+    if not head.startswith(b"\x1f\x8b"):
+        return head, 1.0
+    out = []
+    rest = head
+    while rest:
+        inflater = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        try:
+            out.append(inflater.decompress(rest))
+        except zlib.error:
+            break
+        if not inflater.eof:
+            break
+        rest = inflater.unused_data
+    text = b"".join(out)
+    return text, len(head) / max(1, len(text))
@@ -0,0 +1,175 @@
+"""
+Reference genome helpers.
+
+Reference serves regions of a FASTA straight from a read-only memory map,
+located through its .fai index, so looking up flanking sequence neither
+loads the genome into memory nor runs a tool per batch.
+
+(c) 2021 by latch.ai.
+"""
+
+import hashlib
+import mmap
+import os
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+HASH_BLOCK = 8 * 1024 * 1024
+
+
+class FaiEntry(NamedTuple):
+    length: int
+    offset: int
+    line_bases: int
+    line_width: int
+
+
+def fasta_digest(path: str) -> str:
+    """sha256 of the FASTA contents."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def build_fai(fasta: str, fai: str = None) -> str:
+    """
+    Writes a samtools-compatible .fai index for fasta and returns its path.
+
+    params:
+    - fasta: uncompressed FASTA with a fixed line width per sequence
+    - fai: output path, defaults to fasta + ".fai"
+    """
+    if fai is None:
+        fai = fasta + ".fai"
+
+    entries = []
+    name = None
+    offset = 0
+    with open(fasta, "rb") as f:
+        for line in f:
+            if line.startswith(b">"):
+                if name is not None:
+                    entries.append((name, length, seq_offset, line_bases, line_width))
+                name = line[1:].split()[0].decode()
+                length = 0
+                seq_offset = offset + len(line)
+                line_bases = None
+                line_width = None
+                short_line = False
+            elif name is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if line_bases is None:
+                    line_bases = bases
+                    line_width = len(line)
+                elif short_line or bases > line_bases:
+                    if bases > 0:
+                        raise ValueError(
+                            f"{fasta}: sequence '{name}' has inconsistent line lengths"
+                        )
+                if bases < line_bases:
+                    short_line = True
+                length += bases
+            offset += len(line)
+    if name is not None:
+        entries.append((name, length, seq_offset, line_bases, line_width))
+
+    with open(fai, "w") as f:
+        for name, length, seq_offset, line_bases, line_width in entries:
+            f.write(
+                f"{name}\t{length}\t{seq_offset}\t{line_bases or 0}\t{line_width or 0}\n"
+            )
+    return fai
+
+
+def ensure_fai(fasta: str) -> str:
+    """Builds the .fai next to fasta, unless one at least as new is there."""
+    fai = fasta + ".fai"
+    if not os.path.isfile(fai) or os.path.getmtime(fai) < os.path.getmtime(fasta):
+        build_fai(fasta, fai)
+    return fai
+
+
+def read_fai(fai: str) -> Dict[str, FaiEntry]:
+    index = {}
+    with open(fai) as f:
+        for line in f:
+            fields = line.rstrip("\n").split("\t")
+            index[fields[0]] = FaiEntry(*(int(v) for v in fields[1:5]))
+    return index
+
+
+class Reference:
+    """
+    Memory-mapped FASTA with random access through its .fai index.
+
+    params:
+    - fasta: uncompressed FASTA, indexed on first use if it has no .fai
+    """
+
+    def __init__(self, fasta: str):
+        self.index = read_fai(ensure_fai(fasta))
+        self._file = open(fasta, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._map = (
+            mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        )
+        self._view = memoryview(self._map)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        self._view.release()
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+
+    def segments(self, chrom: str, start: int, end: int) -> List[memoryview]:
+        """
+        Views into the mapped file covering bases [start, end) of chrom, one
+        per FASTA line, clamped to the sequence. Nothing is copied.
+        """
+        entry = self.index.get(chrom)
+        if entry is None:
+            return []
+        start, end = max(0, start), min(end, entry.length)
+        views = []
+        while start < end:
+            line, column = divmod(start, entry.line_bases)
+            take = min(end - start, entry.line_bases - column)
+            offset = entry.offset + line * entry.line_width + column
+            views.append(self._view[offset : offset + take])
+            start += take
+        return views
+
+    def fetch(self, chrom: str, start: int, end: int) -> bytes:
+        """
+        Bases [start, end) of chrom, in the FASTA's case. The join is the one
+        copy made: a region spans line breaks in the file, so its bases are
+        only contiguous once copied. Callers that can work per line should
+        use segments.
+        """
+        return b"".join(self.segments(chrom, start, end))
+
+    def fetch_many(self, regions: Iterable[Tuple[str, int, int]]) -> List[bytes]:
+        """
+        fetch for each (chrom, start, end), read in file order so a batch
+        sweeps the map once, and returned in the order given.
+        """
+        regions = list(regions)
+        order = sorted(
+            range(len(regions)),
+            key=lambda i: (
+                self.index[regions[i][0]].offset if regions[i][0] in self.index else -1,
+                regions[i][1],
+            ),
+        )
+        sequences = [b""] * len(regions)
+        for i in order:
+            sequences[i] = self.fetch(*regions[i])
+        return sequences
@@ -0,0 +1,108 @@
+"""
+Resource tiers for guideseq tasks and thread counts for the tools they run.
+
+A tier is picked from the bytes of FASTQ a task will read, with the memory
+raised if needed to hold the BWA index of the reference.
+
+(c) 2021 by latch.ai.
+"""
+
+import math
+import os
+import shlex
+import stat
+from typing import NamedTuple
+
+GiB = 1024**3
+# Bases bwa mem reads per batch. Without a fixed -K the batch size scales
+# with -t, and the insert size statistics, and so the pairing, differ
+# between thread counts.
+BWA_BATCH_BASES = 10_000_000
+
+
+class Tier(NamedTuple):
+    name: str
+    cpu: int
+    memory_gb: int
+    max_fastq_bytes: float
+
+
+TIERS = (
+    Tier("small", 2, 8, 2 * GiB),
+    Tier("medium", 8, 32, 20 * GiB),
+    Tier("large", 32, 128, math.inf),
+)
+
+
+def plan_tier(
+    fastq_bytes: int, reference_bytes: int = 0, cpu: int = 0, memory_gb: int = 0
+) -> Tier:
+    """
+    params:
+    - fastq_bytes: total size of the FASTQs the task reads
+    - reference_bytes: size of the reference FASTA, bwa needs ~2x in memory
+    - cpu, memory_gb: explicit requests that override the tier when non-zero
+    """
+    tier = next(t for t in TIERS if fastq_bytes <= t.max_fastq_bytes)
+    memory = max(tier.memory_gb, math.ceil(2 * reference_bytes / GiB) + 2)
+    return tier._replace(cpu=cpu or tier.cpu, memory_gb=memory_gb or memory)
+
+
+def available_cpus() -> int:
+    """CPUs this process may use, honouring affinity and cgroup CPU quotas."""
+    cpus = len(os.sched_getaffinity(0))
+    for quota_file, period_file in (
+        ("/sys/fs/cgroup/cpu.max", None),
+        ("/sys/fs/cgroup/cpu/cpu.cfs_quota_us", "/sys/fs/cgroup/cpu/cpu.cfs_period_us"),
+    ):
+        try:
+            with open(quota_file) as f:
+                fields = f.read().split()
+            if period_file is not None:
+                with open(period_file) as f:
+                    fields.append(f.read().strip())
+        except OSError:
+            continue
+        if fields[0] not in ("max", "-1"):
+            cpus = min(cpus, math.ceil(int(fields[0]) / int(fields[1])))
+        break
+    return max(1, cpus)
+
+
+def available_memory() -> int:
+    """Bytes of memory this process may use, honouring cgroup memory limits."""
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    for limit_file in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit != "max":
+            memory = min(memory, int(limit))
+        break
+    return memory
+
+
+def threaded_bwa(bwa: str, threads: int, path: str) -> str:
+    """
+    Writes an executable that forwards to bwa, adding `-t threads` and a
+    fixed `-K` to `bwa mem` so that its output does not depend on the thread
+    count. guideseq takes the bwa executable from the manifest but never
+    passes a thread count, so the manifest is pointed at this wrapper.
+    """
+    bwa = shlex.quote(bwa)
+    with open(path, "w") as f:
+        f.write(
+            "#!/bin/sh\n"
+            'if [ "$1" = mem ]; then\n'
+            "    shift\n"
+            f'    exec {bwa} mem -t {threads} -K {BWA_BATCH_BASES} "$@"\n'
+            "fi\n"
+            f'exec {bwa} "$@"\n'
+        )
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return os.path.abspath(path)
@@ -0,0 +1,178 @@
+"""
+Whole-run memoization for the guideseq task.
+
+A run is fingerprinted from its normalized manifest, the ETags of every
+input object it reads, the options that change its outputs and the image it
+runs in. When a run succeeds, a record of where its outputs were published
+is stored under the fingerprint. A later run with the same fingerprint
+copies those outputs server side into its own output directory instead of
+running the pipeline again.
+
+A record is stored once every output is published, and holds the size and
+ETag of each file. A lookup only counts as a hit if each one is still there
+unchanged, so outputs overwritten by a later run into the same output
+directory are never mistaken for the recorded ones.
+
+(c) 2021 by latch.ai.
+"""
+
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+from botocore.exceptions import ClientError
+
+from latch.s3_dir_download import DEFAULT_CONCURRENCY, get_s3_client, head_objects
+
+
+def pipeline_version() -> str:
+    """The image the task runs in, which pins both guideseq and this package."""
+    return os.environ.get("FLYTE_INTERNAL_IMAGE", "")
+
+
+def run_fingerprint(data: Dict, etags: Dict[str, str], **options) -> str:
+    """
+    params:
+    - data: manifest after the output_folder rewrite
+    - etags: ETag of every input object, keyed on manifest path
+    - options: task inputs that change the outputs
+    """
+    h = hashlib.sha256()
+    h.update(
+        json.dumps(
+            {
+                "manifest": data,
+                "inputs": etags,
+                "options": options,
+                "version": pipeline_version(),
+            },
+            sort_keys=True,
+        ).encode()
+    )
+    return h.hexdigest()
+
+
+def output_files(root: str) -> Dict[str, int]:
+    """Sizes of the files under root, keyed on their path relative to it."""
+    files = {}
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            files[os.path.relpath(path, root).replace(os.sep, "/")] = os.path.getsize(
+                path
+            )
+    return files
+
+
+class RunCache:
+    """
+    params:
+    - bucket, prefix: s3 location records are stored under
+    - client: s3 client, the shared one if omitted
+    - concurrency: maximum number of requests in flight at once
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str,
+        client=None,
+        concurrency=DEFAULT_CONCURRENCY,
+    ):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = client or get_s3_client()
+        self.concurrency = concurrency
+
+    def _record_key(self, fingerprint: str) -> str:
+        return f"{self.prefix}/{fingerprint}.json"
+
+    def lookup(self, fingerprint: str) -> Optional[Dict]:
+        """The record of an earlier run whose outputs are all still in place."""
+        try:
+            body = self.client.get_object(
+                Bucket=self.bucket, Key=self._record_key(fingerprint)
+            )["Body"]
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        record = json.loads(body.read())
+
+        stats = head_objects(
+            [f"{record['prefix']}/{rel}" for rel in record["files"]],
+            record["bucket"],
+            self.client,
+            self.concurrency,
+        )
+        for obj, stat in zip(stats, record["files"].values()):
+            if obj is None or (obj["Size"], obj["ETag"]) != (
+                stat["size"],
+                stat["etag"],
+            ):
+                return None
+        return record
+
+    def store(self, fingerprint: str, files: List[str], bucket: str, prefix: str):
+        """
+        Records that files, relative paths as from output_files, are published
+        under s3://bucket/prefix. Raises if any of them is not.
+        """
+        stats = head_objects(
+            [f"{prefix}/{rel}" for rel in files], bucket, self.client, self.concurrency
+        )
+        missing = [rel for rel, obj in zip(files, stats) if obj is None]
+        if missing:
+            raise ValueError(
+                f"Outputs of the run are not published under s3://{bucket}/{prefix}: "
+                + ", ".join(missing)
+            )
+        record = {
+            "bucket": bucket,
+            "prefix": prefix,
+            "files": {
+                rel: {"size": obj["Size"], "etag": obj["ETag"]}
+                for rel, obj in zip(files, stats)
+            },
+        }
+        self.client.put_object(
+            Bucket=self.bucket,
+            Key=self._record_key(fingerprint),
+            Body=json.dumps(record, indent=2).encode(),
+        )
+
+    def copy(self, record: Dict, bucket: str, prefix: str) -> List[str]:
+        """Copies a recorded run's outputs under s3://bucket/prefix."""
+        if (record["bucket"], record["prefix"]) == (bucket, prefix):
+            return []
+        from boto3.s3.transfer import TransferConfig, create_transfer_manager
+
+        keys = []
+        futures = []
+        manager = create_transfer_manager(
+            self.client, TransferConfig(max_concurrency=self.concurrency)
+        )
+        with manager:
+            for rel in record["files"]:
+                src = {"Bucket": record["bucket"], "Key": f"{record['prefix']}/{rel}"}
+                keys.append(f"{prefix}/{rel}")
+                futures.append(manager.copy(src, bucket, keys[-1]))
+            for future in futures:
+                future.result()
+        return keys
+
+
+def open_run_cache(location: str, client) -> Optional[RunCache]:
+    """
+    params:
+    - location: s3://bucket/prefix URI; empty disables memoization
+    - client: s3 client, the shared one if omitted
+    """
+    if not location:
+        return None
+    split_uri = urlparse(location)
+    if split_uri.scheme != "s3":
+        raise ValueError(f"Run cache must be an s3:// URI, got '{location}'")
+    return RunCache(split_uri.netloc, split_uri.path, client)
@@ -2,54 +2,293 @@
 """
 Copies s3 kv store into local directory structure
 
+Objects are fetched by a bounded pool of workers while the prefix is still
+being listed. Objects larger than `part_size` are split into ranged GETs
+that are written into a preallocated file, so a single multi-GB FASTQ is
+spread across the pool instead of occupying one worker.
+
 (c) 2021 by aidan@latch.bio
 (c) copied and modified from https://stackoverflow.com/questions/31918960/boto3-to-download-all-files-from-a-s3-bucket
 """
+
 import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CONCURRENCY = 16
+MAX_POOL_CONNECTIONS = 64
+PART_SIZE = 64 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+
+_clients = {}
+_clients_lock = threading.Lock()
 
-import boto3
 
-s3_client = boto3.client("s3")
+def get_s3_client():
+    """
+    The process's shared s3 client, built on first use so that importing
+    latch, as registration does, neither loads boto3 nor resolves
+    credentials. Clients are not safe to share across a fork, so a forked
+    child builds its own.
+    """
+    pid = os.getpid()
+    with _clients_lock:
+        client = _clients.get(pid)
+        if client is None:
+            import boto3
+            from botocore.config import Config
+
+            client = _clients[pid] = boto3.client(
+                "s3", config=Config(max_pool_connections=MAX_POOL_CONNECTIONS)
+            )
+    return client
 
 
-def download_dir(prefix, local, bucket, client=s3_client):
+def download_dir(
+    prefix,
+    local,
+    bucket,
+    client=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    part_size=PART_SIZE,
+    cache=None,
+):
     """
     params:
     - prefix: pattern to match in s3
     - local: local path to folder in which to place files
     - bucket: s3 bucket with target contents
-    - client: initialized s3 client object
+    - client: s3 client, the shared one if omitted
+    - concurrency: maximum number of GETs in flight at once
+    - part_size: objects larger than this are fetched as ranged GETs of this size
+    - cache: optional DownloadCache consulted before, and filled after, each GET
+    """
+    client = client or get_s3_client()
+    _download_objects(
+        _list_objects(client, bucket, prefix),
+        prefix,
+        local,
+        bucket,
+        client,
+        concurrency,
+        part_size,
+        cache,
+    )
+
+
+def download_keys(
+    keys,
+    prefix,
+    local,
+    bucket,
+    client=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    part_size=PART_SIZE,
+    optional_keys=(),
+    cache=None,
+):
+    """
+    Downloads only the listed keys, laid out as download_dir would lay them
+    out. Every key is stat'ed before the first byte is transferred, so a
+    missing input fails the task immediately.
+
+    params:
+    - keys: keys under prefix that must exist
+    - prefix: s3 key prefix stripped from the local paths
+    - local: local path to folder in which to place files
+    - bucket: s3 bucket with target contents
+    - client: s3 client, the shared one if omitted
+    - concurrency: maximum number of requests in flight at once
+    - part_size: objects larger than this are fetched as ranged GETs of this size
+    - optional_keys: keys that are downloaded only if they exist
+    - cache: optional DownloadCache consulted before, and filled after, each GET
+    """
+    client = client or get_s3_client()
+    keys = list(dict.fromkeys(keys))
+    optional_keys = [k for k in dict.fromkeys(optional_keys) if k not in keys]
+    stats = head_objects(keys, bucket, client, concurrency)
+    optional_stats = head_objects(optional_keys, bucket, client, concurrency)
+
+    missing = [k for k, obj in zip(keys, stats) if obj is None]
+    if len(missing) > 0:
+        raise FileNotFoundError(
+            "Manifest references objects that do not exist: "
+            + ", ".join(f"s3://{bucket}/{k}" for k in missing)
+        )
+
+    _download_objects(
+        stats + [obj for obj in optional_stats if obj is not None],
+        prefix,
+        local,
+        bucket,
+        client,
+        concurrency,
+        part_size,
+        cache,
+    )
+
+
+def list_objects(prefix, bucket, client=None):
+    """
+    Lists every object under prefix as returned by list_objects_v2, which
+    includes the Size used to plan task resources before any download.
+    """
+    client = client or get_s3_client()
+    return list(_list_objects(client, bucket, prefix))
+
+
+def head_objects(keys, bucket, client=None, concurrency=DEFAULT_CONCURRENCY):
+    """
+    Stats keys concurrently. Returns each object in list_objects_v2 shape,
+    or None where the key does not exist.
     """
-    keys = []
-    dirs = []
-    next_token = ""
-    base_kwargs = {
+    client = client or get_s3_client()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(lambda k: _head_object(client, bucket, k), keys))
+
+
+def _download_objects(
+    objects, prefix, local, bucket, client, concurrency, part_size, cache
+):
+    staged = []
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        # Bounds the number of queued parts so that listing a huge prefix
+        # does not run arbitrarily far ahead of the downloads.
+        slots = threading.BoundedSemaphore(concurrency * 2)
+        futures = deque()
+        # Cache lookups in flight, whose misses are downloaded once they finish.
+        lookups = []
+
+        def _release(future):
+            slots.release()
+
+        def _submit(fn, *args):
+            slots.acquire()
+            _raise_first_error(futures)
+            future = pool.submit(fn, *args)
+            future.add_done_callback(_release)
+            futures.append(future)
+            return future
+
+        def _stage(obj, dest_pathname):
+            tmp_pathname = dest_pathname + ".download"
+            with open(tmp_pathname, "wb") as f:
+                f.truncate(obj["Size"])
+            staged.append((obj, tmp_pathname, dest_pathname))
+
+            for start, end in _byte_ranges(obj["Size"], part_size):
+                _submit(
+                    _download_range,
+                    client,
+                    bucket,
+                    obj["Key"],
+                    obj.get("ETag"),
+                    tmp_pathname,
+                    start,
+                    end,
+                )
+
+        def _collect_lookups(block):
+            for lookup in list(lookups):
+                obj, dest_pathname, future = lookup
+                if block or future.done():
+                    lookups.remove(lookup)
+                    if not future.result():
+                        _stage(obj, dest_pathname)
+
+        try:
+            for obj in objects:
+                k = obj["Key"]
+                dest_pathname = local + k.replace(prefix, "")
+                ensure_dir(dest_pathname)
+                if k[-1] == "/":
+                    continue
+                if cache is None:
+                    _stage(obj, dest_pathname)
+                    continue
+                # Hits are materialized by the pool too, so a slow one never
+                # holds up the misses listed after it.
+                future = _submit(cache.fetch, bucket, obj, dest_pathname)
+                lookups.append((obj, dest_pathname, future))
+                _collect_lookups(block=False)
+            _collect_lookups(block=True)
+
+            for future in futures:
+                future.result()
+        except BaseException:
+            pool.shutdown(wait=True, cancel_futures=True)
+            for _, tmp_pathname, _ in staged:
+                if os.path.exists(tmp_pathname):
+                    os.remove(tmp_pathname)
+            raise
+
+    for obj, tmp_pathname, dest_pathname in staged:
+        os.replace(tmp_pathname, dest_pathname)
+        if cache is not None:
+            cache.store(bucket, obj, dest_pathname)
+    if cache is not None and len(staged) > 0:
+        cache.evict()
+
+
+def _list_objects(client, bucket, prefix):
+    """Yields listed objects page by page so downloads start on the first page."""
+    kwargs = {
         "Bucket": bucket,
         "Prefix": prefix,
     }
-    while next_token is not None:
-        kwargs = base_kwargs.copy()
-        if next_token != "":
-            kwargs.update({"ContinuationToken": next_token})
+    while True:
         results = client.list_objects_v2(**kwargs)
-        contents = results.get("Contents")
-        if contents is not None:
-            for i in contents:
-                k = i.get("Key")
-                if k[-1] != "/":
-                    keys.append(k)
-                else:
-                    dirs.append(k)
-            next_token = results.get("NextContinuationToken")
-    for d in dirs:
-        dest_pathname = local + d.replace(prefix, "")
-        if not os.path.exists(os.path.dirname(dest_pathname)):
-            os.makedirs(os.path.dirname(dest_pathname))
-    for k in keys:
-        dest_pathname = local + k.replace(prefix, "")
-        if not os.path.exists(os.path.dirname(dest_pathname)):
-            os.makedirs(os.path.dirname(dest_pathname))
-        client.download_file(bucket, k, dest_pathname)
+        yield from results.get("Contents", [])
+        next_token = results.get("NextContinuationToken")
+        if next_token is None:
+            return
+        kwargs["ContinuationToken"] = next_token
+
+
+def _head_object(client, bucket, key):
+    """Returns the object in list_objects_v2 shape, or None if it does not exist."""
+    from botocore.exceptions import ClientError
+
+    try:
+        results = client.head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    return {
+        "Key": key,
+        "Size": results["ContentLength"],
+        "ETag": results.get("ETag"),
+    }
+
+
+def _raise_first_error(futures):
+    """Fails fast: surfaces an error from a finished part before queueing more."""
+    while futures and futures[0].done():
+        futures.popleft().result()
+
+
+def _byte_ranges(size, part_size):
+    for start in range(0, size, part_size):
+        yield start, min(start + part_size, size) - 1
+
+
+def _download_range(client, bucket, key, etag, path, start, end):
+    kwargs = {
+        "Bucket": bucket,
+        "Key": key,
+        "Range": f"bytes={start}-{end}",
+    }
+    # Pinning every part to the listed ETag makes a concurrent overwrite of
+    # the object fail the download instead of splicing two versions together.
+    if etag is not None:
+        kwargs["IfMatch"] = etag
+    body = client.get_object(**kwargs)["Body"]
+    with open(path, "r+b") as f:
+        f.seek(start)
+        for chunk in iter(lambda: body.read(CHUNK_SIZE), b""):
+            f.write(chunk)
 
 
 def ensure_dir(file_path):
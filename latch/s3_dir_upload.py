@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Uploads guideseq stage folders to s3 while the pipeline is still running.
+
+`guideseq.py all` runs its stages one after the other, each writing a folder
+under the output folder. Once a later stage's folder appears, the files of
+every earlier stage are closed, so they are handed to a shared transfer
+manager that splits large files into concurrent multipart uploads. Files
+that are uploaded here are removed from the output folder when the run
+ends, leaving only what is still unpublished for the task's FlyteDirectory.
+
+(c) 2021 by latch.ai.
+"""
+
+import os
+import threading
+
+from latch.s3_dir_download import DEFAULT_CONCURRENCY, PART_SIZE, get_s3_client
+
+STAGES = (
+    "demultiplexed",
+    "umitagged",
+    "consolidated",
+    "aligned",
+    "identified",
+    "filtered",
+    "visualization",
+)
+DEFAULT_RETRIES = 3
+POLL_INTERVAL = 5
+
+
+class StageUploader:
+    """
+    Context manager that uploads each stage folder under root to
+    s3://bucket/prefix as soon as the pipeline has moved past it.
+
+    params:
+    - root: local output folder the pipeline writes its stage folders into
+    - bucket, prefix: s3 location root is published to
+    - client: s3 client, the shared one if omitted
+    - concurrency: maximum number of parts in flight at once
+    - part_size: files larger than this are uploaded in parts of this size
+    - retries: attempts per file before it is left for the final upload
+    - skip: stage folders that are never uploaded early
+    """
+
+    def __init__(
+        self,
+        root,
+        bucket,
+        prefix,
+        client=None,
+        concurrency=DEFAULT_CONCURRENCY,
+        part_size=PART_SIZE,
+        retries=DEFAULT_RETRIES,
+        poll_interval=POLL_INTERVAL,
+        skip=(),
+    ):
+        self.root = root
+        self.bucket = bucket
+        self.prefix = prefix
+        self.retries = retries
+        self.poll_interval = poll_interval
+        self.skip = set(skip)
+        self.uploaded = []
+        from boto3.s3.transfer import TransferConfig, create_transfer_manager
+
+        self._manager = create_transfer_manager(
+            client or get_s3_client(),
+            TransferConfig(
+                multipart_threshold=part_size,
+                multipart_chunksize=part_size,
+                max_concurrency=concurrency,
+            ),
+        )
+        self._pending = {}
+        self._seen = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._watch, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        if exc_type is not None:
+            self._manager.shutdown(cancel=True)
+            return False
+
+        self._poll()
+        while self._pending:
+            self._collect(block=True)
+        self._manager.shutdown()
+        for path in self.uploaded:
+            os.remove(path)
+        print(f"Uploaded {len(self.uploaded)} files while the pipeline ran")
+        return False
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            self._poll()
+
+    def _poll(self):
+        self._collect(block=False)
+        for stage in self._closed_stages():
+            for path in _walk_files(os.path.join(self.root, stage)):
+                if path not in self._seen:
+                    self._seen.add(path)
+                    self._submit(path, 1)
+
+    def _closed_stages(self):
+        present = [s for s in STAGES if os.path.isdir(os.path.join(self.root, s))]
+        return [s for s in present[:-1] if s not in self.skip]
+
+    def _submit(self, path, attempt):
+        key = self.prefix + "/" + os.path.relpath(path, self.root).replace(os.sep, "/")
+        future = self._manager.upload(path, self.bucket, key)
+        self._pending[path] = (future, attempt)
+
+    def _collect(self, block):
+        for path, (future, attempt) in list(self._pending.items()):
+            if not block and not future.done():
+                continue
+            try:
+                future.result()
+            except Exception as e:
+                del self._pending[path]
+                if attempt < self.retries:
+                    self._submit(path, attempt + 1)
+                else:
+                    # Left in place, so the task's own upload publishes it.
+                    print(f"Giving up on early upload of {path}: {e}")
+                continue
+            del self._pending[path]
+            self.uploaded.append(path)
+
+
+def _walk_files(directory):
+    for dirpath, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            yield os.path.join(dirpath, filename)
+
+
+def upload_files(
+    paths,
+    root,
+    bucket,
+    prefix,
+    client=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    part_size=PART_SIZE,
+    retries=DEFAULT_RETRIES,
+):
+    """
+    Uploads paths under root to the matching keys under prefix and waits for
+    all of them, retrying each file up to `retries` times in total.
+
+    params:
+    - paths: local files, all under root
+    - root: local folder that maps onto prefix
+    - bucket, prefix: s3 location root is published to
+    """
+    from boto3.s3.transfer import TransferConfig, create_transfer_manager
+
+    manager = create_transfer_manager(
+        client or get_s3_client(),
+        TransferConfig(
+            multipart_threshold=part_size,
+            multipart_chunksize=part_size,
+            max_concurrency=concurrency,
+        ),
+    )
+
+    def submit(path):
+        key = prefix + "/" + os.path.relpath(path, root).replace(os.sep, "/")
+        return manager.upload(path, bucket, key)
+
+    with manager:
+        pending = [(path, submit(path), 1) for path in paths]
+        while pending:
+            path, future, attempt = pending.pop(0)
+            try:
+                future.result()
+            except Exception:
+                if attempt >= retries:
+                    raise
+                pending.append((path, submit(path), attempt + 1))
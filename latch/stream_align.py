@@ -0,0 +1,230 @@
+"""
+Streams a sample from demultiplexed reads to alignments, in place of
+guideseq's umitag, consolidate and align steps.
+
+Read pairs are tagged with their molecular id and written one pair per
+line to `sort`, which spills to disk under its own memory budget, so pairs
+come out grouped by molecule with both ends together. Each molecule's
+consensus pair is piped, interleaved, into `bwa mem -p`. Its SAM is
+written straight into the aligned folder, or through `samtools sort` into
+a BAM. Umitagged and consolidated FASTQs only touch the disk when they are
+asked for.
+
+(c) 2021 by latch.ai.
+"""
+
+import itertools
+import os
+import shutil
+import subprocess
+import threading
+from typing import Dict
+
+from latch.compress import BAM_LEVEL
+from latch.consolidate import MIN_FREQ, MIN_QUAL, consolidated_record, molecular_id
+from latch.demultiplex import open_fastq
+from latch.pipeline import (
+    READ_ENDS,
+    aligned_path,
+    consolidated_paths,
+    run,
+    umitagged_paths,
+)
+from latch.resources import available_memory
+
+# Share of the task's memory `sort` buffers pairs in. bwa mem holds the
+# index and samtools sort its own buffers in the rest.
+SORT_MEMORY_FRACTION = 0.25
+MIN_SORT_BUFFER = 64 * 1024**2
+PIPE_BUFFER = 1024 * 1024
+# Fields of a tagged pair: molecular id, then name, sequence and qualities
+# of each end.
+ENDS = ((1, 2, 3), (4, 5, 6))
+
+
+def stream_align(
+    reads: Dict[str, str],
+    bwa: str,
+    genome: str,
+    output_folder: str,
+    sample: str,
+    threads: int,
+    log_path: str,
+    compressed: bool = False,
+    keep_intermediates: bool = False,
+    min_qual: int = MIN_QUAL,
+    min_freq: float = MIN_FREQ,
+) -> str:
+    """
+    Writes the sample's alignment to the aligned folder and returns its path.
+
+    params:
+    - reads: demultiplexed read paths keyed by r1/r2/i1/i2
+    - bwa: bwa executable
+    - genome: indexed reference FASTA
+    - output_folder: shared output folder
+    - sample: sample name the outputs are named after
+    - threads: threads for sort and samtools, bwa takes its own from its wrapper
+    - log_path: file stderr of every tool is appended to
+    - compressed: write a sorted, indexed BAM instead of a SAM
+    - keep_intermediates: also write the umitagged and consolidated FASTQs
+    """
+    aligned = aligned_path(output_folder, sample, compressed)
+    sort_dir = os.path.abspath(os.path.join("umi_sort", sample))
+    for path in (aligned, log_path, os.path.join(sort_dir, "")):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    kept = []
+    if keep_intermediates:
+        for paths in (
+            umitagged_paths(output_folder, sample),
+            consolidated_paths(output_folder, sample),
+        ):
+            for path in paths.values():
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            kept.append([open(paths[end], "wb") for end in ("r1", "r2")])
+
+    print(f"Streaming {sample} through umitag, consolidate and bwa mem", flush=True)
+    procs = []
+    errors = []
+    with open(log_path, "ab") as log:
+        try:
+            sort = subprocess.Popen(
+                [
+                    "sort",
+                    "-t",
+                    "\t",
+                    "-k1,1",
+                    "-S",
+                    sort_buffer(available_memory()),
+                    f"--parallel={threads}",
+                    "-T",
+                    sort_dir,
+                ],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=log,
+                bufsize=PIPE_BUFFER,
+                # Byte order, so molecules group the same in every locale.
+                env={**os.environ, "LC_ALL": "C"},
+            )
+            procs.append(("sort", sort))
+            if compressed:
+                bwa_out = subprocess.PIPE
+            else:
+                bwa_out = open(aligned, "wb")
+            aligner = subprocess.Popen(
+                [bwa, "mem", "-p", genome, "-"],
+                stdin=subprocess.PIPE,
+                stdout=bwa_out,
+                stderr=log,
+                bufsize=PIPE_BUFFER,
+            )
+            procs.append(("bwa mem", aligner))
+            if compressed:
+                samtools = subprocess.Popen(
+                    [
+                        "samtools",
+                        "sort",
+                        "-@",
+                        str(threads),
+                        "-l",
+                        str(BAM_LEVEL),
+                        "-o",
+                        aligned,
+                        "-",
+                    ],
+                    stdin=aligner.stdout,
+                    stderr=log,
+                )
+                procs.append(("samtools sort", samtools))
+                aligner.stdout.close()
+            else:
+                bwa_out.close()
+
+            tagger = threading.Thread(
+                target=_tag_pairs, args=(reads, sort.stdin, errors), daemon=True
+            )
+            tagger.start()
+            umitagged, consolidated = kept if kept else (None, None)
+            for mol_id, lines in itertools.groupby(
+                sort.stdout, key=lambda line: line.split(b"\t", 1)[0]
+            ):
+                pairs = [line.rstrip(b"\n").split(b"\t") for line in lines]
+                records = [
+                    consolidated_record(
+                        mol_id,
+                        [p[seq] for p in pairs],
+                        [p[qual] for p in pairs],
+                        min_qual,
+                        min_freq,
+                    )
+                    for _, seq, qual in ENDS
+                ]
+                aligner.stdin.write(records[0] + records[1])
+                if umitagged is not None:
+                    for f, (name, seq, qual) in zip(umitagged, ENDS):
+                        f.writelines(
+                            b"%s %s\n%s\n+\n%s\n" % (p[name], mol_id, p[seq], p[qual])
+                            for p in pairs
+                        )
+                    for f, record in zip(consolidated, records):
+                        f.write(record)
+            tagger.join()
+            aligner.stdin.close()
+            for _, proc in procs:
+                proc.wait()
+        except BaseException:
+            for _, proc in procs:
+                proc.kill()
+                proc.wait()
+            raise
+        finally:
+            for files in kept:
+                for f in files:
+                    f.close()
+            shutil.rmtree(sort_dir, ignore_errors=True)
+
+    if errors:
+        raise errors[0]
+    for name, proc in procs:
+        if proc.returncode != 0:
+            raise RuntimeError(
+                f"{name} exited with code {proc.returncode} while streaming "
+                f"{sample}, see {log_path}"
+            )
+    if compressed:
+        run(["samtools", "index", "-@", str(threads), aligned], log_path)
+    return aligned
+
+
+def sort_buffer(memory: int) -> str:
+    """`sort -S` size, in bytes, for a task that may use memory bytes."""
+    return f"{max(MIN_SORT_BUFFER, int(memory * SORT_MEMORY_FRACTION))}b"
+
+
+def _tag_pairs(reads: Dict[str, str], sink, errors):
+    """Writes every read pair to sink as a line led by its molecular id."""
+    streams = [open_fastq(reads[end]) for end in READ_ENDS]
+    try:
+        files = [f for _, f in streams]
+        while True:
+            r1, r2, i1, i2 = [
+                [f.readline().rstrip(b"\n") for _ in range(4)] for f in files
+            ]
+            if not r1[0]:
+                if r2[0] or i1[0] or i2[0]:
+                    raise ValueError("Demultiplexed FASTQs differ in length")
+                break
+            mol_id = molecular_id(i1[1], i2[1], r1[1])
+            sink.write(
+                b"\t".join((mol_id, r1[0], r1[1], r1[3], r2[0], r2[1], r2[3])) + b"\n"
+            )
+    except BaseException as e:
+        errors.append(e)
+    finally:
+        sink.close()
+        for proc, f in streams:
+            f.close()
+            if proc is not None:
+                proc.wait()
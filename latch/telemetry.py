@@ -0,0 +1,253 @@
+"""
+Per-phase performance telemetry for the guideseq task.
+
+A sampler thread reads the task's process tree from /proc: its resident
+memory, its CPU time and the bytes it has passed through read and write
+calls. Finished children count through the parent's totals and running
+ones through their own, so tools such as bwa are included while they are
+still running. Every sample is attributed to the current phase. Phases
+are opened explicitly around download, upload and individually run steps.
+Within `guideseq.py all` they follow the stage folders it creates.
+
+(c) 2021 by latch.ai.
+"""
+
+import glob
+import gzip
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+SAMPLE_INTERVAL = 1
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+CLK_TCK = os.sysconf("SC_CLK_TCK")
+COUNT_BLOCK = 8 * 1024 * 1024
+
+# Files holding one record per read pair in each stage folder, and the number
+# of lines per record.
+READ_FILES = {
+    "demultiplexed": ("*.r1.fastq*", 4),
+    "umitagged": ("*.r1.umitagged.fastq*", 4),
+    "consolidated": ("*.r1.consolidated.fastq*", 4),
+}
+
+
+def _proc_tree(pid: int) -> List[int]:
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree = []
+    stack = [pid]
+    while stack:
+        p = stack.pop()
+        tree.append(p)
+        stack.extend(children.get(p, []))
+    return tree
+
+
+def tree_usage(pid: int) -> Dict[str, float]:
+    """Current rss and cumulative cpu and io of pid and its descendants."""
+    usage = {"rss_bytes": 0, "cpu_seconds": 0.0, "bytes_read": 0, "bytes_written": 0}
+    for p in _proc_tree(pid):
+        try:
+            with open(f"/proc/{p}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open(f"/proc/{p}/io") as f:
+                io = dict(line.split(": ") for line in f.read().splitlines())
+        except OSError:
+            # Exited between listing and reading; its totals moved to its parent.
+            continue
+        # Own time plus that of children it has waited for, as /proc/<p>/io
+        # does for bytes.
+        ticks = sum(int(v) for v in fields[11:15])
+        usage["cpu_seconds"] += ticks / CLK_TCK
+        usage["rss_bytes"] += int(fields[21]) * PAGE_SIZE
+        usage["bytes_read"] += int(io["rchar"])
+        usage["bytes_written"] += int(io["wchar"])
+    return usage
+
+
+class Telemetry:
+    """
+    Context manager that samples the task's process tree until it exits.
+
+    params:
+    - interval: seconds between samples
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        self.interval = interval
+        self.phases = {}
+        self.current = None
+        self._start_usage = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample_loop, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.start(None)
+        self._stop.set()
+        self._thread.join()
+        return False
+
+    def start(self, phase: Optional[str]):
+        """Closes the current phase and opens phase, unless it is None."""
+        usage = tree_usage(os.getpid())
+        now = time.time()
+        with self._lock:
+            if self.current is not None:
+                metrics = self.phases[self.current]
+                metrics["wall_seconds"] += now - self._started
+                metrics["peak_rss_bytes"] = max(
+                    metrics["peak_rss_bytes"], usage["rss_bytes"]
+                )
+                for key in ("cpu_seconds", "bytes_read", "bytes_written"):
+                    metrics[key] += max(0, usage[key] - self._start_usage[key])
+            self.current = phase
+            self._started = now
+            self._start_usage = usage
+            if phase is not None:
+                self.phases.setdefault(
+                    phase,
+                    {
+                        "wall_seconds": 0.0,
+                        "cpu_seconds": 0.0,
+                        "peak_rss_bytes": 0,
+                        "bytes_read": 0,
+                        "bytes_written": 0,
+                    },
+                )
+                self.phases[phase]["peak_rss_bytes"] = max(
+                    self.phases[phase]["peak_rss_bytes"], usage["rss_bytes"]
+                )
+
+    @contextmanager
+    def phase(self, phase: str):
+        self.start(phase)
+        try:
+            yield
+        finally:
+            self.start(None)
+
+    @contextmanager
+    def stages(self, output_folder: str, stages):
+        """
+        Attributes everything until exit to the latest of stages whose folder
+        exists under output_folder.
+        """
+        stop = threading.Event()
+
+        def watch():
+            while not stop.wait(self.interval):
+                present = [
+                    s for s in stages if os.path.isdir(os.path.join(output_folder, s))
+                ]
+                if present and present[-1] != self.current:
+                    self.start(present[-1])
+
+        thread = threading.Thread(target=watch, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+            self.start(None)
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            rss = tree_usage(os.getpid())["rss_bytes"]
+            with self._lock:
+                if self.current is not None:
+                    metrics = self.phases[self.current]
+                    metrics["peak_rss_bytes"] = max(metrics["peak_rss_bytes"], rss)
+
+    def count_reads(self, output_folder: str):
+        """Adds read pair, alignment and site counts to the stages that wrote them."""
+        counts = {}
+        for stage, (pattern, lines) in READ_FILES.items():
+            paths = glob.glob(os.path.join(output_folder, stage, pattern))
+            if paths:
+                counts[stage] = sum(_count_lines(p) for p in paths) // lines
+        aligned = glob.glob(os.path.join(output_folder, "aligned", "*.sam"))
+        bams = glob.glob(os.path.join(output_folder, "aligned", "*.bam"))
+        if aligned or bams:
+            counts["aligned"] = sum(_count_sam_records(p) for p in aligned) + sum(
+                _count_bam_records(p) for p in bams
+            )
+        identified = glob.glob(os.path.join(output_folder, "identified", "*.txt"))
+        if identified:
+            counts["identified"] = sum(max(0, _count_lines(p) - 1) for p in identified)
+        for stage, count in counts.items():
+            self.phases.setdefault(stage, {})["records"] = count
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            json.dump({"phases": self.phases}, f, indent=2)
+
+    def summary(self) -> str:
+        lines = [
+            f"{'phase':<16}{'wall s':>10}{'cpu s':>10}{'peak rss':>12}"
+            f"{'read':>12}{'written':>12}{'records':>12}"
+        ]
+        for phase, m in self.phases.items():
+            lines.append(
+                f"{phase:<16}{m.get('wall_seconds', 0):>10.1f}"
+                f"{m.get('cpu_seconds', 0):>10.1f}"
+                f"{_fmt_bytes(m.get('peak_rss_bytes', 0)):>12}"
+                f"{_fmt_bytes(m.get('bytes_read', 0)):>12}"
+                f"{_fmt_bytes(m.get('bytes_written', 0)):>12}"
+                f"{m.get('records', ''):>12}"
+            )
+        return "\n".join(lines)
+
+
+def _fmt_bytes(n: int) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if n < 1024:
+            return f"{n:.0f}{unit}"
+        n /= 1024
+    return f"{n:.1f}TiB"
+
+
+def _count_lines(path: str) -> int:
+    opener = gzip.open if path.endswith(".gz") else open
+    count = 0
+    with opener(path, "rb") as f:
+        for block in iter(lambda: f.read(COUNT_BLOCK), b""):
+            count += block.count(b"\n")
+    return count
+
+
+def _count_sam_records(path: str) -> int:
+    count = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.startswith(b"@"):
+                count += 1
+                break
+        for block in iter(lambda: f.read(COUNT_BLOCK), b""):
+            count += block.count(b"\n")
+    return count
+
+
+def _count_bam_records(path: str) -> int:
+    out = subprocess.run(
+        ["samtools", "view", "-c", path], check=True, capture_output=True, text=True
+    )
+    return int(out.stdout)
@@ -1,5 +1,6 @@
 """Test correct outputs of ldata process on remote flyte cluster."""
 
+import json
 import os
 import subprocess
 import time
@@ -8,8 +9,27 @@ from typing import List
 
 import boto3
 import pytest
+import yaml
 from botocore.exceptions import ClientError
 
+from latch.consolidate import consolidate_partitioned
+from latch.demultiplex import DEFAULT_MIN_READS, demultiplex_reads, sample_barcodes
+from latch.identify import align_sites, identify, reverse_complement
+from latch.manifest import READ_FIELDS
+from latch.pipeline import (
+    GUIDESEQ,
+    READ_ENDS,
+    aligned_path,
+    consolidated_paths,
+    demultiplexed_paths,
+    guideseq_cmd,
+    identified_path,
+    run,
+    umitagged_paths,
+)
+from latch.s3_dir_download import download_dir
+from latch.stream_align import stream_align
+
 PROJECT = os.environ["PROJECT"]
 VERSION = os.environ["VERSION"]
 FLYTE_ADMIN_ENDPOINT = os.environ["FLYTE_ADMIN_ENDPOINT"]
@@ -20,6 +40,10 @@ DOMAIN = "development"
 s3_client = boto3.resource("s3")
 client = boto3.client("s3")
 
+TEST_PREFIX = ".test/wf-core-guideseq"
+# Where guideseq is cloned in the task image, next to this file.
+GUIDESEQ_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), GUIDESEQ)
+
 managed_buckets = {
     "admin.flyte.ligma.ai:81": "dev-ldata-managed",
     "admin.flyte.sugma.ai:81": "staging-ldata-managed",
@@ -73,6 +97,40 @@ def outputs(bucket):
     ]
 
 
+@pytest.fixture
+def compressed_outputs(bucket):
+    return [
+        ".test/wf-core-guideseq/guideseq_outputs/aligned/control.bam",
+        ".test/wf-core-guideseq/guideseq_outputs/aligned/control.bam.bai",
+        ".test/wf-core-guideseq/guideseq_outputs/aligned/EMX1.bam",
+        ".test/wf-core-guideseq/guideseq_outputs/aligned/EMX1.bam.bai",
+        ".test/wf-core-guideseq/guideseq_outputs/consolidated/control.r1.consolidated.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/consolidated/control.r2.consolidated.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/consolidated/EMX1.r1.consolidated.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/consolidated/EMX1.r2.consolidated.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/demultiplexed/control.i1.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/demultiplexed/control.i2.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/demultiplexed/control.r1.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/demultiplexed/control.r2.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/demultiplexed/EMX1.i1.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/demultiplexed/EMX1.i2.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/demultiplexed/EMX1.r1.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/demultiplexed/EMX1.r2.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/demultiplexed/undetermined.i1.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/demultiplexed/undetermined.i2.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/demultiplexed/undetermined.r1.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/demultiplexed/undetermined.r2.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/filtered/EMX1_backgroundFiltered.txt",
+        ".test/wf-core-guideseq/guideseq_outputs/identified/control_identifiedOfftargets.txt",
+        ".test/wf-core-guideseq/guideseq_outputs/identified/EMX1_identifiedOfftargets.txt",
+        ".test/wf-core-guideseq/guideseq_outputs/umitagged/control.r1.umitagged.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/umitagged/control.r2.umitagged.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/umitagged/EMX1.r1.umitagged.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/umitagged/EMX1.r2.umitagged.fastq.gz",
+        ".test/wf-core-guideseq/guideseq_outputs/visualization/EMX1_offtargets.svg",
+    ]
+
+
 def _s3_obj_exists(bucket_name: str, res_path: str) -> bool:
     obj = s3_client.Object(bucket_name, res_path)
     try:
@@ -90,7 +148,7 @@ def _rm_s3_obj(bucket_name: str, res_path: str) -> bool:
     s3_client.Object(bucket_name, res_path).delete()
 
 
-def test_guideseq(bucket, inputs, outputs):
+def _run_guideseq(bucket, inputs, outputs, extra_inputs=""):
     try:
         bucket_obj = s3_client.Bucket(bucket)
         bucket_obj.objects.filter(
@@ -103,6 +161,7 @@ def test_guideseq(bucket, inputs, outputs):
                 manifest: "s3://{bucket}/{inputs[0]}"
                 input_dir: "s3://{bucket}/{inputs[1]}"
                 output_dir: "s3://{bucket}/{inputs[2]}"
+            {extra_inputs}
             targetDomain: "{DOMAIN}"
             targetProject: "{PROJECT}"
             version: "{VERSION}"
@@ -141,3 +200,186 @@ def test_guideseq(bucket, inputs, outputs):
         bucket_obj.objects.filter(
             Prefix=f".test/wf-core-guideseq/guideseq_outputs"
         ).delete()
+
+
+def test_guideseq(bucket, inputs, outputs):
+    _run_guideseq(bucket, inputs, outputs)
+
+
+def test_guideseq_compressed(bucket, inputs, compressed_outputs):
+    _run_guideseq(
+        bucket, inputs, compressed_outputs, "    compress_intermediates: true"
+    )
+
+
+@pytest.fixture(scope="module")
+def upstream(tmp_path_factory):
+    """
+    The test dataset laid out as the task lays it out, with every step of
+    upstream `guideseq.py all` run on it into `upstream/`. Manifest paths
+    are relative to the returned folder.
+    """
+    bucket = managed_buckets[FLYTE_ADMIN_ENDPOINT]
+    root = tmp_path_factory.mktemp("upstream")
+    download_dir(f"{TEST_PREFIX}/test", str(root / "test"), bucket, client)
+    client.download_file(
+        bucket, f"{TEST_PREFIX}/test_manifest.yaml", str(root / "manifest.yaml")
+    )
+    with open(root / "manifest.yaml") as f:
+        data = yaml.safe_load(f)
+    data["output_folder"] = "upstream"
+    with open(root / "manifest.yaml", "w") as f:
+        yaml.safe_dump(data, f)
+
+    cwd = os.getcwd()
+    os.chdir(root)
+    try:
+        cmd = guideseq_cmd("all")
+        cmd[cmd.index(GUIDESEQ)] = GUIDESEQ_PATH
+        run(cmd + ["-m", "manifest.yaml"], os.path.join("logs", "guideseq.log"))
+    finally:
+        os.chdir(cwd)
+    return root, data
+
+
+def _folder_files(folder) -> dict:
+    files = {}
+    for dirpath, _, names in os.walk(folder):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            with open(path, "rb") as f:
+                files[os.path.relpath(path, folder)] = f.read()
+    return files
+
+
+def test_demultiplex_matches_guideseq(upstream, tmp_path):
+    root, data = upstream
+    reads = data["undemultiplexed"]
+    demultiplex_reads(
+        *[str(root / reads[field]) for field in READ_FIELDS],
+        sample_barcodes(data["samples"]),
+        str(tmp_path),
+        min_reads=data.get("demultiplex_min_reads", DEFAULT_MIN_READS),
+    )
+    files = _folder_files(tmp_path)
+    expected = _folder_files(root / "upstream/demultiplexed")
+    # guideseq writes undetermined reads in the iteration order of a Python 2
+    # dict of barcodes, so only the set of read quadruples can match.
+    assert _undetermined(files) == _undetermined(expected)
+    assert files == expected
+
+
+def _undetermined(files: dict) -> list:
+    """Pops the undetermined FASTQs out of files as sorted read quadruples."""
+    ends = []
+    for end in READ_ENDS:
+        lines = files.pop(f"undetermined.{end}.fastq").split(b"\n")
+        ends.append([tuple(lines[i : i + 4]) for i in range(0, len(lines) - 1, 4)])
+    assert len(set(map(len, ends))) == 1
+    return sorted(zip(*ends))
+
+
+@pytest.mark.parametrize("memory_bytes", [1024**2, 1024**3])
+def test_consolidate_matches_guideseq(upstream, tmp_path, memory_bytes):
+    root, data = upstream
+    for sample in data["samples"]:
+        consolidated = consolidated_paths(str(tmp_path), sample)
+        consolidate_partitioned(
+            umitagged_paths(str(root / "upstream"), sample),
+            consolidated,
+            str(tmp_path / "buckets"),
+            memory_bytes,
+            processes=2,
+        )
+        for end, path in consolidated_paths(str(root / "upstream"), sample).items():
+            with open(path, "rb") as expected, open(consolidated[end], "rb") as f:
+                assert f.read() == expected.read(), f"{sample}.{end} differs"
+
+
+def _alignments(path) -> list:
+    """Name, flag, chromosome and position of every SAM record, sorted."""
+    with open(path) as f:
+        records = [line.split("\t")[:4] for line in f if not line.startswith("@")]
+    return sorted(
+        (name, int(flag), chrom, int(pos)) for name, flag, chrom, pos in records
+    )
+
+
+def test_stream_align_matches_guideseq(upstream, tmp_path):
+    root, data = upstream
+    for sample in data["samples"]:
+        aligned = stream_align(
+            demultiplexed_paths(str(root / "upstream"), sample),
+            data.get("bwa", "bwa"),
+            str(root / data["reference_genome"]),
+            str(tmp_path),
+            sample,
+            2,
+            str(tmp_path / "logs" / f"{sample}.log"),
+        )
+        assert _alignments(aligned) == _alignments(
+            aligned_path(str(root / "upstream"), sample)
+        ), f"{sample} aligns differently"
+
+
+UPSTREAM_ALIGN = """
+import json, sys
+sys.path.insert(0, sys.argv[1])
+from identifyOfftargetSites import alignSequences
+target, windows = json.load(sys.stdin)
+# Python 2's json gives unicode, which guideseq's reverseComplement rejects.
+target, windows = str(target), [str(window) for window in windows]
+json.dump([alignSequences(target, window) for window in windows], sys.stdout)
+"""
+
+
+def test_align_matches_guideseq():
+    """guideseq's alignSequences, run in python2.7, on bulged and unbulged sites."""
+    target = "GAGTCCGAGCAGAAGAAGAANGG"
+    flank = "ACCTTGACCATCAATCAGTC"
+    sites = [
+        "GAGTCCGAGCAGAAGAAGAAGGG",
+        "GAGTCTGAGCAGTAGAAGAAAGG",
+        "GAGTCCGAGCAGAAGTAAGAAGGG",
+        "GAGTCCGAGCAGAAGAAGTAAGAAGGG",
+        "GAGTCCGAGCAAAGAAGAATGG",
+        "GAGTCCGACAGAAGAAGAATGG",
+        "GATCCGAGCAGAAGAAGAAGGG",
+        "CAGTCCGAGCAGAATGAAGAAGGG",
+        "ACGTACGTACGTACGTACGTACG",
+    ]
+    windows = [flank + site + flank[::-1] for site in sites]
+    windows += [reverse_complement(window) for window in windows]
+    windows.append(windows[0].lower())
+    upstream = subprocess.run(
+        ["python2.7", "-c", UPSTREAM_ALIGN, os.path.dirname(GUIDESEQ_PATH)],
+        input=json.dumps([target, windows]),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert align_sites(windows, target) == json.loads(upstream)
+
+
+def test_identify_matches_guideseq(upstream, tmp_path):
+    """
+    The array engine's tables, with sites aligned across a process pool,
+    are guideseq's line for line. Annotations are passed as `guideseq.py
+    all` reads them from the manifest.
+    """
+    root, data = upstream
+    for sample, fields in data["samples"].items():
+        out = identified_path(str(tmp_path), sample)
+        identify(
+            aligned_path(str(root / "upstream"), sample),
+            str(root / data["reference_genome"]),
+            out,
+            sample,
+            fields.get("target"),
+            fields.get("description"),
+            processes=2,
+        )
+        with open(identified_path(str(root / "upstream"), sample)) as f:
+            expected = f.read().splitlines()
+        with open(out) as f:
+            assert f.read().splitlines() == expected, f"{sample} differs"
@@ -0,0 +1,995 @@
+"""
+Test the task's transfer, caching and planning code against an in-process
+moto S3, and its reference access, identify engine and off-target dataset
+on small inputs.
+"""
+
+import gzip
+import os
+import random
+import shutil
+import subprocess
+
+import boto3
+import pyarrow.parquet as pq
+import pytest
+from moto import mock_aws
+
+from latch import identify
+from latch.bundle_store import open_bundle_store
+from latch.bwa_index import INDEX_SUFFIXES, ensure_index, open_index_cache
+from latch.checkpoint import Checkpoints, run_digest
+from latch.control_cache import (
+    control_digest,
+    control_files,
+    open_control_cache,
+)
+from latch.download_cache import open_cache
+from latch.identify import align_sequences, align_sites, reverse_complement
+from latch.offtargets import filtered_path, write_offtargets
+from latch.pipeline import identified_path
+from latch.preflight import (
+    PreflightError,
+    check_manifest,
+    estimate_reads,
+    input_paths,
+    plan_run,
+)
+from latch.reference import Reference, build_fai, read_fai
+from latch.run_cache import open_run_cache, run_fingerprint
+from latch.s3_dir_download import download_dir, download_keys
+from latch.stream_align import MIN_SORT_BUFFER, sort_buffer
+
+BUCKET = "guideseq-test"
+PREFIX = "inputs/test"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "test")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "test")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+
+@pytest.fixture
+def objects(s3):
+    """Inputs of varied sizes, some spanning several download parts."""
+    contents = {
+        f"{PREFIX}/manifest.yaml": b"samples: {}\n",
+        f"{PREFIX}/data/reads.r1.fastq": os.urandom(300_000),
+        f"{PREFIX}/data/reads.r2.fastq": os.urandom(65_536),
+        f"{PREFIX}/ref/genome.fa": os.urandom(1),
+        f"{PREFIX}/empty.txt": b"",
+    }
+    for key, body in contents.items():
+        s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+    return contents
+
+
+def _local_files(root: str) -> dict:
+    files = {}
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            with open(path, "rb") as f:
+                files[os.path.relpath(path, root)] = f.read()
+    return files
+
+
+def _expected(objects: dict, prefix: str = PREFIX) -> dict:
+    return {k[len(prefix) + 1 :]: v for k, v in objects.items()}
+
+
+@pytest.mark.parametrize("part_size", [4096, 65_536, 10**9])
+def test_download_dir(s3, objects, tmp_path, part_size):
+    download_dir(PREFIX, str(tmp_path), BUCKET, s3, concurrency=3, part_size=part_size)
+    assert _local_files(str(tmp_path)) == _expected(objects)
+
+
+def test_download_keys_fetches_only_listed_keys(s3, objects, tmp_path):
+    keys = [f"{PREFIX}/manifest.yaml", f"{PREFIX}/data/reads.r1.fastq"]
+    download_keys(
+        keys,
+        PREFIX,
+        str(tmp_path),
+        BUCKET,
+        s3,
+        part_size=4096,
+        optional_keys=[f"{PREFIX}/ref/genome.fa", f"{PREFIX}/ref/genome.fa.fai"],
+    )
+    expected = _expected(objects)
+    assert _local_files(str(tmp_path)) == {
+        k: expected[k]
+        for k in ["manifest.yaml", "data/reads.r1.fastq", "ref/genome.fa"]
+    }
+
+
+def test_download_keys_missing_input(s3, objects, tmp_path):
+    keys = [f"{PREFIX}/manifest.yaml", f"{PREFIX}/data/missing.fastq"]
+    with pytest.raises(FileNotFoundError, match="data/missing.fastq"):
+        download_keys(keys, PREFIX, str(tmp_path), BUCKET, s3)
+    assert _local_files(str(tmp_path)) == {}
+
+
+def _cache_keys(s3, prefix):
+    pages = s3.get_paginator("list_objects_v2").paginate(Bucket=BUCKET, Prefix=prefix)
+    return sorted(obj["Key"] for page in pages for obj in page.get("Contents", []))
+
+
+@pytest.mark.parametrize("location", ["local", f"s3://{BUCKET}/cache"])
+def test_download_cache_hits(s3, objects, tmp_path, location):
+    if location == "local":
+        location = str(tmp_path / "cache")
+    cache = open_cache(location, s3)
+    for run in ["first", "second"]:
+        local = str(tmp_path / run)
+        download_dir(PREFIX, local, BUCKET, s3, part_size=4096, cache=cache)
+        assert _local_files(local) == _expected(objects)
+    assert cache.misses == len(objects)
+    assert cache.hits == len(objects)
+
+
+def test_s3_download_cache_eviction(s3, objects, tmp_path):
+    cache = open_cache(f"s3://{BUCKET}/cache", s3)
+    for run in ["first", "second"]:
+        download_dir(PREFIX, str(tmp_path / run), BUCKET, s3, cache=cache)
+    markers = _cache_keys(s3, "cache/.access/")
+    assert len(markers) == len(objects)
+
+    cache.evict()
+    assert len(_cache_keys(s3, "cache/")) == 2 * len(objects)
+
+    cache.max_bytes = 0
+    cache.evict()
+    assert _cache_keys(s3, "cache/") == []
+
+
+def test_local_download_cache_eviction(s3, objects, tmp_path):
+    root = tmp_path / "cache"
+    cache = open_cache(str(root), s3)
+    download_dir(PREFIX, str(tmp_path / "run"), BUCKET, s3, cache=cache)
+    entries = {}
+    for dirpath, _, names in os.walk(root):
+        for name in names:
+            path = os.path.join(dirpath, name)
+            entries[path] = os.path.getsize(path)
+    # Age every entry but the largest, which must then survive eviction.
+    largest = max(entries, key=entries.get)
+    for path in entries:
+        if path != largest:
+            os.utime(path, (0, 0))
+
+    cache.max_bytes = entries[largest]
+    cache.evict()
+    assert [p for p in entries if os.path.exists(p)] == [largest]
+
+
+def test_local_download_cache_entries_are_private(s3, objects, tmp_path):
+    cache = open_cache(str(tmp_path / "cache"), s3)
+    for run in ["first", "second"]:
+        download_dir(PREFIX, str(tmp_path / run), BUCKET, s3, cache=cache)
+    for run in ["first", "second"]:
+        path = tmp_path / run / "data" / "reads.r1.fastq"
+        assert os.stat(path).st_nlink == 1
+        assert os.access(path, os.W_OK)
+        path.write_bytes(b"overwritten")
+    download_dir(PREFIX, str(tmp_path / "third"), BUCKET, s3, cache=cache)
+    assert _local_files(str(tmp_path / "third")) == _expected(objects)
+
+
+def test_download_cache_eviction_spares_foreign_objects(s3, objects, tmp_path):
+    foreign = ["cache/notes.txt", "cache-other/" + "0" * 64, "cache/sub/" + "0" * 64]
+    for key in foreign:
+        s3.put_object(Bucket=BUCKET, Key=key, Body=b"not an entry")
+    cache = open_cache(f"s3://{BUCKET}/cache", s3, max_bytes=0)
+    download_dir(PREFIX, str(tmp_path / "run"), BUCKET, s3, cache=cache)
+    assert sorted(_cache_keys(s3, "cache")) == sorted(foreign)
+
+    root = tmp_path / "cache"
+    _write(str(root), "notes.txt", b"not an entry")
+    cache = open_cache(str(root), s3, max_bytes=0)
+    download_dir(PREFIX, str(tmp_path / "local"), BUCKET, s3, cache=cache)
+    assert _local_files(str(root)) == {"notes.txt": b"not an entry"}
+
+
+def _write(root, rel, body: bytes):
+    path = os.path.join(root, rel)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(body)
+
+
+def _bundle_location(tmp_path, location: str) -> str:
+    return str(tmp_path / "store") if location == "local" else location
+
+
+@pytest.mark.parametrize("location", ["local", f"s3://{BUCKET}/bundles"])
+def test_bundle_store_round_trip(s3, tmp_path, location):
+    store = open_bundle_store(_bundle_location(tmp_path, location), s3)
+    files = {"a.txt": os.urandom(1000), "sub/b.txt": b""}
+    for name, body in files.items():
+        _write(str(tmp_path / "src"), name, body)
+    assert store.files("digest") is None
+    assert not store.fetch("digest", lambda name: str(tmp_path / "dest" / name))
+    assert not (tmp_path / "dest").exists()
+
+    store.publish("digest", {name: str(tmp_path / "src" / name) for name in files})
+    assert store.files("digest") == ["a.txt", "sub/b.txt"]
+    # A published bundle is never replaced.
+    _write(str(tmp_path / "src"), "a.txt", b"changed")
+    store.publish("digest", {name: str(tmp_path / "src" / name) for name in files})
+
+    assert store.fetch("digest", lambda name: str(tmp_path / "dest" / name))
+    assert _local_files(str(tmp_path / "dest")) == files
+
+
+def test_s3_bundle_without_marker_is_a_miss(s3, tmp_path):
+    store = open_bundle_store(f"s3://{BUCKET}/bundles", s3)
+    s3.put_object(Bucket=BUCKET, Key="bundles/digest/a.txt", Body=b"partial")
+    assert store.files("digest") is None
+    assert not store.fetch("digest", lambda name: str(tmp_path / name))
+    assert _local_files(str(tmp_path)) == {}
+
+
+def test_bundle_fetch_is_all_or_nothing(s3, tmp_path):
+    store = open_bundle_store(f"s3://{BUCKET}/bundles", s3)
+    for name in ["a.txt", "b.txt"]:
+        _write(str(tmp_path / "src"), name, name.encode())
+    store.publish("digest", {n: str(tmp_path / "src" / n) for n in ["a.txt", "b.txt"]})
+    s3.delete_object(Bucket=BUCKET, Key="bundles/digest/b.txt")
+
+    with pytest.raises(Exception):
+        store.fetch("digest", lambda name: str(tmp_path / "dest" / name))
+    assert _local_files(str(tmp_path / "dest")) == {}
+
+
+@pytest.mark.parametrize("location", ["local", f"s3://{BUCKET}/index"])
+def test_ensure_index(s3, tmp_path, location):
+    reference = str(tmp_path / "ref" / "genome.fa")
+    _write(str(tmp_path / "ref"), "genome.fa", b">chr1\nACGT\n")
+    index = {suffix: os.urandom(100) for suffix in INDEX_SUFFIXES}
+    for suffix, body in index.items():
+        _write(str(tmp_path / "ref"), "genome.fa" + suffix, body)
+    cache = open_index_cache(_bundle_location(tmp_path, location), s3)
+
+    # An index found next to the reference is used but not published.
+    digest = ensure_index(reference, "false", cache)
+    assert cache.store.files(digest) is None
+
+    cache.publish(digest, reference)
+    for suffix in INDEX_SUFFIXES:
+        os.remove(reference + suffix)
+    # bwa is `false`, so building instead of fetching would fail.
+    assert ensure_index(reference, "false", cache) == digest
+    for suffix, body in index.items():
+        with open(reference + suffix, "rb") as f:
+            assert f.read() == body
+
+
+def test_control_digest(tmp_path):
+    reads = {}
+    for end in ["r1", "r2", "i1", "i2"]:
+        reads[end] = str(tmp_path / f"control.{end}.fastq")
+        _write(str(tmp_path), f"control.{end}.fastq", end.encode())
+    digest = control_digest(reads, "reference", compressed=False)
+    assert digest == control_digest(
+        dict(reversed(reads.items())), "reference", compressed=False
+    )
+    assert digest != control_digest(reads, "other-reference", compressed=False)
+    assert digest != control_digest(reads, "reference", compressed=True)
+    _write(str(tmp_path), "control.i2.fastq", b"changed")
+    assert digest != control_digest(reads, "reference", compressed=False)
+
+
+@pytest.mark.parametrize("location", ["local", f"s3://{BUCKET}/controls"])
+def test_control_cache_round_trip(s3, tmp_path, location):
+    first = str(tmp_path / "first")
+    outputs = {
+        "consolidated/control.r1.consolidated.fastq": os.urandom(1000),
+        "consolidated/control.r2.consolidated.fastq": os.urandom(1000),
+        "aligned/control.sam": b"@HD\tVN:1.0\n",
+        "identified/control_identifiedOfftargets.txt": b"header\n",
+        "identified/EMX1_identifiedOfftargets.txt": b"not the control's\n",
+    }
+    for rel, body in outputs.items():
+        _write(first, rel, body)
+    paths = control_files(first)
+    assert sorted(os.path.relpath(p, first) for p in paths) == sorted(
+        rel for rel in outputs if "control" in rel
+    )
+
+    cache = open_control_cache(_bundle_location(tmp_path, location), s3)
+    retry = str(tmp_path / "retry")
+    assert not cache.fetch("digest", retry)
+    cache.publish("digest", first, paths)
+    assert cache.fetch("digest", retry)
+    assert _local_files(retry) == {
+        rel: body for rel, body in outputs.items() if "control" in rel
+    }
+
+
+def test_control_cache_without_marker_is_a_miss(s3, tmp_path):
+    cache = open_control_cache(f"s3://{BUCKET}/controls", s3)
+    s3.put_object(Bucket=BUCKET, Key="controls/digest/aligned/control.sam", Body=b"")
+    assert not cache.fetch("digest", str(tmp_path))
+    assert _local_files(str(tmp_path)) == {}
+
+
+def test_checkpoints_resume(s3, tmp_path):
+    manifest = tmp_path / "manifest.yaml"
+    manifest.write_bytes(b"samples: {}\n")
+    digest = run_digest(str(manifest), execution="exec-1")
+    assert digest != run_digest(str(manifest), execution="exec-2")
+
+    first = str(tmp_path / "first")
+    outputs = {
+        "demultiplexed/a.r1.fastq": os.urandom(10_000),
+        "demultiplexed/b.r1.fastq": b"",
+        "umitagged/a.r1.umitagged.fastq": os.urandom(100),
+    }
+    for rel, body in outputs.items():
+        _write(first, rel, body)
+    checkpoints = Checkpoints(first, BUCKET, "outputs/run", digest, s3)
+    checkpoints.record("demultiplex")
+    checkpoints.record("umitag")
+    stages = ["demultiplex", "umitag", "consolidate"]
+    assert checkpoints.completed(stages) == ["demultiplex", "umitag"]
+    assert checkpoints.sizes(["demultiplex"]) == {
+        "demultiplexed/a.r1.fastq": 10_000,
+        "demultiplexed/b.r1.fastq": 0,
+    }
+
+    retry = str(tmp_path / "retry")
+    resumed = Checkpoints(retry, BUCKET, "outputs/run", digest, s3)
+    assert resumed.completed(stages) == ["demultiplex", "umitag"]
+    resumed.restore("umitag")
+    assert _local_files(retry) == {
+        "umitagged/a.r1.umitagged.fastq": outputs["umitagged/a.r1.umitagged.fastq"]
+    }
+
+    other = Checkpoints(retry, BUCKET, "outputs/run", "other-digest", s3)
+    assert other.completed(stages) == []
+
+
+def test_checkpoint_restore_detects_changed_files(s3, tmp_path):
+    root = str(tmp_path / "run")
+    _write(root, "demultiplexed/a.r1.fastq", b"ACGT\n")
+    Checkpoints(root, BUCKET, "outputs/run", "digest", s3).record("demultiplex")
+    s3.put_object(
+        Bucket=BUCKET, Key="outputs/run/demultiplexed/a.r1.fastq", Body=b"TTTT\n"
+    )
+
+    retry = Checkpoints(str(tmp_path / "retry"), BUCKET, "outputs/run", "digest", s3)
+    with pytest.raises(RuntimeError, match="demultiplexed/a.r1.fastq"):
+        retry.restore("demultiplex")
+
+
+def test_run_cache(s3, tmp_path):
+    data = {"samples": {}, "output_folder": "outputs"}
+    fingerprint = run_fingerprint(data, {"reads.fastq": '"etag-1"'}, stream=False)
+    assert fingerprint != run_fingerprint(
+        data, {"reads.fastq": '"etag-2"'}, stream=False
+    )
+    outputs = {
+        "identified/a_identifiedOfftargets.txt": b"site\n",
+        "filtered/a_backgroundOfftargets.txt": b"",
+    }
+    for rel, body in outputs.items():
+        s3.put_object(Bucket=BUCKET, Key=f"runs/first/{rel}", Body=body)
+
+    cache = open_run_cache(f"s3://{BUCKET}/run-cache", s3)
+    assert cache.lookup(fingerprint) is None
+    with pytest.raises(ValueError, match="missing.txt"):
+        cache.store(fingerprint, list(outputs) + ["missing.txt"], BUCKET, "runs/first")
+    cache.store(fingerprint, list(outputs), BUCKET, "runs/first")
+
+    record = cache.lookup(fingerprint)
+    assert record is not None
+    keys = cache.copy(record, BUCKET, "runs/second")
+    assert sorted(keys) == sorted(f"runs/second/{rel}" for rel in outputs)
+    for rel, body in outputs.items():
+        copied = s3.get_object(Bucket=BUCKET, Key=f"runs/second/{rel}")
+        assert copied["Body"].read() == body
+    assert cache.copy(record, BUCKET, "runs/first") == []
+
+    # Same size, different bytes: only the ETag tells the outputs apart.
+    s3.put_object(
+        Bucket=BUCKET,
+        Key="runs/first/identified/a_identifiedOfftargets.txt",
+        Body=b"SITE\n",
+    )
+    assert cache.lookup(fingerprint) is None
+
+
+def _manifest(**fields) -> dict:
+    data = {
+        "reference_genome": "test/genome.fa",
+        "output_folder": "outputs",
+        "undemultiplexed": {
+            field: f"test/undemux.{field}.fastq"
+            for field in ("forward", "reverse", "index1", "index2")
+        },
+        "samples": {
+            "control": {"barcode1": "CTCTCTAC", "barcode2": "CTCTCTAT"},
+            "EMX1": {
+                "barcode1": "TAGGCATG",
+                "barcode2": "TAGATCGC",
+                "target": "GAGTCCGAGCAGAAGAAGAANGG",
+            },
+        },
+    }
+    data.update(fields)
+    return data
+
+
+def test_check_manifest_accepts_valid_manifest():
+    assert check_manifest(_manifest()) == ([], [])
+
+
+@pytest.mark.parametrize(
+    "fields, error",
+    [
+        (
+            {"samples": {"EMX1": {"barcode1": "TAGGCATG", "barcode2": "TAGATCGC"}}},
+            "must contain a 'control' sample",
+        ),
+        (
+            {
+                "samples": {
+                    "control": {"barcode1": "CTCTCTAC", "barcode2": "CTCTCTAT"},
+                    "EMX1": {"barcode1": "CTCTCTAC", "barcode2": "CTCTCTAT"},
+                }
+            },
+            "share barcode",
+        ),
+        (
+            {
+                "samples": {
+                    "control": {"barcode1": "CTCTCTAC", "barcode2": "CTCT"},
+                    "EMX1": {"barcode1": "TAGGCATG", "barcode2": "TAGATCGC"},
+                }
+            },
+            "control' barcode2 must be at least 8 bases",
+        ),
+        (
+            {
+                "samples": {
+                    "control": {"barcode1": "CTCTCTAC", "barcode2": "CTCTCTAT"},
+                    "EMX1": {
+                        "barcode1": "TAGGCATG",
+                        "barcode2": "TAGATCGC",
+                        "target": "GAGT CCG",
+                    },
+                }
+            },
+            "target must be a nucleotide sequence",
+        ),
+        ({"reference_genome": ""}, "'reference_genome' must be the path"),
+        ({"bwa": ""}, "'bwa' must be a non-empty string"),
+        ({"demultiplex_min_reads": -1}, "must be a non-negative integer"),
+        ({"undemultiplexed": {"forward": "r1.fastq"}}, "missing 'index2'"),
+    ],
+)
+def test_check_manifest_errors(fields, error):
+    errors, _ = check_manifest(_manifest(**fields))
+    assert any(error in e for e in errors), errors
+
+
+def test_check_manifest_warnings():
+    _, warnings = check_manifest(_manifest(flowcell="A"))
+    assert warnings == ["Unknown manifest field 'flowcell' is ignored"]
+    samples = {
+        "control": {"barcode1": "CTCTCTAC", "barcode2": "CTCTCTAT"},
+        "EMX1": {"barcode1": "CTCTCTAA", "barcode2": "CTCTCTAT"},
+    }
+    errors, warnings = check_manifest(_manifest(samples=samples), max_mismatches=1)
+    assert errors == []
+    assert "are within 2 mismatches" in warnings[0]
+
+
+def test_check_manifest_skip_demultiplex():
+    errors, _ = check_manifest(_manifest(), skip_demultiplex=True)
+    assert "skip_demultiplex needs a 'demultiplexed' block per sample" in errors
+    assert "'demultiplexed' has no reads for sample 'EMX1'" in errors
+
+
+def test_identify_and_filter_reads_alignments():
+    data = _manifest(undemultiplexed=None)
+    assert check_manifest(data, identify_and_filter=True) == ([], [])
+    assert input_paths(data, identify_and_filter=True) == [
+        "test/genome.fa",
+        "outputs/aligned/control.sam",
+        "outputs/aligned/EMX1.sam",
+    ]
+    errors, _ = check_manifest(_manifest(output_folder=None), identify_and_filter=True)
+    assert errors == ["identify_and_filter needs the 'output_folder' holding aligned/"]
+
+
+def _fastq(n: int, index: str = "ACGTACGTACGT") -> bytes:
+    return b"".join(
+        f"@read{i:05d}\n{index}\n+\n{'I' * len(index)}\n".encode() for i in range(n)
+    )
+
+
+def test_estimate_reads_plain():
+    fastq = _fastq(1000)
+    head = fastq[:10_000]
+    reads, sequences = estimate_reads(head, len(fastq))
+    assert reads == 1000
+    assert len(sequences) == 10_000 // (len(fastq) // 1000)
+    assert set(sequences) == {b"ACGTACGTACGT"}
+    assert estimate_reads(b"@read0\nACGT\n", 100) == (0, [])
+
+
+def test_estimate_reads_bgzip():
+    fastq = _fastq(1000)
+    # bgzip writes independent gzip members, the head ends inside one.
+    blocks = [gzip.compress(fastq[i : i + 4096]) for i in range(0, len(fastq), 4096)]
+    compressed = b"".join(blocks)
+    head = compressed[: len(blocks[0]) + len(blocks[1]) + 10]
+    reads, sequences = estimate_reads(head, len(compressed))
+    assert abs(reads - 1000) <= 20
+    assert set(sequences) == {b"ACGTACGTACGT"}
+
+
+def test_plan_run(s3):
+    data = _manifest()
+    data["samples"]["EMX1"]["barcode1"] = "TTAGGCAT"
+    keys = {p: f"{PREFIX}/{p}" for p in input_paths(data)}
+    bodies = {
+        "test/genome.fa": b">chr1\nACGT\n",
+        "test/undemux.forward.fastq": _fastq(200),
+        "test/undemux.reverse.fastq": _fastq(200),
+        "test/undemux.index1.fastq": _fastq(100, "CTCTCTAC") + _fastq(100, "TTAGGCAT"),
+        "test/undemux.index2.fastq": _fastq(200, "CTCTCTAT"),
+    }
+    for path, body in bodies.items():
+        s3.put_object(Bucket=BUCKET, Key=keys[path], Body=body)
+    optional = {"test/genome.fa.fai": f"{PREFIX}/test/genome.fa.fai"}
+
+    plan = plan_run(data, keys, BUCKET, optional, client=s3)
+    assert plan["reference_bytes"] == len(bodies["test/genome.fa"])
+    assert plan["fastq_bytes"] == sum(map(len, bodies.values())) - len(
+        bodies["test/genome.fa"]
+    )
+    assert plan["prebuilt_index"] is False
+    # index2 of the EMX1 reads is the control's, so they are undetermined.
+    assert plan["estimated_reads"] == {"control": 100, "EMX1": 0, "undetermined": 100}
+    assert plan["tier"]["name"] == "small"
+
+    s3.delete_object(Bucket=BUCKET, Key=keys["test/undemux.index2.fastq"])
+    with pytest.raises(PreflightError) as e:
+        plan_run(data, keys, BUCKET, optional, client=s3)
+    assert e.value.problems == [
+        f"Input does not exist: s3://{BUCKET}/{PREFIX}/test/undemux.index2.fastq "
+        "(test/undemux.index2.fastq)"
+    ]
+
+
+def test_sort_buffer():
+    assert sort_buffer(32 * 1024**3) == f"{8 * 1024**3}b"
+    assert sort_buffer(0) == f"{MIN_SORT_BUFFER}b"
+
+
+@pytest.fixture
+def fasta(tmp_path):
+    """Multi-line FASTA mixing upper and lower case, with ragged last lines."""
+    rng = random.Random(0)
+    path = tmp_path / "genome.fa"
+    with open(path, "w") as f:
+        for name, length, width in [
+            ("chr1", 1000, 60),
+            ("chr2 desc", 75, 25),
+            ("chrM", 7, 70),
+        ]:
+            seq = "".join(rng.choice("ACGTNacgtn") for _ in range(length))
+            f.write(f">{name}\n")
+            f.writelines(seq[i : i + width] + "\n" for i in range(0, length, width))
+    return str(path)
+
+
+def _faidx(fasta: str, *regions: str) -> str:
+    return subprocess.run(
+        ["samtools", "faidx", fasta, *regions],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout
+
+
+requires_samtools = pytest.mark.skipif(
+    shutil.which("samtools") is None, reason="samtools is not installed"
+)
+
+
+@requires_samtools
+def test_build_fai_matches_samtools(fasta, tmp_path):
+    ours = build_fai(fasta, str(tmp_path / "ours.fai"))
+    _faidx(fasta)
+    with open(ours) as f, open(fasta + ".fai") as expected:
+        assert f.read() == expected.read()
+    assert read_fai(ours) == read_fai(fasta + ".fai")
+    entry = read_fai(ours)["chr2"]
+    assert (entry.length, entry.line_bases, entry.line_width) == (75, 25, 26)
+
+
+@requires_samtools
+def test_reference_matches_samtools(fasta):
+    regions = [
+        ("chr1", 0, 1000),
+        ("chr1", 59, 61),
+        ("chr1", 110, 171),
+        ("chr1", 990, 1200),
+        ("chr2", 24, 51),
+        ("chr2", 70, 75),
+        ("chrM", 0, 7),
+    ]
+    expected = []
+    for chrom, start, end in regions:
+        lines = _faidx(fasta, f"{chrom}:{start + 1}-{end}").splitlines()
+        expected.append("".join(lines[1:]).encode())
+
+    with Reference(fasta) as genome:
+        for (chrom, start, end), sequence in zip(regions, expected):
+            assert genome.fetch(chrom, start, end) == sequence
+            assert b"".join(genome.segments(chrom, start, end)) == sequence
+        shuffled = list(reversed(regions))
+        assert genome.fetch_many(shuffled) == list(reversed(expected))
+        assert genome.fetch("chrX", 0, 10) == b""
+
+
+TARGET = "GAGTCCGAGCAGAAGAAGAANGG"
+LEFT_FLANK = "ACCTTGACCATCAATCAGTC"
+RIGHT_FLANK = "TCAGTACTGATCACTGTTCA"
+
+
+def _window(site: str) -> str:
+    return LEFT_FLANK + site + RIGHT_FLANK
+
+
+@pytest.mark.parametrize(
+    "window, expected",
+    [
+        (
+            _window("GAGTCCGAGCAGAAGAAGAAGGG"),
+            ["GAGTCCGAGCAGAAGAAGAAGGG", 0, "+", 20, 43]
+            + ["", "", "", "", "", "", "", "", "", "none"],
+        ),
+        (
+            _window("GAGTCCGAGCAGAAGAAGAAGGG").lower(),
+            ["GAGTCCGAGCAGAAGAAGAAGGG", 0, "+", 20, 43]
+            + ["", "", "", "", "", "", "", "", "", "none"],
+        ),
+        (
+            reverse_complement(_window("GAGTCTGAGCAGTAGAAGAAAGG")),
+            ["GAGTCTGAGCAGTAGAAGAAAGG", 2, "-", 20, 43]
+            + ["", "", "", "", "", "", "", "", "", "none"],
+        ),
+        # DNA bulge: an extra T in the off-target.
+        (
+            _window("GAGTCCGAGCAGAAGTAAGAAGGG"),
+            ["GAGTCCGAGCAGAAGTAAGAAGG", 3, "+", 20, 43]
+            + ["GAGTCCGAGCAGAAGTAAGAAGGG", 24, 3, 0, 1, 0, "+", 20, 44]
+            + ["GAGTCCGAGCAGAAG-AAGAANGG"],
+        ),
+        # RNA bulge: the off-target lacks a G of the target.
+        (
+            _window("GAGTCCGAGCAAAGAAGAATGG"),
+            ["GAGTCCGAGCAAAGAAGAATGGT", 7, "+", 20, 43]
+            + ["GAGTCCGAGCA-AAGAAGAATGG", 22, 3, 0, 0, 1, "+", 20, 42]
+            + ["GAGTCCGAGCAGAAGAAGAANGG"],
+        ),
+        ("ACGT" * 12, [""] * 14 + ["none"]),
+    ],
+)
+def test_align_sequences(window, expected):
+    assert align_sequences(TARGET, window) == expected
+
+
+def test_align_sites_keeps_order(monkeypatch):
+    monkeypatch.setattr(identify, "ALIGN_BATCH", 2)
+    windows = [
+        _window("GAGTCCGAGCAGAAGAAGAAGGG"),
+        "ACGT" * 12,
+        _window("GAGTCCGAGCAAAGAAGAATGG"),
+    ]
+    assert align_sites(windows, TARGET) == [
+        align_sequences(TARGET, window) for window in windows
+    ]
+
+
+def _sam_read(
+    chrom: str,
+    position: int,
+    barcode: str,
+    count: int = 1,
+    primer: str = "",
+    flag: int = 0x1 | 0x2 | 0x80,
+    mapq: int = 60,
+    template_length: int = 100,
+) -> str:
+    """A second-of-pair read as consolidate names it, starting with primer."""
+    seq = primer + "ACGTTGCA" * 3
+    if flag & 0x10:
+        seq = reverse_complement(seq)
+    if template_length < 0:
+        # guideseq places a reverse read at the end of its template.
+        pos, mate_pos = position, position + template_length + 1
+    else:
+        pos, mate_pos = position, position + 50
+    name = f"{barcode}_{count}"
+    fields = [name, flag, chrom, pos, mapq, f"{len(seq)}M", "=", mate_pos]
+    fields += [template_length, seq, "I" * len(seq)]
+    return "\t".join(map(str, fields)) + "\n"
+
+
+@pytest.fixture
+def identify_inputs(tmp_path):
+    """
+    Reads on chromosome 1 in three windows, the first two around a copy of
+    TARGET at [60, 83), and one window on chromosome 2.
+    """
+    rng = random.Random(1)
+    chrom1 = [rng.choice("ACGT") for _ in range(200)]
+    chrom1[60:83] = "GAGTCCGAGCAGAAGAAGAAGGG"
+    with open(tmp_path / "genome.fa", "w") as f:
+        f.write(">1\n" + "".join(chrom1) + "\n")
+        f.write(">2\n" + "".join(rng.choice("ACGT") for _ in range(200)) + "\n")
+
+    p1, p2 = "TTGAGTTGTCATATGTTAAT", "ACATATGACAACTCAATTAA"
+    minus = {"flag": 0x1 | 0x2 | 0x10 | 0x80, "template_length": -100}
+    bc = ["AAAACCCC_AAACCC_AAACC" + c for c in "ACGT"] + [
+        "CCCCAAAA_CCCAAA_CCCAA" + c for c in "ACGT"
+    ]
+    reads = [
+        # Window 1: the rightmost of two equally supported positions wins.
+        _sam_read("1", 58, bc[4]),
+        _sam_read("1", 60, bc[5], 2, **minus),
+        # Window 2: one molecule counted once at 72 however many reads.
+        _sam_read("1", 72, bc[0], 3, p1),
+        _sam_read("1", 72, bc[0], 2, p1),
+        _sam_read("1", 75, bc[1], 1, p2, **minus),
+        _sam_read("1", 78, bc[2]),
+        _sam_read("1", 80, bc[3], 4, **minus),
+        # Window 3 is seen on one strand only. guideseq ignores the rest.
+        _sam_read("1", 150, bc[0]),
+        _sam_read("1", 151, bc[1], flag=0x1 | 0x2 | 0x10 | 0x40, template_length=-9),
+        _sam_read("1", 152, bc[2], mapq=49, **minus),
+        _sam_read("1", 153, bc[3], flag=0x1 | 0x2 | 0x10 | 0x80 | 0x800),
+        _sam_read("1", 154, bc[3], template_length=0),
+        # Window 4: both primers on one strand.
+        _sam_read("2", 100, bc[6], 1, p1),
+        _sam_read("2", 102, bc[7], 1, p2),
+    ]
+    sam = tmp_path / "sample.sam"
+    with open(sam, "w") as f:
+        f.write("@SQ\tSN:1\tLN:200\n@SQ\tSN:2\tLN:200\n")
+        f.writelines(reads)
+    return str(sam), str(tmp_path / "genome.fa")
+
+
+def _table(path: str) -> list:
+    with open(path) as f:
+        header, *lines = f.read().splitlines()
+    assert header.split("\t") == list(identify.COLUMNS)
+    return [dict(zip(identify.COLUMNS, line.split("\t"))) for line in lines]
+
+
+def test_identify_windows(identify_inputs, tmp_path):
+    sam, genome = identify_inputs
+    out = str(tmp_path / "identified" / "sample.txt")
+    assert identify.identify(sam, genome, out, "sample", "", None) == 3
+    rows = _table(out)
+    assert [(r["#BED_Chromosome"], r["WindowIndex"], r["Position"]) for r in rows] == [
+        ("chr1", "1", "60"),
+        ("chr1", "2", "80"),
+        ("chr2", "4", "102"),
+    ]
+    window = rows[1]
+    assert window["BED_Name"] == "chr1_80_4"
+    assert (window["BED_Min.Position"], window["BED_Max.Position"]) == ("72", "80")
+    assert window["Filename"] == "sample.sam"
+    assert window["WindowSequence"] == "".join(
+        Reference(genome).fetch("1", 55, 105).decode()
+    )
+    counts = ["+.mi", "-.mi", "bi.sum.mi", "bi.geometric_mean.mi"]
+    counts += ["+.total", "-.total", "total.sum", "total.geometric_mean"]
+    counts += ["primer1.mi", "primer2.mi", "primer.geometric_mean", "position.stdev"]
+    assert [window[c] for c in counts] == [
+        "2",
+        "2",
+        "4",
+        "2.0",
+        "6",
+        "5",
+        "11",
+        "5.47722557505",
+        "1",
+        "1",
+        "1.0",
+        "3.031088913245535",
+    ]
+    assert [
+        rows[2][c] for c in ("primer1.mi", "primer2.mi", "primer.geometric_mean")
+    ] == [
+        "1",
+        "1",
+        "1.0",
+    ]
+    assert [window[c] for c in identify.COLUMNS[21:]] == [""] * 17 + [
+        "None",
+        "sample",
+        "",
+        "none",
+    ]
+
+
+def test_identify_merges_windows_on_one_site(identify_inputs, tmp_path):
+    sam, genome = identify_inputs
+    out = str(tmp_path / "sample.txt")
+    assert identify.identify(sam, genome, out, "sample", TARGET, "EMX1") == 2
+    site, other = _table(out)
+    # Both windows on chromosome 1 align to the target at [60, 83).
+    assert (site["WindowIndex"], site["bi.sum.mi"]) == ("1", "6")
+    assert [site[c] for c in identify.COLUMNS[21:29]] == [
+        "chr1_60_2",
+        "1",
+        "chr1",
+        "GAGTCCGAGCAGAAGAAGAAGGG",
+        "0",
+        "+",
+        "60",
+        "83",
+    ]
+    assert [site[c] for c in identify.COLUMNS[38:]] == [
+        "EMX1",
+        "sample",
+        TARGET,
+        "none",
+    ]
+    assert other["WindowIndex"] == "4"
+    assert [other[c] for c in identify.COLUMNS[21:24]] == ["", "", ""]
+    assert other["RealignedTargetSequence"] == "none"
+
+
+def test_py2_str():
+    assert identify._py2_str(2.0) == "2.0"
+    assert identify._py2_str(30**0.5) == "5.47722557505"
+    assert identify._py2_str(1e16) == "1e+16"
+
+
+def _identified(rows) -> str:
+    """An identified/ table of (chromosome, position, molecules) sites."""
+    lines = ["\t".join(identify.COLUMNS)]
+    for i, (chrom, position, molecules) in enumerate(rows, start=1):
+        values = dict.fromkeys(identify.COLUMNS, "")
+        values.update(
+            {
+                "#BED_Chromosome": f"chr{chrom}",
+                "BED_Min.Position": str(position - 2),
+                "BED_Max.Position": str(position),
+                "BED_Name": f"chr{chrom}_{position}_{molecules}",
+                "WindowIndex": str(i),
+                "WindowChromosome": chrom,
+                "Position": str(position),
+                "bi.sum.mi": str(molecules),
+                "bi.geometric_mean.mi": "1.41421356237",
+                "position.stdev": "0.5",
+                "BED_Score": "1",
+                # python2 may print whole numbers as floats.
+                "Site_SubstitutionsOnly.NumSubstitutions": "2.0",
+                "RealignedTargetSequence": "none",
+            }
+        )
+        lines.append("\t".join(values[c] for c in identify.COLUMNS))
+    return "\n".join(lines) + "\n"
+
+
+def test_write_offtargets(tmp_path):
+    samples = {
+        "control": {"target": None, "description": "Control"},
+        "EMX1": {"target": TARGET, "description": "EMX1"},
+        "VEGFA": {"target": "GGGTGGGGGGAGTTTGCTCCNGG", "description": "VEGFA"},
+        "missing": {"target": TARGET, "description": "no table"},
+    }
+    tables = {
+        "control": [("2", 500, 3), ("1", 100, 2)],
+        "EMX1": [("1", 300, 9), ("1", 100, 5), ("10", 7, 1)],
+        "VEGFA": [("1", 200, 4), ("2", 50, 8)],
+    }
+    root = str(tmp_path)
+    os.makedirs(os.path.join(root, "identified"))
+    for sample, rows in tables.items():
+        with open(identified_path(root, sample), "w") as f:
+            f.write(_identified(rows))
+    # EMX1's site at 1:300 survives background filtering, the others not.
+    os.makedirs(os.path.dirname(filtered_path(root, "EMX1")))
+    with open(filtered_path(root, "EMX1"), "w") as f:
+        f.write(_identified([("1", 300, 9)]))
+
+    out = write_offtargets(root, samples, row_group_rows=2)
+    assert out == os.path.join(root, "offtargets")
+
+    sites = pq.read_table(os.path.join(out, "sites.parquet"))
+    schema = {field.name: str(field.type) for field in sites.schema}
+    assert list(schema)[:3] == ["sample", "target", "background_filtered"]
+    assert list(schema)[3:] == list(identify.COLUMNS)
+    assert schema["Position"] == schema["Site_GapsAllowed.End"] == "int64"
+    assert schema["position.stdev"] == "double"
+    assert schema["WindowSequence"] == "string"
+    assert schema["background_filtered"] == "bool"
+
+    rows = sites.to_pylist()
+    assert [(r["WindowChromosome"], r["Position"], r["sample"]) for r in rows] == [
+        ("1", 100, "EMX1"),
+        ("1", 100, "control"),
+        ("1", 200, "VEGFA"),
+        ("1", 300, "EMX1"),
+        ("10", 7, "EMX1"),
+        ("2", 50, "VEGFA"),
+        ("2", 500, "control"),
+    ]
+    assert [r["background_filtered"] for r in rows] == [
+        False,
+        None,
+        None,
+        True,
+        False,
+        None,
+        None,
+    ]
+    first = rows[0]
+    assert first["target"] == TARGET
+    assert first["Site_SubstitutionsOnly.NumSubstitutions"] == 2
+    assert first["bi.geometric_mean.mi"] == pytest.approx(2**0.5)
+    assert first["Site_GapsAllowed.Sequence"] is None
+    assert first["RealignedTargetSequence"] == "none"
+
+    metadata = pq.ParquetFile(os.path.join(out, "sites.parquet")).metadata
+    assert metadata.num_row_groups == 4
+    index = pq.read_table(os.path.join(out, "samples.parquet")).to_pylist()
+    assert index == [
+        {
+            "sample": "EMX1",
+            "target": TARGET,
+            "description": "EMX1",
+            "sites": 3,
+            "background_filtered_sites": 1,
+            "row_groups": [0, 1, 2],
+        },
+        {
+            "sample": "VEGFA",
+            "target": "GGGTGGGGGGAGTTTGCTCCNGG",
+            "description": "VEGFA",
+            "sites": 2,
+            "background_filtered_sites": 0,
+            "row_groups": [1, 2],
+        },
+        {
+            "sample": "control",
+            "target": None,
+            "description": "Control",
+            "sites": 2,
+            "background_filtered_sites": 0,
+            "row_groups": [0, 3],
+        },
+    ]
+
+
+def test_write_offtargets_without_tables(tmp_path):
+    assert write_offtargets(str(tmp_path), {"control": {}}) is None
+
+
+def test_write_offtargets_rejects_mixed_columns(tmp_path):
+    root = str(tmp_path)
+    os.makedirs(os.path.join(root, "identified"))
+    with open(identified_path(root, "control"), "w") as f:
+        f.write(_identified([("1", 100, 2)]))
+    with open(identified_path(root, "EMX1"), "w") as f:
+        f.write("#BED Chromosome\tPosition\nchr1\t100\n")
+    with pytest.raises(ValueError, match="different columns"):
+        write_offtargets(root, {"control": {}, "EMX1": {}})